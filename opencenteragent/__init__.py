@@ -36,6 +36,8 @@ import sys
 import time
 import traceback
 
+from collections import deque
+from threading import Condition
 from threading import Thread
 
 from ConfigParser import ConfigParser
@@ -47,12 +49,12 @@ from opencenteragent.utils import detailed_exception
 
 
 class OpenCenterAgentDispatchWorker(Thread):
-    def __init__(self, input_handler, output_handler, data):
+    def __init__(self, pool):
         super(OpenCenterAgentDispatchWorker, self).__init__()
 
-        self.data = data
-        self.output_handler = output_handler
-        self.input_handler = input_handler
+        self.pool = pool
+        self.output_handler = pool.output_handler
+        self.input_handler = pool.input_handler
         self.logger = logging.getLogger('opencenter-agent.dispatch')
 
     # apparently signals can only be set in python on the mainline thread.
@@ -63,19 +65,36 @@ class OpenCenterAgentDispatchWorker(Thread):
     #     signal.signal(signal.SIGINT, signal.SIG_IGN) # Workers should ignore
 
     def run(self):
-        data = self.data
+        # self._worker_signals()
+
+        while True:
+            work = self.pool.get_work()
+            if work is None:
+                break
+
+            data, reserved = work
+            try:
+                self.dispatch(data, reserved)
+            finally:
+                self.pool.work_done()
+
+        self.logger.debug('dispatch worker terminating')
+
+    def dispatch(self, data, reserved=False):
         input_handler = self.input_handler
         output_handler = self.output_handler
 
-#        self._worker_signals()
-
         data['output'] = {'result_code': 255,
                           'result_str': 'unknown error',
                           'result_data': ''}
 
         try:
             self.logger.debug('sending input data to output handler')
-            data['output'] = output_handler.dispatch(data['input'])
+            if reserved:
+                data['output'] = output_handler.dispatch(data['input'],
+                                                         reserved=True)
+            else:
+                data['output'] = output_handler.dispatch(data['input'])
             self.logger.debug('got return from output handler')
 
         except KeyboardInterrupt:
@@ -90,8 +109,209 @@ class OpenCenterAgentDispatchWorker(Thread):
 
         self.logger.debug(
             'passing output handler result back to input handler')
-        input_handler.result(data)
-        self.logger.debug('dispatch handler terminating')
+        try:
+            input_handler.result(data)
+        except Exception:
+            self.logger.error('exception in input handler result: %s' %
+                              detailed_exception())
+
+
+class OpenCenterAgentDispatchPool(object):
+    """A fixed set of dispatch workers fed from a bounded work queue.
+
+    submit() blocks while the queue is full, so a dispatch loop that
+    calls wait_for_capacity() before fetching stops pulling input as
+    soon as every worker is busy and the queue is saturated.
+
+    Workers take the highest priority queued task, as rated by the
+    output handler's priority(), and the oldest within a priority.
+    So that low priority work isn't starved, a task's priority rises
+    by one for every aging seconds it waits.
+
+    If the output handler can reserve() concurrency slots, tasks that
+    conflict with running actions are passed over, and wait in the
+    queue rather than tying up a worker.
+    """
+
+    def __init__(self, input_handler, output_handler, size=8,
+                 queue_size=16, aging=30):
+        self.input_handler = input_handler
+        self.output_handler = output_handler
+        self.size = max(1, int(size))
+        self.queue_size = max(1, int(queue_size))
+        self.aging = float(aging)
+        # (priority, queued time, task), in arrival order
+        self.queue = deque()
+        self.condition = Condition()
+        self.workers = []
+        self.busy = 0
+        self.submitted = 0
+        self.completed = 0
+        self.running = False
+        self.logger = logging.getLogger('opencenter-agent.dispatch')
+
+        # retry held-back tasks whenever a running action finishes
+        if hasattr(output_handler, 'add_release_listener'):
+            output_handler.add_release_listener(self._wakeup)
+
+    def _wakeup(self):
+        with self.condition:
+            self.condition.notify_all()
+
+    def _priority(self, data):
+        priority = getattr(self.output_handler, 'priority', None)
+        if priority is None:
+            return 0
+
+        try:
+            return priority(data['input'])
+        except Exception:
+            # let the dispatch proper report the bad input
+            return 0
+
+    def _next_work(self):
+        # pick the most urgent task the output handler will admit now
+        reserve = getattr(self.output_handler, 'reserve', None)
+
+        now = time.time()
+        queue = self.queue
+
+        def rank(index):
+            # a level for every aging seconds waited, then oldest first
+            priority, queued, data = queue[index]
+            return (-(priority + (now - queued) / self.aging), queued)
+
+        for index in sorted(range(len(queue)), key=rank):
+            data = queue[index][2]
+            if reserve is None:
+                reserved = False
+            else:
+                try:
+                    if not reserve(data['input']):
+                        continue
+                    reserved = True
+                except Exception:
+                    # let the dispatch proper report the bad input
+                    reserved = False
+
+            del queue[index]
+            return data, reserved
+
+        return None
+
+    def start(self):
+        with self.condition:
+            if self.running:
+                return
+            self.running = True
+
+        self.logger.debug('starting %d dispatch workers' % self.size)
+        for _ in range(self.size):
+            worker = OpenCenterAgentDispatchWorker(self)
+            worker.setDaemon(True)
+            worker.start()
+            self.workers.append(worker)
+
+    def stop(self, timeout=5):
+        with self.condition:
+            self.running = False
+            dropped = [data for priority, queued, data in self.queue]
+            self.queue.clear()
+            self.condition.notify_all()
+
+        # tasks that never reached a worker go back to their input
+        # plugin, so they are picked up again rather than left
+        # "running" upstream
+        unclaim = getattr(self.input_handler, 'unclaim', None)
+        for data in dropped:
+            try:
+                if unclaim is not None and unclaim(data):
+                    continue
+            except Exception:
+                self.logger.error('exception in input handler unclaim: %s' %
+                                  detailed_exception())
+            self.logger.warning('dropping queued task on shutdown: %s' %
+                                data['input'])
+
+        for worker in self.workers:
+            worker.join(timeout)
+        self.workers = []
+
+    def saturated(self):
+        with self.condition:
+            return len(self.queue) >= self.queue_size
+
+    def wait_for_capacity(self, timeout=None):
+        """Block until the work queue can accept another task.
+
+        :param: timeout: maximum number of seconds to wait, or None to
+                         wait indefinitely
+
+        :returns: True if there is room in the queue
+        """
+        with self.condition:
+            if timeout is not None:
+                deadline = time.time() + timeout
+
+            while self.running and len(self.queue) >= self.queue_size:
+                if timeout is None:
+                    self.condition.wait()
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+                    self.condition.wait(remaining)
+
+            return len(self.queue) < self.queue_size
+
+    def submit(self, data):
+        priority = self._priority(data)
+
+        with self.condition:
+            while self.running and len(self.queue) >= self.queue_size:
+                self.condition.wait()
+
+            if not self.running:
+                raise RuntimeError('dispatch pool is not running')
+
+            self.queue.append((priority, time.time(), data))
+            self.submitted += 1
+            self.condition.notify_all()
+
+    def get_work(self):
+        # called by workers.  returns a (task, reserved) tuple, or None
+        # when the pool is stopping.
+        with self.condition:
+            while True:
+                if not self.running:
+                    return None
+
+                work = self._next_work()
+                if work is not None:
+                    break
+
+                self.condition.wait()
+
+            self.busy += 1
+            self.condition.notify_all()
+            return work
+
+    def work_done(self):
+        with self.condition:
+            self.busy -= 1
+            self.completed += 1
+            self.condition.notify_all()
+
+    def stats(self):
+        with self.condition:
+            return {'workers': self.size,
+                    'busy': self.busy,
+                    'idle': self.size - self.busy,
+                    'utilisation': float(self.busy) / self.size,
+                    'queue_depth': len(self.queue),
+                    'queue_size': self.queue_size,
+                    'submitted': self.submitted,
+                    'completed': self.completed}
 
 
 class OpenCenterAgent():
@@ -101,6 +321,8 @@ class OpenCenterAgent():
         self.config_section = config_section
         self.input_handler = None
         self.output_handler = None
+        self.dispatch_pool = None
+        self.poll_interval = 5
         self.logger = logging.getLogger()
         self.logger.addHandler(logging.StreamHandler(sys.stderr))
         self.config = {config_section: {}}
@@ -155,6 +377,16 @@ class OpenCenterAgent():
     def _cleanup(self):
         output_handler = self.output_handler
         input_handler = self.input_handler
+        dispatch_pool = self.dispatch_pool
+
+        # stop the pool first, so the input plugins are still running
+        # to take back the tasks it drops
+        if dispatch_pool:
+            self.logger.debug('Stopping dispatch pool.')
+            try:
+                dispatch_pool.stop()
+            except:
+                pass
 
         if input_handler:
             self.logger.debug('Stopping input handler.')
@@ -362,30 +594,70 @@ class OpenCenterAgent():
         self.input_handler = InputManager(
             [x.strip() for x in input_handlers.split(',')], config)
 
+        # size of the dispatch pool and its backlog.  the input side
+        # stops fetching once the backlog is full.  waiting tasks gain
+        # a priority level every dispatch_priority_aging seconds.
+        workers = config[config_section].get('dispatch_workers', 8)
+        queue_size = config[config_section].get('dispatch_queue_size', 16)
+        aging = config[config_section].get('dispatch_priority_aging', 30)
+
+        self.dispatch_pool = OpenCenterAgentDispatchPool(
+            self.input_handler, self.output_handler,
+            size=int(workers), queue_size=int(queue_size),
+            aging=float(aging))
+
+        # while idle, the dispatch loop sleeps until an input plugin
+        # signals new input.  plugins that don't signal are polled
+        # at this interval.
+        self.poll_interval = float(config[config_section].get(
+            'input_poll_interval', 5))
+
+    def _check_health(self):
+        # log when the inputs change health state, so a lost server
+        # connection shows up once rather than on every retry.
+        health = self.input_handler.health()
+        state = health['state']
+        previous = getattr(self, 'input_health', 'ok')
+
+        if state != previous:
+            problems = dict((k, v) for k, v in health['plugins'].items()
+                            if v['state'] != 'ok')
+            if state == 'ok':
+                self.logger.info('Input plugins recovered')
+            else:
+                self.logger.warning('Input plugins %s: %s' %
+                                    (state, problems))
+        self.input_health = state
+        return health
+
     def dispatch(self):
-        output_handler = self.output_handler
         input_handler = self.input_handler
+        dispatch_pool = self.dispatch_pool
+
+        dispatch_pool.start()
 
         # we'll assume non-blocking.  we should negotiate this
         # with the plugins, I suppose
         do_quit = False
         try:
             while not do_quit:
+                # don't pull more work off the inputs than we can queue
+                dispatch_pool.wait_for_capacity()
+
                 self.logger.debug('FETCH')
                 result = input_handler.fetch()
                 if len(result) == 0:
-                    time.sleep(5)
+                    self._check_health()
+                    input_handler.wait(self.poll_interval)
                 else:
                     self.logger.debug('Got input from input handler "%s"'
                                       % (result['plugin']))
                     self.logger.debug('Data: %s' % result['input'])
 
                     # Apply to the pool
-                    worker = OpenCenterAgentDispatchWorker(input_handler,
-                                                           output_handler,
-                                                           result)
-                    worker.setDaemon(True)
-                    worker.start()
+                    dispatch_pool.submit(result)
+                    self.logger.debug('Dispatch pool: %s' %
+                                      dispatch_pool.stats())
         except KeyboardInterrupt:
             self.logger.debug('Got keyboard interrupt.')
             self._exit(False)
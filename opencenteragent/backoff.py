@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+#               OpenCenter(TM) is Copyright 2013 by Rackspace US, Inc.
+##############################################################################
+#
+# OpenCenter is licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.  This
+# version of OpenCenter includes Rackspace trademarks and logos, and in
+# accordance with Section 6 of the License, the provision of commercial
+# support services in conjunction with a version of OpenCenter which includes
+# Rackspace trademarks and logos is prohibited.  OpenCenter source code and
+# details are available at: # https://github.com/rcbops/opencenter or upon
+# written request.
+#
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0 and a copy, including this
+# notice, is available in the LICENSE file accompanying this software.
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the # specific language governing permissions and limitations
+# under the License.
+#
+##############################################################################
+#
+#
+
+import random
+import time
+
+
+class Backoff(object):
+    """Retry delays for reconnecting to something that's gone away.
+
+    The first retry comes quickly (after about first seconds), since
+    most failures are blips.  After that the delay starts at initial
+    seconds and grows by factor on every further failure, up to cap.
+
+    Each delay is randomised by up to jitter (a fraction of the
+    delay), so that a fleet of agents that lost the server at the same
+    moment doesn't come back at the same moment too.
+    """
+
+    def __init__(self, initial=1, cap=120, factor=2, jitter=0.5,
+                 first=0.5):
+        self.initial = float(initial)
+        self.cap = float(cap)
+        self.factor = float(factor)
+        self.jitter = float(jitter)
+        self.first = float(first)
+
+        self.failures = 0
+        self.total_failures = 0
+        self.last_failure = None
+        self.last_delay = 0
+        # the delay before jitter, grown on each failure rather than
+        # recomputed, so it can't overflow however long we fail for
+        self.base = 0
+
+    def delay(self):
+        """Record a failure and return how long to wait before retrying."""
+        self.failures += 1
+        self.total_failures += 1
+        self.last_failure = time.time()
+
+        if self.failures == 1:
+            self.base = self.first
+        elif self.failures == 2:
+            self.base = min(self.cap, self.initial)
+        else:
+            self.base = min(self.cap, self.base * self.factor)
+
+        self.last_delay = self.base * (1 - self.jitter * random.random())
+        return self.last_delay
+
+    def reset(self):
+        """Record a success."""
+        self.failures = 0
+        self.last_delay = 0
+        self.base = 0
@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+#               OpenCenter(TM) is Copyright 2013 by Rackspace US, Inc.
+##############################################################################
+#
+# OpenCenter is licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.  This
+# version of OpenCenter includes Rackspace trademarks and logos, and in
+# accordance with Section 6 of the License, the provision of commercial
+# support services in conjunction with a version of OpenCenter which includes
+# Rackspace trademarks and logos is prohibited.  OpenCenter source code and
+# details are available at: # https://github.com/rcbops/opencenter or upon
+# written request.
+#
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0 and a copy, including this
+# notice, is available in the LICENSE file accompanying this software.
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the # specific language governing permissions and limitations
+# under the License.
+#
+##############################################################################
+#
+#
+
+import logging
+import threading
+import urlparse
+
+LOG = logging.getLogger('opencenter.endpoints')
+
+
+def _client_endpoint(url):
+    from opencenterclient.client import OpenCenterEndpoint
+    return OpenCenterEndpoint(url)
+
+
+class EndpointPool(object):
+    """Shared OpenCenterEndpoint objects, one per URL.
+
+    Setting up an endpoint costs a connection and a round trip, and
+    each endpoint keeps its own HTTP connections alive, so everything
+    in the agent talking to the same server should share one rather
+    than building its own.  get() is safe to call from any thread; an
+    endpoint is only ever created once per URL, even when several
+    threads ask for it at the same time.
+
+    If an endpoint goes bad, invalidate() it and the next get() makes
+    a new one.
+    """
+
+    def __init__(self, factory=_client_endpoint):
+        self.factory = factory
+        self.lock = threading.Lock()
+        self.endpoints = {}
+        self.creating = {}
+        self.hosts = {}
+
+    def _host(self, url):
+        # no credentials in the stats
+        parsed = urlparse.urlparse(url)
+        host = parsed.hostname or url
+        if parsed.port:
+            host = '%s:%d' % (host, parsed.port)
+        return host
+
+    def _count(self, url, counter):
+        # call with self.lock held
+        stats = self.hosts.setdefault(self._host(url),
+                                      {'created': 0, 'reused': 0,
+                                       'failed': 0, 'invalidated': 0})
+        stats[counter] += 1
+
+    def get(self, url):
+        self.lock.acquire()
+        try:
+            if url in self.endpoints:
+                self._count(url, 'reused')
+                return self.endpoints[url]
+            create_lock = self.creating.setdefault(url, threading.Lock())
+        finally:
+            self.lock.release()
+
+        # one thread connects, anyone else asking for the same url
+        # waits for it rather than connecting too
+        create_lock.acquire()
+        try:
+            self.lock.acquire()
+            endpoint = self.endpoints.get(url)
+            if endpoint is not None:
+                self._count(url, 'reused')
+            self.lock.release()
+            if endpoint is not None:
+                return endpoint
+
+            try:
+                endpoint = self.factory(url)
+            except:
+                self.lock.acquire()
+                self._count(url, 'failed')
+                self.lock.release()
+                raise
+
+            self.lock.acquire()
+            self.endpoints[url] = endpoint
+            self._count(url, 'created')
+            self.lock.release()
+            LOG.debug('Connected to endpoint on %s' % self._host(url))
+            return endpoint
+        finally:
+            create_lock.release()
+
+    def invalidate(self, url, endpoint=None):
+        """Forget the endpoint for url.
+
+        If endpoint is given, only forget it if it's still the current
+        one, so a stale error doesn't throw away a fresh endpoint.
+        """
+        self.lock.acquire()
+        try:
+            current = self.endpoints.get(url)
+            if current is None:
+                return
+            if endpoint is not None and endpoint is not current:
+                return
+            del self.endpoints[url]
+            self._count(url, 'invalidated')
+        finally:
+            self.lock.release()
+
+    def stats(self):
+        self.lock.acquire()
+        try:
+            stats = {}
+            for host, counters in self.hosts.items():
+                stats[host] = dict(counters)
+                stats[host]['open'] = len(
+                    [url for url in self.endpoints
+                     if self._host(url) == host])
+            return stats
+        finally:
+            self.lock.release()
+
+
+# the pool the agent and its plugins share
+pool = EndpointPool()
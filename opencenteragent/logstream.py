@@ -0,0 +1,479 @@
+#!/usr/bin/env python
+#               OpenCenter(TM) is Copyright 2013 by Rackspace US, Inc.
+##############################################################################
+#
+# OpenCenter is licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.  This
+# version of OpenCenter includes Rackspace trademarks and logos, and in
+# accordance with Section 6 of the License, the provision of commercial
+# support services in conjunction with a version of OpenCenter which includes
+# Rackspace trademarks and logos is prohibited.  OpenCenter source code and
+# details are available at: # https://github.com/rcbops/opencenter or upon
+# written request.
+#
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0 and a copy, including this
+# notice, is available in the LICENSE file accompanying this software.
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the # specific language governing permissions and limitations
+# under the License.
+#
+##############################################################################
+#
+#
+
+
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import select
+import socket
+import struct
+import threading
+import time
+
+from opencenteragent import utils
+
+LOG = logging.getLogger('opencenter.logstream')
+
+IN_MODIFY = 0x00000002
+IN_CLOEXEC = 0o2000000
+IN_NONBLOCK = 0o4000
+
+_EVENT = struct.Struct('iIII')
+
+# largest single sendfile() / send() per stream per pass, so one busy
+# stream can't starve the rest
+CHUNK = 65536
+
+_HANGUP = select.POLLHUP | select.POLLERR | select.POLLNVAL
+_AGAIN = (errno.EAGAIN, errno.EWOULDBLOCK)
+
+
+class Inotify(object):
+    """Just enough of inotify(7) to hear about file writes.
+
+    Python 2 has no inotify binding, so this goes straight to libc.
+    Raises OSError if inotify isn't available.
+    """
+
+    _libc = None
+
+    def __init__(self):
+        libc = Inotify._load()
+        self.libc = libc
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            self._raise()
+
+    @classmethod
+    def _load(cls):
+        if cls._libc is None:
+            try:
+                libc = ctypes.CDLL(ctypes.util.find_library('c'),
+                                   use_errno=True)
+                libc.inotify_init1
+                libc.inotify_add_watch
+                libc.inotify_rm_watch
+            except (OSError, AttributeError, TypeError):
+                raise OSError(errno.ENOSYS, 'inotify not available')
+            cls._libc = libc
+        return cls._libc
+
+    def _raise(self):
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err))
+
+    def fileno(self):
+        return self.fd
+
+    def add_watch(self, path, mask=IN_MODIFY):
+        wd = self.libc.inotify_add_watch(self.fd, path, mask)
+        if wd < 0:
+            self._raise()
+        return wd
+
+    def rm_watch(self, wd):
+        # fails harmlessly if the file (and so the watch) is gone
+        self.libc.inotify_rm_watch(self.fd, wd)
+
+    def read(self):
+        """Return the watch descriptors with pending events."""
+        wds = set()
+        while True:
+            try:
+                buf = os.read(self.fd, 65536)
+            except OSError as e:
+                if e.errno in (errno.EAGAIN, errno.EINTR):
+                    return wds
+                raise
+
+            offset = 0
+            while offset + _EVENT.size <= len(buf):
+                wd, mask, cookie, length = _EVENT.unpack_from(buf, offset)
+                wds.add(wd)
+                offset += _EVENT.size + length
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+
+class _Stream(object):
+    def __init__(self, fd, sock, timeout):
+        self.fd = fd
+        self.sock = sock
+        self.timeout = timeout
+        self.offset = fd.tell()
+        self.size = self.offset
+        self.sent = 0
+        self.wd = None
+        self.use_sendfile = utils.sendfile is not None
+        self.writing = False
+        self.last_active = time.time()
+
+    @property
+    def follow(self):
+        return self.timeout != 0
+
+    def behind(self):
+        return self.offset < self.size
+
+    def expired(self, now):
+        return now - self.last_active >= self.timeout
+
+    def refresh(self):
+        try:
+            self.size = os.fstat(self.fd.fileno()).st_size
+        except OSError:
+            pass
+
+    def close(self):
+        self.fd.close()
+        try:
+            # This will fail if the socket isn't open
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except:
+            pass
+        self.sock.close()
+
+
+class LogStreamer(object):
+    """Ships transaction logs to remote sockets on a single thread.
+
+    Each stream is an open file, positioned at the first byte to send,
+    and a connected socket.  The streamer owns both from then on: it
+    sends the file up to EOF without blocking, using sendfile() where
+    it can, then either closes the stream (logfile.tail, timeout 0) or
+    keeps following the file until timeout seconds pass with no new
+    data (logfile.watch).  Streams also end when the remote end hangs
+    up.
+
+    Growth of followed files is picked up through inotify, or by
+    checking file sizes every poll_interval seconds where inotify
+    isn't available.  Sockets are multiplexed with poll(), so there's
+    no select() limit on the number of streams.
+    """
+
+    def __init__(self, poll_interval=1, use_inotify=True):
+        self.poll_interval = poll_interval
+        self.use_inotify = use_inotify
+        self.inotify = None
+
+        self.lock = threading.Lock()
+        self.thread = None
+        self.running = False
+        self.pending = []
+        self.streams = {}
+        self.wds = {}
+        self.poller = None
+        self.wake_r = self.wake_w = None
+
+        self.opened = 0
+        self.closed = 0
+        self.failed = 0
+        self.bytes_sent = 0
+
+    def add(self, fd, sock, timeout=0):
+        """Stream fd to sock.
+
+        With a timeout, keep following fd until timeout seconds pass
+        without new data.
+        """
+        self.lock.acquire()
+        try:
+            self.pending.append(_Stream(fd, sock, timeout))
+            self.opened += 1
+            if self.thread is None:
+                self._start()
+        finally:
+            self.lock.release()
+        self._wakeup()
+
+    def count(self):
+        self.lock.acquire()
+        try:
+            return len(self.streams) + len(self.pending)
+        finally:
+            self.lock.release()
+
+    def stats(self):
+        self.lock.acquire()
+        try:
+            streams = self.streams.values()
+            return {'active': len(streams) + len(self.pending),
+                    'following': len([s for s in streams if s.follow]),
+                    'opened': self.opened,
+                    'closed': self.closed,
+                    'failed': self.failed,
+                    'bytes_sent': self.bytes_sent,
+                    'inotify': self.inotify is not None}
+        finally:
+            self.lock.release()
+
+    def stop(self, timeout=5):
+        self.lock.acquire()
+        thread = self.thread
+        self.running = False
+        self.lock.release()
+
+        if thread is not None:
+            self._wakeup()
+            thread.join(timeout)
+
+    def _start(self):
+        self.poller = select.poll()
+
+        if self.use_inotify:
+            try:
+                self.inotify = Inotify()
+            except OSError as e:
+                LOG.warning('inotify unavailable (%s), polling logs '
+                            'every %s seconds' % (e, self.poll_interval))
+            else:
+                self.poller.register(self.inotify, select.POLLIN)
+
+        self.wake_r, self.wake_w = os.pipe()
+        self.poller.register(self.wake_r, select.POLLIN)
+
+        self.running = True
+        self.thread = threading.Thread(target=self._run,
+                                       name='logstream')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _wakeup(self):
+        try:
+            os.write(self.wake_w, 'x')
+        except (OSError, TypeError):
+            pass
+
+    def _register(self, stream):
+        stream.sock.setblocking(0)
+        self.poller.register(stream.sock, select.POLLIN)
+
+        if stream.follow and self.inotify is not None:
+            try:
+                stream.wd = self.inotify.add_watch(stream.fd.name)
+            except OSError as e:
+                LOG.warning('cannot watch %s: %s' % (stream.fd.name, e))
+            else:
+                self.wds.setdefault(stream.wd, []).append(stream)
+
+        stream.refresh()
+        self._update(stream)
+
+    def _update(self, stream):
+        # only ask for POLLOUT while there's something to send
+        writing = stream.behind()
+        if writing != stream.writing:
+            mask = select.POLLIN
+            if writing:
+                mask |= select.POLLOUT
+            self.poller.modify(stream.sock, mask)
+            stream.writing = writing
+
+    def _remove(self, stream, failed=False):
+        fileno = stream.sock.fileno()
+        if self.streams.get(fileno) is not stream:
+            return
+
+        self.poller.unregister(fileno)
+
+        if stream.wd is not None:
+            peers = self.wds.get(stream.wd, [])
+            if stream in peers:
+                peers.remove(stream)
+            if not peers:
+                self.wds.pop(stream.wd, None)
+                self.inotify.rm_watch(stream.wd)
+
+        LOG.debug('closing stream of %s after %d bytes%s' %
+                  (stream.fd.name, stream.sent,
+                   failed and ' (remote end gone)' or ''))
+        stream.close()
+
+        self.lock.acquire()
+        del self.streams[fileno]
+        self.closed += 1
+        if failed:
+            self.failed += 1
+        self.lock.release()
+
+    def _send(self, stream):
+        """Send as much as the socket will take without blocking.
+
+        :returns: False if the remote end has gone away
+        """
+        sent = 0
+        try:
+            while stream.behind():
+                count = min(CHUNK, stream.size - stream.offset)
+                try:
+                    if stream.use_sendfile:
+                        n = utils.sendfile(stream.sock.fileno(),
+                                           stream.fd.fileno(),
+                                           stream.offset, count)
+                    else:
+                        stream.fd.seek(stream.offset, os.SEEK_SET)
+                        n = stream.sock.send(stream.fd.read(count))
+                except (OSError, IOError, socket.error) as e:
+                    if e.errno in _AGAIN:
+                        break
+                    if e.errno == errno.EINTR:
+                        continue
+                    if e.errno in (errno.EINVAL, errno.ENOSYS) and \
+                            stream.use_sendfile and stream.sent == 0:
+                        # file or socket type sendfile can't handle
+                        stream.use_sendfile = False
+                        continue
+                    return False
+                except Exception as e:
+                    # don't let a broken stream take the thread down
+                    LOG.warning('error streaming %s: %s' %
+                                (stream.fd.name, e))
+                    return False
+
+                if n == 0:
+                    if stream.use_sendfile:
+                        # file shrank under us; nothing more to send
+                        stream.size = stream.offset
+                        break
+                    return False
+
+                stream.offset += n
+                stream.sent += n
+                sent += n
+        finally:
+            if sent:
+                stream.last_active = time.time()
+                self.lock.acquire()
+                self.bytes_sent += sent
+                self.lock.release()
+
+        return True
+
+    def _hung_up(self, stream):
+        # the remote end never sends us anything, so a readable socket
+        # means it has hung up (or is about to)
+        try:
+            return stream.sock.recv(4096) == ''
+        except socket.error as e:
+            return e.errno not in _AGAIN
+
+    def _wait_time(self, now):
+        wait = None
+        for stream in self.streams.values():
+            if stream.behind() or not stream.follow:
+                continue
+
+            expiry = max(0, stream.last_active + stream.timeout - now)
+            if stream.wd is None:
+                expiry = min(expiry, self.poll_interval)
+            if wait is None or expiry < wait:
+                wait = expiry
+
+        if wait is None:
+            return None
+        # poll() wants milliseconds
+        return int(wait * 1000) + 1
+
+    def _run(self):
+        while True:
+            self.lock.acquire()
+            running = self.running
+            if running:
+                pending, self.pending = self.pending, []
+                for stream in pending:
+                    self.streams[stream.sock.fileno()] = stream
+            self.lock.release()
+
+            if not running:
+                break
+
+            for stream in pending:
+                self._register(stream)
+
+            try:
+                events = self.poller.poll(self._wait_time(time.time()))
+            except select.error as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+
+            for fileno, mask in events:
+                if fileno == self.wake_r:
+                    os.read(self.wake_r, 4096)
+                elif self.inotify is not None and \
+                        fileno == self.inotify.fileno():
+                    for wd in self.inotify.read():
+                        for stream in self.wds.get(wd, []):
+                            stream.refresh()
+                elif fileno in self.streams:
+                    stream = self.streams[fileno]
+                    if mask & _HANGUP or \
+                            (mask & select.POLLIN and self._hung_up(stream)):
+                        self._remove(stream, failed=stream.behind())
+                    elif mask & select.POLLOUT:
+                        if not self._send(stream):
+                            self._remove(stream, failed=True)
+
+            now = time.time()
+            for stream in self.streams.values():
+                if stream.follow and stream.wd is None:
+                    stream.refresh()
+
+                if stream.behind():
+                    self._update(stream)
+                elif not stream.follow or stream.expired(now):
+                    self._remove(stream)
+                else:
+                    self._update(stream)
+
+        self._shutdown()
+
+    def _shutdown(self):
+        self.lock.acquire()
+        pending, self.pending = self.pending, []
+        self.thread = None
+        self.lock.release()
+
+        for stream in self.streams.values():
+            self._remove(stream)
+        for stream in pending:
+            stream.close()
+
+        if self.inotify is not None:
+            self.inotify.close()
+            self.inotify = None
+
+        os.close(self.wake_r)
+        os.close(self.wake_w)
+        self.wake_r = self.wake_w = None
+        self.poller = None
@@ -26,11 +26,15 @@
 
 import os
 import logging
+import threading
 
 import manager
 
 LOG = logging.getLogger('opencenter.input')
 
+# plugin health states, best first
+HEALTH_STATES = ['ok', 'degraded', 'down']
+
 # Input modules export a number of functions and attributes:
 #
 # name = <string>
@@ -38,10 +42,15 @@ LOG = logging.getLogger('opencenter.input')
 # teardown()                    # optional
 # fetch(blocking=False)         # blocking optional (see below)
 # result(transaction, result)   # optional
+# pending()                     # optional
+# health()                      # optional
 #
 # the "name" attribute is an optional "friendly name" for
 # logging purposes.  Default name is derived from file name.
 #
+# input modules can use endpoints.get(url) from their namespace to
+# get a shared opencenter endpoint, rather than creating their own.
+#
 # The "setup" function performs whatever initialization is required
 # for the module, including such things as background threads
 # if necessary for the input module.  Once the setup function is
@@ -80,17 +89,62 @@ LOG = logging.getLogger('opencenter.input')
 # performing a blocking fetch, then, the plugin MAY NOT return an
 # empty dict, but must block until a new dict is ready to be consumed.
 #
+# The optional "pending" function returns the number of inputs the
+# plugin has queued up, for reporting in InputManager.stats().
+#
+# The optional "health" function returns a dict describing the
+# plugin's connection to its input source.  It must contain a
+# "state" key of "ok", "degraded" (trouble, but retrying) or "down",
+# and may carry any other jsonable detail.  InputManager.health()
+# reports the worst state of all plugins.
+#
+# When several input plugins are loaded they are polled round-robin.
+# A plugin's share of dispatches may be set with "fetch_weight"
+# (default 1) in its config section, and plugins with a higher
+# "fetch_priority" (default 0) are always polled first.
+#
 # The optional "result" function receives the original output dict, as
 # well as a "result" dict (as returned from the output plugin).  If
 # the plugin has a need to update status, it can do so.
 #
+# The optional "unclaim" function receives input the plugin handed
+# out but that was never dispatched (the agent is shutting down).
+# The plugin should return it to its source, so it isn't lost or left
+# marked as in progress.
+#
+# The manager injects a "notify_ready()" function into each input
+# plugin namespace.  Plugins that gather input in the background
+# should call it whenever new input becomes available.  The dispatch
+# loop sleeps in wait() while all plugins are empty, and is woken by
+# notify_ready() rather than having to poll.  Plugins that never call
+# it still work, but are only polled every few seconds while idle.
+#
 
 
 class InputManager(manager.Manager):
     def __init__(self, path, config={}):
         super(InputManager, self).__init__(path, config=config)
+        self.input_ready = threading.Event()
+        self.schedule = {}
         self.load(path)
 
+    def _extend_namespace(self, name, ns):
+        ns['notify_ready'] = self.notify_ready
+
+    def notify_ready(self):
+        self.input_ready.set()
+
+    def wait(self, timeout=None):
+        """Wait for an input plugin to signal new input.
+
+        :param: timeout: maximum number of seconds to wait, or None to
+                         wait until a plugin calls notify_ready()
+
+        :returns: True if a plugin signalled new input
+        """
+        self.input_ready.wait(timeout)
+        return self.input_ready.is_set()
+
     def result(self, result):
         input_data = result['input']
         output_data = result['output']
@@ -100,21 +154,128 @@ class InputManager(manager.Manager):
             LOG.debug('sending result outcome to plugin "%s"' % plugin)
             self.plugins[plugin]['result'](input_data, output_data)
 
+    def unclaim(self, result):
+        """Hand input that was never dispatched back to its plugin.
+
+        :returns: True if the plugin took it back
+        """
+        plugin = result['plugin']
+
+        if 'unclaim' in self.plugins[plugin]:
+            LOG.debug('returning undispatched input to plugin "%s"' %
+                      plugin)
+            self.plugins[plugin]['unclaim'](result['input'])
+            return True
+        return False
+
+    def _schedule(self, name):
+        # per-plugin scheduling state and counters, created on first use
+        if name not in self.schedule:
+            config = self.config.get(name, {})
+            self.schedule[name] = {
+                'weight': max(1, int(config.get('fetch_weight', 1))),
+                'priority': int(config.get('fetch_priority', 0)),
+                'current': 0,
+                'fetched': 0,
+                'served': 0}
+        return self.schedule[name]
+
+    def stats(self):
+        """Per-plugin fetch counters.
+
+        "fetched" counts fetch() calls on the plugin, "served" the ones
+        that returned input, and "waiting" the plugin backlog if the
+        plugin exports a pending() function.
+        """
+        stats = {}
+        for name, ns in self.plugins.items():
+            if 'fetch' not in ns:
+                continue
+
+            entry = self._schedule(name)
+            stats[name] = {'weight': entry['weight'],
+                           'priority': entry['priority'],
+                           'fetched': entry['fetched'],
+                           'served': entry['served'],
+                           'waiting': None}
+            if 'pending' in ns:
+                try:
+                    stats[name]['waiting'] = ns['pending']()
+                except Exception:
+                    LOG.exception('pending() failed in plugin "%s"' % name)
+        return stats
+
+    def health(self):
+        """Health of the input plugins that export a health() function.
+
+        :returns: dict with the worst "state" of any plugin, and the
+                  per-plugin health dicts under "plugins"
+        """
+        state = 'ok'
+        plugins = {}
+        for name, ns in self.plugins.items():
+            if 'health' not in ns:
+                continue
+
+            try:
+                health = ns['health']()
+            except Exception as e:
+                LOG.exception('health() failed in plugin "%s"' % name)
+                health = {'state': 'down', 'error': str(e)}
+
+            if not health.get('state') in HEALTH_STATES:
+                health['state'] = 'down'
+
+            plugins[name] = health
+            if (HEALTH_STATES.index(health['state']) >
+                    HEALTH_STATES.index(state)):
+                state = health['state']
+
+        return {'state': state, 'plugins': plugins}
+
     def fetch(self):
-        # walk through all the different input managers and fetch the
-        # next input message.
-        #
-        # there is a possibility of starvation here if one plugin manages
-        # to get much more input than the other.  Probably could order the
-        # plugins by last valid response or something to keep one plugin
-        # from monopolizing the input queue.  In fact, FIXME
+        # walk through the input plugins and fetch the next input
+        # message.  Plugins with a higher fetch_priority are always
+        # polled first.  Within a priority class plugins are polled in
+        # smooth weighted round-robin order (as nginx balances
+        # upstreams), so a chatty plugin gets at most its fetch_weight
+        # share of dispatches and can't starve the others.
         #
-        for input_plugin in self.plugins:
-            if 'fetch' in self.plugins[input_plugin]:
-                fetch_result = self.plugins[input_plugin]['fetch']()
+        # clear the ready flag before polling: anything that arrives
+        # after a plugin has been polled sets it again, so a following
+        # wait() returns immediately rather than missing the input.
+        self.input_ready.clear()
+
+        classes = {}
+        for name in self.plugins:
+            if 'fetch' in self.plugins[name]:
+                entry = self._schedule(name)
+                classes.setdefault(entry['priority'], []).append(name)
+
+        for priority in sorted(classes.keys(), reverse=True):
+            names = classes[priority]
+
+            for name in names:
+                self.schedule[name]['current'] += self.schedule[name]['weight']
+
+            # plugins found empty give back the credit they were
+            # just handed, so an idle plugin can't bank credit and
+            # then monopolize the dispatcher when input turns up.
+            credited = sum([self.schedule[n]['weight'] for n in names])
+
+            for name in sorted(names,
+                               key=lambda n: -self.schedule[n]['current']):
+                entry = self.schedule[name]
+                entry['fetched'] += 1
+                fetch_result = self.plugins[name]['fetch']()
                 if len(fetch_result):
-                    return {"plugin": self.plugins[input_plugin]['name'],
+                    entry['served'] += 1
+                    entry['current'] -= credited
+                    return {"plugin": self.plugins[name]['name'],
                             "input": fetch_result}
 
+                entry['current'] -= entry['weight']
+                credited -= entry['weight']
+
         # otherwise, nothing
         return {}
@@ -29,6 +29,8 @@ import os
 
 from functools import partial
 
+from opencenteragent import endpoints
+
 
 # Parent class for the input and output managers
 
@@ -59,7 +61,8 @@ class Manager(object):
         # we can't really load this into the existing namespace --
         # we'll have registration collisions.
         ns = {'global_config': self.config,
-              'LOG': LOG}
+              'LOG': LOG,
+              'endpoints': endpoints.pool}
         LOG.debug('Loading output plugin file %s' % shortpath)
         execfile(path, ns)
 
@@ -74,6 +77,7 @@ class Manager(object):
         ns['LOG'] = logging.getLogger('%s.%s' % (ns['LOG'],
                                                  'output_%s' % name))
         ns['register_action'] = partial(self.register_action, name, shortpath)
+        self._extend_namespace(name, ns)
 
         self.loaded_modules.append(name)
         self.plugins[name] = ns
@@ -84,6 +88,11 @@ class Manager(object):
         else:
             LOG.warning('No setup function in %s. Ignoring.' % shortpath)
 
+    def _extend_namespace(self, name, ns):
+        # hook for subclasses to inject extra helpers into a plugin
+        # namespace before the plugin setup function is called
+        pass
+
     def register_action(self, plugin, action, method,
                         constraints=[],
                         consequences=[],
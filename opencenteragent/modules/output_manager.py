@@ -28,10 +28,16 @@ import os
 import logging
 import socket
 import select
-import time
+import sys
+import threading
+from collections import OrderedDict
 from functools import partial
 
 import manager
+from opencenteragent import task_context
+from opencenteragent.logstream import LogStreamer
+from opencenteragent.translog import TransactionLogs
+from opencenteragent.utils import digest
 
 LOG = logging.getLogger('opencenter.output')
 
@@ -53,7 +59,9 @@ LOG = logging.getLogger('opencenter.output')
 # LOG - a python logging handler
 # global_config - the global config hash
 # module_config - the configuration for the module
+# endpoints - the shared opencenter endpoints: endpoints.get(url)
 # register_action()
+# PRIORITY_BATCH, PRIORITY_INTERACTIVE - see below
 #
 # after registering an action, any incoming data sent to
 # a specific action will be sent to the registered dispatch
@@ -67,6 +75,40 @@ LOG = logging.getLogger('opencenter.output')
 #
 # The payload is arbitrary, and is specific to the action.
 #
+# register_action() also takes some optional scheduling hints:
+#
+# concurrency - the maximum number of instances of the action that
+#               may run at once (0, the default, is unlimited)
+# exclusive   - a list of exclusion group names, for example
+#               ["package-manager"].  Only one action holding a given
+#               group runs at a time.
+# priority    - how urgent the action is.  Queued tasks are dispatched
+#               highest priority first, unless their payload carries
+#               a "priority" of its own, and input plugins that queue
+#               tasks (the taskerator) fetch them in the same order.
+#               Use PRIORITY_INTERACTIVE for quick actions an
+#               operator is waiting on, PRIORITY_BATCH for long
+#               running work, and leave the default for the rest.
+#
+# A "max_concurrency" value in the plugin's config section caps how
+# many actions from the plugin run at once.  Tasks that would break a
+# limit are held back until a conflicting task finishes, while
+# unrelated actions keep running in parallel.
+#
+# If an action is registered with a "timeout" (in seconds), dispatch
+# gives up on it once the timeout expires and returns a result_code
+# of 124.  The action is cancelled through its task context, which
+# kills any child processes it started through the bash script
+# runner.  Actions registered without a timeout are advertised with
+# the default of 30 seconds but are not cut off.
+#
+# The "modules.actions" action returns the action table along with
+# its "digest".  If the payload carries the digest of a table the
+# caller already has as "since", only the difference is returned,
+# as a "delta" (see actions_delta()), or "unchanged": True if there
+# is none.  If the old table is no longer known the full table is
+# returned as usual.
+#
 # The dispatch handler should processes the message, and return
 # a python dict in the following format:
 #
@@ -87,21 +129,134 @@ def _fail(code=1, message='unknown failure', data={}):
     return _ok(code, message, data)
 
 
-def _xfer_to_eof(fd_in, sock_out):
-    while True:
-        bytes_read = fd_in.read(1024)
-        if len(bytes_read) == 0:
-            # fd_in EOF.
+DEFAULT_TIMEOUT = 30
+
+# action priorities.  any integer will do; higher goes first.
+PRIORITY_BATCH = -10
+PRIORITY_NORMAL = 0
+PRIORITY_INTERACTIVE = 10
+
+# same as timeout(1)
+TIMEOUT_RESULT_CODE = 124
+
+# how many old action tables to keep around for deltas
+ACTION_HISTORY = 8
+
+
+def actions_delta(old, new):
+    """Compact difference between two action tables.
+
+    :returns: dict of "changed" (action -> new details, for new or
+              changed actions) and "removed" (list of action names)
+    """
+    changed = {}
+    for action, details in new.items():
+        if old.get(action) != details:
+            changed[action] = details
+
+    removed = [action for action in old if action not in new]
+    return {'changed': changed, 'removed': sorted(removed)}
+
+
+def apply_actions_delta(old, delta):
+    """Rebuild a new action table from an old one and a delta."""
+    new = dict((action, details) for action, details in old.items()
+               if action not in delta['removed'])
+    new.update(delta['changed'])
+    return new
+
+
+class ActionLimiter(object):
+    """Tracks running actions against concurrency limits.
+
+    An action is admitted when its per-action limit, its plugin limit
+    and all of its exclusion groups have room.  Release listeners are
+    called (without the limiter lock held) whenever an action
+    finishes, so a scheduler can retry work it had to hold back.
+    """
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.actions = {}
+        self.plugins = {}
+        self.groups = {}
+        self.listeners = []
+
+    def _admissible(self, action, plugin, limit, plugin_limit, groups):
+        if limit and self.actions.get(action, 0) >= limit:
+            return False
+        if plugin_limit and self.plugins.get(plugin, 0) >= plugin_limit:
+            return False
+        for group in groups:
+            if self.groups.get(group, 0) > 0:
+                return False
+        return True
+
+    def _hold(self, action, plugin, groups):
+        self.actions[action] = self.actions.get(action, 0) + 1
+        self.plugins[plugin] = self.plugins.get(plugin, 0) + 1
+        for group in groups:
+            self.groups[group] = self.groups.get(group, 0) + 1
+
+    def acquire(self, action, plugin, limit=0, plugin_limit=0, groups=[],
+                blocking=True):
+        with self.condition:
+            while not self._admissible(action, plugin, limit,
+                                       plugin_limit, groups):
+                if not blocking:
+                    return False
+                self.condition.wait()
+
+            self._hold(action, plugin, groups)
             return True
 
+    def release(self, action, plugin, groups=[]):
+        with self.condition:
+            for counts, key in [(self.actions, action),
+                                (self.plugins, plugin)] + \
+                    [(self.groups, group) for group in groups]:
+                counts[key] -= 1
+                if counts[key] == 0:
+                    del counts[key]
+            self.condition.notify_all()
+            listeners = list(self.listeners)
+
+        for listener in listeners:
+            listener()
+
+    def stats(self):
+        with self.condition:
+            return {'actions': dict(self.actions),
+                    'plugins': dict(self.plugins),
+                    'groups': dict(self.groups)}
+
+
+class ActionThread(threading.Thread):
+    """Runs a single action so the dispatcher can stop waiting on it."""
+
+    def __init__(self, fn, input_data, context, finish):
+        super(ActionThread, self).__init__()
+        self.fn = fn
+        self.input_data = input_data
+        self.context = context
+        self.finish = finish
+        self.result = None
+        self.exc_info = None
+
+    def run(self):
+        task_context.activate(self.context)
         try:
-            bytes_sent = sock_out.send(bytes_read)
-        except:
-            return False
+            self.result = self.fn(self.input_data)
+        except Exception:
+            self.exc_info = sys.exc_info()
+        finally:
+            task_context.deactivate()
+            self.finish()
 
-        if bytes_sent == 0:
-            # remote socket shut down
-            return False
+    def outcome(self):
+        if self.exc_info is not None:
+            raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+        return self.result
 
 
 class OutputManager(manager.Manager):
@@ -110,26 +265,43 @@ class OutputManager(manager.Manager):
 
         # should all actions be named module.action?
         self.dispatch_table = {}
+        self.limiter = ActionLimiter()
+        self.translog = TransactionLogs()
+        self.log_streamer = LogStreamer()
+        # digest -> recently published action tables, for deltas
+        self.action_history = OrderedDict()
+        self.action_history_lock = threading.Lock()
         self.register_action('modules', 'modules', 'logfile.tail',
-                             self.handle_logfile)
+                             self.handle_logfile,
+                             priority=PRIORITY_INTERACTIVE)
         self.register_action('modules', 'modules', 'logfile.watch',
-                             self.handle_logfile)
+                             self.handle_logfile,
+                             priority=PRIORITY_INTERACTIVE)
         self.register_action('modules', 'modules', 'modules.list',
-                             self.handle_modules)
+                             self.handle_modules,
+                             priority=PRIORITY_INTERACTIVE)
         self.register_action('modules', 'modules', 'modules.load',
-                             self.handle_modules)
+                             self.handle_modules,
+                             priority=PRIORITY_INTERACTIVE)
         self.register_action('modules', 'modules', 'modules.actions',
-                             self.handle_modules)
+                             self.handle_modules,
+                             priority=PRIORITY_INTERACTIVE)
         self.register_action('modules', 'modules', 'modules.reload',
-                             self.handle_modules)
+                             self.handle_modules,
+                             priority=PRIORITY_INTERACTIVE)
 
         self.load(path)
 
         LOG.debug('Dispatch methods: %s' % self.dispatch_table.keys())
 
+    def stop(self):
+        self.log_streamer.stop()
+        return super(OutputManager, self).stop()
+
     def register_action(self, plugin, shortpath, action, method,
                         constraints=[], consequences=[], args={},
-                        timeout=30):
+                        timeout=None, concurrency=0, exclusive=[],
+                        priority=PRIORITY_NORMAL):
         LOG.debug('Registering handler for action %s' % action)
         # First handler wins
         if action in self.dispatch_table:
@@ -145,7 +317,10 @@ class OutputManager(manager.Manager):
                                            'constraints': constraints,
                                            'consequences': consequences,
                                            'arguments': args,
-                                           'timeout': timeout}
+                                           'timeout': timeout,
+                                           'concurrency': concurrency,
+                                           'exclusive': list(exclusive),
+                                           'priority': priority}
 
     def actions(self):
         d = {}
@@ -154,10 +329,103 @@ class OutputManager(manager.Manager):
                          'constraints': params['constraints'],
                          'consequences': params['consequences'],
                          'args': params['arguments'],
-                         'timeout': params['timeout']}
+                         'timeout': params['timeout'],
+                         'priority': params['priority']}
+            if params['timeout'] is None:
+                d[action]['timeout'] = DEFAULT_TIMEOUT
         return d
 
-    def dispatch(self, input_data):
+    def priority(self, input_data):
+        """How urgent a task is: the "priority" in its payload, or
+        else the priority its action was registered with.
+        """
+        payload = input_data.get('payload') or {}
+        try:
+            return int(payload['priority'])
+        except (KeyError, TypeError, ValueError):
+            pass
+
+        action = input_data.get('action')
+        if action in self.dispatch_table:
+            return self.dispatch_table[action]['priority']
+        return PRIORITY_NORMAL
+
+    def actions_digest(self):
+        """Stable digest of actions(), to tell whether it changed."""
+        return digest(self.actions())
+
+    def _remember_actions(self, actions, actions_digest, since=None):
+        # record the current table, and return the one the caller
+        # last saw (if we still have it)
+        with self.action_history_lock:
+            old = self.action_history.get(since)
+            self.action_history.pop(actions_digest, None)
+            self.action_history[actions_digest] = actions
+            while len(self.action_history) > ACTION_HISTORY:
+                self.action_history.popitem(last=False)
+        return old
+
+    def _extend_namespace(self, name, ns):
+        # log to the transaction log of whichever task is calling
+        ns['LOG'] = task_context.TaskLogger(ns['LOG'])
+        ns['PRIORITY_BATCH'] = PRIORITY_BATCH
+        ns['PRIORITY_INTERACTIVE'] = PRIORITY_INTERACTIVE
+
+    def _limits(self, action):
+        params = self.dispatch_table[action]
+        plugin = params['plugin']
+        plugin_limit = int(self.config.get(plugin, {}).get(
+            'max_concurrency', 0))
+        return (action, plugin, params['concurrency'], plugin_limit,
+                params['exclusive'])
+
+    def reserve(self, input_data):
+        """Try to claim a concurrency slot for a task without blocking.
+
+        A successful reservation must be handed to dispatch() with
+        reserved=True, which releases it when the action completes.
+
+        :param: input_data: the task as passed to dispatch()
+
+        :returns: False if the task conflicts with running actions
+        """
+        action = input_data.get('action')
+        if action not in self.dispatch_table:
+            return True
+
+        action, plugin, limit, plugin_limit, groups = self._limits(action)
+        return self.limiter.acquire(action, plugin, limit, plugin_limit,
+                                    groups, blocking=False)
+
+    def add_release_listener(self, listener):
+        self.limiter.listeners.append(listener)
+
+    def _call(self, fn, input_data, context, finish):
+        timeout = context.timeout
+        if not timeout:
+            task_context.activate(context)
+            try:
+                return fn(input_data)
+            finally:
+                task_context.deactivate()
+                finish()
+
+        thread = ActionThread(fn, input_data, context, finish)
+        thread.setDaemon(True)
+        thread.start()
+        thread.join(timeout)
+
+        if thread.isAlive():
+            LOG.warning('Action %s (task %s) timed out after %s seconds' %
+                        (input_data['action'], input_data.get('id'),
+                         timeout))
+            context.cancel()
+            return _fail(code=TIMEOUT_RESULT_CODE,
+                         message='timed out after %s seconds' % timeout)
+
+        return thread.outcome()
+
+    def dispatch(self, input_data, reserved=False):
         # look at the dispatch table for matching actions
         # and dispatch them in order to the registered
         # handlers.
@@ -180,36 +448,39 @@ class OutputManager(manager.Manager):
             LOG.debug('Plugin_manager: dispatching action %s from plugin %s' %
                       (action, plugin))
             LOG.debug('Received input_data %s' % (input_data))
-            base = self.config['main'].get('trans_log_dir',
-                                           '/var/log/opencenter')
-
-            if not os.path.isdir(base):
-                raise OSError(2, 'Specified path "%s" ' % (base) +
-                              'does not exist or is not a directory.')
-
-            if not os.access(base, os.W_OK):
-                raise OSError(13,
-                              'Specified path "%s" is not writable.' %
-                              base)
-
-            # we won't log from built-in functions
-            ns = None
-            if plugin in self.plugins:
-                ns = self.plugins[plugin]
-                t_LOG = ns['LOG']
-                if 'id' in input_data:
-                    ns['LOG'] = logging.getLogger(
-                        'opencenter.output.trans_%s' % input_data['id'])
-                    h = logging.FileHandler(
-                        os.path.join(base,
-                                     'trans_%s.log' % input_data['id']), 'w')
-                    ns['LOG'].addHandler(h)
-
-            # FIXME(rp): handle exceptions
-            result = fn(input_data)
-
-            if ns is not None:
-                ns['LOG'] = t_LOG
+
+            # wait for any conflicting actions to finish
+            action, plugin, limit, plugin_limit, groups = \
+                self._limits(action)
+            if not reserved:
+                self.limiter.acquire(action, plugin, limit, plugin_limit,
+                                     groups)
+
+            context = task_context.TaskContext(input_data.get('id'), action,
+                                               params['timeout'])
+
+            def finish():
+                # runs once the action has actually returned, which
+                # may be well after a timed out dispatch gave up on it
+                if context.logger is not None:
+                    self.translog.close(context.logger)
+
+                self.limiter.release(action, plugin, groups)
+
+            try:
+                base = self.config['main'].get('trans_log_dir',
+                                               '/var/log/opencenter')
+                self.translog.validate(base)
+
+                # we won't log from built-in functions
+                if plugin in self.plugins and 'id' in input_data:
+                    context.logger = self.translog.open(base,
+                                                        input_data['id'])
+            except:
+                finish()
+                raise
+
+            result = self._call(fn, input_data, context, finish)
 
             LOG.debug('Got result %s' % result)
         else:
@@ -242,13 +513,13 @@ class OutputManager(manager.Manager):
                          'dest_ip and dest_port')
 
         base = self.config['main'].get('trans_log_dir', '/var/log/opencenter')
-        log_path = os.path.join(base, 'trans_%s.log' % payload['task_id'])
+        log_path = self.translog.path(base, payload['task_id'])
 
         if not os.path.exists(log_path):
             return _fail(message='no such transaction log file')
 
         data = ''
-        fd = open(log_path, 'r')
+        fd = open(log_path, 'rb')
 
         try:
             position = payload['offset']['position']
@@ -275,52 +546,24 @@ class OutputManager(manager.Manager):
                 sock.connect((payload['dest_ip'],
                               int(payload['dest_port'])))
             except socket.error as e:
-                fd.close()
-                sock.close()
                 return _fail(message='%s' % str(e))
 
-            result = _xfer_to_eof(fd, sock)
-            if timeout == 0:
-                fd.close()
-                sock.shutdown(socket.SHUT_RDWR)
-                sock.close()
-
-            if result is False:
-                return _fail(code=1, message='remote socket disconnect')
-
-            if timeout == 0:
-                return _ok()
-
-            # we're polling to end of file.  Socket and fd are open,
-            # fd is at EOF.  Wait for file size to change
-            pos = fd.tell()
-            remaining_timeout = timeout
-
-            while remaining_timeout > 0:
-                time.sleep(1)
-                remaining_timeout -= 1
-
-                # would be nice to be able to detect remote socket
-                # disconnected.  Sadly this doesn't seem trivially
-                # doable.
-                fd.seek(0, os.SEEK_END)
-                if fd.tell() != pos:
-                    # new data in file
-                    fd.seek(pos, os.SEEK_SET)
-                    result = _xfer_to_eof(fd, sock)
-                    if not result:
-                        return _fail(message='remote socket disconnect')
-
-                    pos = fd.tell()
-                    remaining_timeout = timeout
+            # the log streamer owns the fd and socket from here on.
+            # it ships the file to EOF, and with a timeout keeps
+            # following it until it's quiet for that long.
+            self.log_streamer.add(fd, sock, timeout)
+            fd = sock = None
 
         finally:
-            try:
-                # This will fail if the socket isn't open
-                sock.shutdown(socket.SHUT_RDWR)
-            except:
-                pass
-            sock.close()
+            if fd is not None:
+                fd.close()
+            if sock is not None:
+                try:
+                    # This will fail if the socket isn't open
+                    sock.shutdown(socket.SHUT_RDWR)
+                except:
+                    pass
+                sock.close()
 
         return _ok()
 
@@ -332,8 +575,21 @@ class OutputManager(manager.Manager):
             return _ok(data={'name': 'opencenter_agent_output_modules',
                              'value': self.loaded_modules})
         elif action == 'modules.actions':
-            return _ok(data={'name': 'opencenter_agent_actions',
-                             'value': self.actions()})
+            actions = self.actions()
+            actions_digest = digest(actions)
+            since = (payload or {}).get('since')
+            old = self._remember_actions(actions, actions_digest, since)
+
+            data = {'name': 'opencenter_agent_actions',
+                    'digest': actions_digest}
+            if since == actions_digest:
+                data['unchanged'] = True
+            elif old is not None:
+                data['since'] = since
+                data['delta'] = actions_delta(old, actions)
+            else:
+                data['value'] = actions
+            return _ok(data=data)
         elif action == 'modules.load':
             if not payload:
                 return _fail(message='no payload specified')
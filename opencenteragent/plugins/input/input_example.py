@@ -23,99 +23,213 @@
 #
 ##############################################################################
 #
+#
 
 import BaseHTTPServer
+import SocketServer
+import collections
 import threading
 import json
-import urllib
 
 producer_lock = threading.Lock()
-producer_queue = []
-server_quit = False
+producer_queue = collections.deque()
 server_thread = None
 name = "example"
 
+# defaults for the [restish] config section
+DEFAULT_BIND_ADDRESS = '0.0.0.0'
+DEFAULT_BIND_PORT = 8000
+# largest request body we'll read, in bytes
+DEFAULT_MAX_REQUEST_SIZE = 1024 * 1024
+# submissions waiting for dispatch before we answer 503
+DEFAULT_MAX_QUEUE = 1024
+# clients being served at once
+DEFAULT_MAX_CONNECTIONS = 64
+# seconds an idle keep-alive connection is held open
+DEFAULT_KEEPALIVE_TIMEOUT = 30
+
 
 class RestishHandler(BaseHTTPServer.BaseHTTPRequestHandler):
-    # these will be
+    # HTTP/1.1 keeps connections open between requests, so every
+    # response must carry a Content-Length
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        self.timeout = self.server.keepalive_timeout
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+
+    def _respond(self, code, body=None, headers={}):
+        data = ''
+        if body is not None:
+            data = json.dumps(body)
+
+        self.send_response(code)
+        self.send_header('Content-type', 'application/json')
+        self.send_header('Content-length', str(len(data)))
+        for header, value in headers.items():
+            self.send_header(header, value)
+        if self.close_connection:
+            self.send_header('Connection', 'close')
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _read_body(self, required):
+        # returns (body, error code).  without a length we'd have to
+        # read to EOF, which doesn't work with keep-alive.
+        payload_len = self.headers.getheader('content-length')
+        if payload_len is None:
+            if not required:
+                return '', None
+            self.close_connection = 1
+            return None, 411
+
+        try:
+            payload_len = int(payload_len)
+        except ValueError:
+            self.close_connection = 1
+            return None, 400
+
+        if payload_len > self.server.max_request_size:
+            # the body is left unread, so this connection is done
+            self.close_connection = 1
+            return None, 413
+
+        return self.rfile.read(payload_len), None
+
     def do_POST(self):
         action = self.path.split("/")[1]
         retval = {'action': action, 'id': id(action)}
 
-        if self.headers.getheader('content-type') == 'application/json':
-            payload_len = self.headers.getheader('content-length')
+        # the body is always read, even if we don't want it, so the
+        # connection can be reused
+        is_json = self.headers.getheader('content-type') == \
+            'application/json'
+        body, error = self._read_body(is_json)
+        if error is not None:
+            self._respond(error)
+            return
 
-            # FIXME: Danger, timeout vs. memory.
+        if is_json:
             try:
-                if payload_len:
-                    retval['payload'] = json.loads(self.rfile.read(
-                        int(payload_len)))
-                else:
-                    retval['payload'] = json.load(self.rfile)
+                retval['payload'] = json.loads(body)
             except ValueError:
-                self.send_response(500)
-                self.send_header('Content-type', 'text/html')
-                self.end_headers()
+                self._respond(400)
                 return
 
         producer_lock.acquire()
-        producer_queue.append(retval)
-
-        # should use a pthread_cond here
+        queued = len(producer_queue) < self.server.max_queue
+        if queued:
+            producer_queue.append(retval)
         producer_lock.release()
 
-        self.send_response(200)
-        self.send_header("Content-type", "text/html")
-        self.end_headers()
+        if not queued:
+            # let the client back off rather than queueing without
+            # bound
+            self._respond(503, headers={'Retry-After': '1'})
+            return
+
+        notify_ready()
+        self._respond(200)
 
     def do_GET(self):
         # Maybe this is status?
-        pass
+        self._respond(200, {'pending': pending()})
+
+    def log_message(self, format, *args):
+        LOG.debug('%s - %s' % (self.address_string(), format % args))
+
+
+class RestishServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """HTTP server handling each connection in its own thread.
+
+    At most max_connections clients are served at once; beyond that
+    new connections get a 503 straight away.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, handler, max_request_size=None,
+                 max_queue=None, max_connections=None,
+                 keepalive_timeout=None):
+        self.max_request_size = max_request_size or DEFAULT_MAX_REQUEST_SIZE
+        self.max_queue = max_queue or DEFAULT_MAX_QUEUE
+        self.keepalive_timeout = keepalive_timeout or \
+            DEFAULT_KEEPALIVE_TIMEOUT
+        self.connections = threading.BoundedSemaphore(
+            max_connections or DEFAULT_MAX_CONNECTIONS)
+        BaseHTTPServer.HTTPServer.__init__(self, address, handler)
+
+    def process_request(self, request, client_address):
+        if not self.connections.acquire(False):
+            LOG.warning('Too many connections, refusing %s' %
+                        (client_address,))
+            try:
+                request.sendall('HTTP/1.1 503 Service Unavailable\r\n'
+                                'Content-Length: 0\r\n'
+                                'Retry-After: 1\r\n'
+                                'Connection: close\r\n\r\n')
+            except Exception:
+                pass
+            self.shutdown_request(request)
+            return
+
+        SocketServer.ThreadingMixIn.process_request(
+            self, request, client_address)
+
+    def process_request_thread(self, request, client_address):
+        try:
+            SocketServer.ThreadingMixIn.process_request_thread(
+                self, request, client_address)
+        finally:
+            self.connections.release()
 
 
 class ServerThread(threading.Thread):
+    def __init__(self, httpd):
+        super(ServerThread, self).__init__()
+        self.daemon = True
+        self.httpd = httpd
+
     def stop(self):
         LOG.debug("closing underlying server socket")
-        # make a best-effort attempt to kill the underlying server
-        try:
-            LOG.debug('kicking web service')
-            urllib.urlopen('http://%s:%s' % self.httpd.server_address)
-            self.httpd.shutdown()
-            self.httpd.socket.close()
-        except Exception as e:
-            pass
+        self.httpd.shutdown()
+        self.httpd.server_close()
 
     def run(self):
-        global server_quit
-
-        server_class = BaseHTTPServer.HTTPServer
-        self.httpd = server_class(('0.0.0.0', 8000), RestishHandler)
-        while not server_quit:
-            try:
-                self.httpd.handle_request()
-            except Exception as e:
-                LOG.error("Got an exception: %s.  Aborting." % type(e))
-                if server_quit:
-                    return
+        try:
+            self.httpd.serve_forever(poll_interval=0.5)
+        except Exception as e:
+            LOG.error("Got an exception: %s.  Aborting." % type(e))
 
-        LOG.error("Exiting run thread")
+        LOG.debug("Exiting run thread")
 
 
-# Amazing stupid handler.  Throw off a thread
-# and start waiting for stuff...
 def setup(config={}):
     global server_thread
-    LOG.debug('Starting rest-ish server')
-    server_thread = ServerThread()
+
+    # settings live in [restish]; a section named after the plugin
+    # overrides them
+    settings = dict(global_config.get('restish', {}))
+    settings.update(config)
+
+    address = (settings.get('bind_address', DEFAULT_BIND_ADDRESS),
+               int(settings.get('bind_port', DEFAULT_BIND_PORT)))
+
+    LOG.debug('Starting rest-ish server on %s:%s' % address)
+    httpd = RestishServer(
+        address, RestishHandler,
+        max_request_size=int(settings.get('max_request_size', 0)),
+        max_queue=int(settings.get('max_queue', 0)),
+        max_connections=int(settings.get('max_connections', 0)),
+        keepalive_timeout=float(settings.get('keepalive_timeout', 0)))
+    server_thread = ServerThread(httpd)
     server_thread.start()
 
 
 def teardown():
     global server_thread
-    global server_quit
 
     LOG.debug('Shutting down rest-ish server')
-    server_quit = True
     server_thread.stop()
     server_thread.join()
 
@@ -125,13 +239,21 @@ def fetch():
 
     producer_lock.acquire()
     if len(producer_queue) > 0:
-        result = producer_queue.pop()
+        result = producer_queue.popleft()
         LOG.debug('Got input from rest-ish server')
     producer_lock.release()
 
     return result
 
 
+def pending():
+    producer_lock.acquire()
+    count = len(producer_queue)
+    producer_lock.release()
+
+    return count
+
+
 def result(input_data, output_data):
     LOG.debug('Got finish callback for id %s: %s\n' % (input_data['id'],
                                                        output_data))
@@ -32,14 +32,98 @@ import threading
 import time
 from requests import ConnectionError
 
-from opencenterclient.client import OpenCenterEndpoint
+from opencenteragent.backoff import Backoff
+from opencenteragent.publishcache import PublishCache
+from opencenteragent.reporter import ResultReporter
+from opencenteragent.taskqueue import TaskQueue
 
 name = 'taskerator'
 task_getter = None
 
+# consecutive connection failures before we call ourselves down
+DOWN_AFTER = 3
+
+
+class NodeTaskUpdater(threading.Thread):
+    """Keeps our node's task_id in step with the task we're running.
+
+    The node update is a GET and a PUT, so it's done here rather than
+    on the intake or result path.  Only the latest value is written:
+    a task that is claimed and finished before the update goes out
+    costs nothing.
+    """
+
+    def __init__(self, task_thread):
+        super(NodeTaskUpdater, self).__init__()
+        self.task_thread = task_thread
+        self.condition = threading.Condition()
+        self.wanted = None
+        self.written = None
+        self.running = False
+
+    def set(self, task_id):
+        self.condition.acquire()
+        self.wanted = task_id
+        self.condition.notify()
+        self.condition.release()
+
+    def clear(self, task_id):
+        # only if we're still showing that task
+        self.condition.acquire()
+        if self.wanted == task_id:
+            self.wanted = None
+            self.condition.notify()
+        self.condition.release()
+
+    def stop(self):
+        self.condition.acquire()
+        self.running = False
+        self.condition.notify()
+        self.condition.release()
+
+    def run(self):
+        self.running = True
+
+        while True:
+            self.condition.acquire()
+            while self.running and self.wanted == self.written:
+                self.condition.wait()
+            running = self.running
+            task_id = self.wanted
+            self.condition.release()
+
+            if not running:
+                break
+
+            endpoint = self.task_thread.endpoint
+            try:
+                if endpoint is None:
+                    raise ConnectionError('not connected')
+
+                myself = endpoint.nodes[self.task_thread.host_id]
+                myself._request_get()
+                if myself.task_id != task_id:
+                    myself.task_id = task_id
+                    myself.save()
+                self.written = task_id
+            except ConnectionError:
+                # try again once we're connected.  set() and clear()
+                # notify as well, so wait out the whole interval
+                # rather than retrying on every new task.
+                deadline = time.time() + 15
+                self.condition.acquire()
+                while self.running:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+                    self.condition.wait(remaining)
+                self.condition.release()
+
 
 class TaskThread(threading.Thread):
-    def __init__(self, endpoint, name, host_id, hostidfile):
+    def __init__(self, endpoint, name, host_id, hostidfile,
+                 spool_dir=None, aging=30, prefetch=1, backoff=None,
+                 publish_cache=None):
         # python, I hate you.
         super(TaskThread, self).__init__()
 
@@ -48,23 +132,44 @@ class TaskThread(threading.Thread):
         self.name = name
         self.producer_lock = threading.Lock()
         self.producer_condition = threading.Condition(self.producer_lock)
-        self.pending_tasks = []
-        self.running_tasks = {}
+        # claimed, pending and running tasks.  guarded by producer_lock
+        self.tasks = TaskQueue(aging=aging)
+        # action -> priority, from the output modules' action list
+        self.priorities = {}
+        # how many tasks we may claim ahead of the dispatch pool
+        self.prefetch = max(1, prefetch)
+        self.node_updater = NodeTaskUpdater(self)
+        self.node_updater.setDaemon(True)
+        self.reporter = ResultReporter(self._send_result,
+                                       spool_dir=spool_dir,
+                                       retry_on=(ConnectionError,))
         self.host_id = host_id
         self.hostidfile = hostidfile
-        self._maybe_init()
+        # what we last published, so unchanged attrs aren't re-sent
+        # every time we (re)connect
+        self.published = PublishCache(publish_cache, host_id)
+
+        # connection state, for health()
+        self.backoff = backoff or Backoff()
+        self.stopping = threading.Event()
+        self.connected = False
+        self.reconnects = 0
+        self.last_error = None
+        self.last_success = None
+
+        try:
+            self._maybe_init()
+        except ConnectionError as e:
+            # run() retries
+            self.last_error = str(e)
 
     def _maybe_init(self):
         if self.endpoint:
             return True
         else:
             LOG.info('Connecting to endpoint')
-            try:
-                self.endpoint = OpenCenterEndpoint(self.endpoint_uri)
-            except ConnectionError:
-                return False
-            except KeyboardInterrupt:
-                raise
+            # connection errors go to the caller, which backs off
+            self.endpoint = endpoints.get(self.endpoint_uri)
 
         if not self.host_id:
             # try to find our host ID from the endpoint
@@ -78,6 +183,7 @@ class TaskThread(threading.Thread):
                 host_id = resp['node_id']
             except KeyError:
                 LOG.error('Unable to get node ID: %s' % resp['message'])
+                self.last_error = resp['message']
                 return False
             reg_file = '.'.join((self.hostidfile, 'registering'))
             dirs = reg_file.rpartition(os.sep)[0]
@@ -93,77 +199,256 @@ class TaskThread(threading.Thread):
                 node = resp['node']
             except KeyError:
                 LOG.error('Unable to get node ID: %s' % resp['message'])
+                self.last_error = resp['message']
                 return False
             if node['id'] == host_id:
                 os.rename(reg_file, self.hostidfile)
                 self.host_id = node['id']
+                self.published.reset(self.host_id)
             else:
                 LOG.error('Node ID mismatch.')
+                self.last_error = 'node id mismatch'
                 return False
 
         # update the module list
+        for action in ['modules.list', 'modules.actions']:
+            task = {'action': action,
+                    'payload': {},
+                    'id': -1}
+            self.producer_lock.acquire()
+            if self.tasks.add(self._key(-1, action), task,
+                              self._priority(task)):
+                self.producer_condition.notify_all()
+                notify_ready()
+                LOG.debug('added %s task to work queue' % action)
+            self.producer_lock.release()
+
+        return True
+
+    def stop(self):
+        self.running = False
+        self.stopping.set()
         self.producer_lock.acquire()
-        task = {'action': 'modules.list',
-                'payload': {},
-                'id': -1}
-        self.pending_tasks.append(task)
-        self.producer_condition.notify()
-        LOG.debug('added module_list task to work queue')
+        self.producer_condition.notify_all()
         self.producer_lock.release()
+
+        self._return_pending()
+        self.endpoint = None
+        self.node_updater.stop()
+        self.reporter.stop()
+
+    def _return_pending(self):
+        # hand tasks we claimed but never started back to the server,
+        # so they don't sit in 'running' until we come back
         self.producer_lock.acquire()
-        task = {'action': 'modules.actions',
-                'payload': {},
-                'id': -1}
-        self.pending_tasks.append(task)
-        self.producer_condition.notify()
-        LOG.debug('added module_list task to work queue')
+        returned = [task for key, task in self.tasks.drain()
+                    if task['id'] > 0]
         self.producer_lock.release()
 
-        return True
+        for task in returned:
+            self._unclaim(task['id'])
 
-    def stop(self):
-        self.endpoint = None
-        self.running = False
+    def unclaim(self, txid, action=None):
+        # a task fetch() handed out that was never dispatched
+        self.producer_lock.acquire()
+        task = self.tasks.finish(self._key(txid, action))
+        self.producer_lock.release()
+
+        if task is not None and txid > 0:
+            self._unclaim(txid)
+
+    def _unclaim(self, task_id):
+        LOG.info('Returning unstarted task %s to the server' % task_id)
+        self.node_updater.clear(task_id)
+        try:
+            task = self.endpoint.tasks[task_id]
+            task._request_get()
+            task.state = 'pending'
+            task.save()
+        except (ConnectionError, AttributeError):
+            LOG.warning('Could not return task %s' % task_id)
+
+    def _key(self, task_id, action):
+        # our own tasks all have id -1, so tell them apart by action
+        if task_id == -1:
+            return 'local:%s' % action
+        return task_id
+
+    def _priority(self, task):
+        # call with producer_lock held.  a priority in the payload
+        # wins, otherwise use the one the action was registered with.
+        payload = task.get('payload') or {}
+        try:
+            return int(payload['priority'])
+        except (KeyError, TypeError, ValueError):
+            return self.priorities.get(task['action'], 0)
+
+    def _claim(self, task):
+        # this should be done on the server side while
+        # locked to avoid races
+        task.state = 'running'
+        task.save()
+
+        # update the node to show we are running this task
+        self.node_updater.set(task.id)
+
+    def _invalidate(self):
+        # the endpoint may be stale (server restarted or moved), so
+        # reconnect with a new one, and have anything else sharing it
+        # get a new one too
+        if self.endpoint is not None:
+            endpoints.invalidate(self.endpoint_uri, self.endpoint)
+            self.endpoint = None
+
+    def _failed(self, error):
+        # back off before trying the server again.  the delays grow
+        # and are jittered, so agents don't all reconnect at once
+        # after a server restart.
+        if isinstance(error, ConnectionError):
+            self._invalidate()
+
+        delay = self.backoff.delay()
+        self.connected = False
+        self.last_error = str(error)
+        LOG.warning('Endpoint unavailable (%s), retrying in %.1f seconds' %
+                    (error, delay))
+        self.stopping.wait(delay)
+
+    def _succeeded(self):
+        if not self.connected:
+            if self.backoff.failures:
+                LOG.info('Reconnected to endpoint after %d failures' %
+                         self.backoff.failures)
+                self.reconnects += 1
+            self.connected = True
+        self.backoff.reset()
+        self.last_success = time.time()
+
+    def health(self):
+        if self.connected:
+            state = 'ok'
+        elif self.backoff.failures < DOWN_AFTER:
+            state = 'degraded'
+        else:
+            state = 'down'
+
+        return {'state': state,
+                'connected': self.connected,
+                'failures': self.backoff.failures,
+                'total_failures': self.backoff.total_failures,
+                'reconnects': self.reconnects,
+                'retry_delay': self.backoff.last_delay,
+                'last_error': self.last_error,
+                'last_success': self.last_success}
+
+    def _capacity(self):
+        # call with producer_lock held
+        return self.prefetch - len(self.tasks.pending) - \
+            len(self.tasks.claiming)
+
+    def _poll(self, count):
+        # with prefetch, pick up everything already waiting for us in
+        # one round trip.  otherwise (or if there's nothing) long-poll
+        # for the next task.
+        if self.prefetch > 1:
+            waiting = self.endpoint.tasks.filter(
+                'node_id = %s and state = "pending"' % self.host_id)
+            waiting = sorted(waiting, key=lambda task: task.id)
+            if waiting:
+                return waiting[:count]
+
+        task = self.endpoint.nodes[self.host_id].task_blocking
+        if task:
+            return [task]
+        return []
 
     def run(self):
         self.running = True
+        self.node_updater.start()
+        self.reporter.start()
 
         while self.running:
-            task = None
+            try:
+                initialised = self._maybe_init()
+            except ConnectionError as e:
+                self._failed(e)
+                continue
 
-            if not self._maybe_init():
-                time.sleep(15)
+            if not initialised:
+                self._failed(self.last_error or 'not registered')
                 continue
 
+            if not self.connected:
+                self._succeeded()
+
+            # don't claim more than the dispatch pool is going to take
+            # off our hands soon.  fetch() wakes us as it frees room.
+            self.producer_lock.acquire()
+            while self.running and self._capacity() <= 0:
+                self.producer_condition.wait(15)
+            count = self._capacity()
+            self.producer_lock.release()
+
+            if not self.running:
+                break
+
             try:
-                task = self.endpoint.nodes[self.host_id].task_blocking
-            except ConnectionError:
-                time.sleep(15)
+                tasks = self._poll(count)
+            except ConnectionError as e:
+                self._failed(e)
+                continue
             except KeyboardInterrupt:
                 raise
 
-            if task:
-                self.producer_lock.acquire()
-                if task.id not in [x['id'] for x in self.pending_tasks]:
-                    LOG.debug('Found new pending task with id %s' % task.id)
+            self._succeeded()
 
-                    # this should be done on the server side while
-                    # locked to avoid races
-                    task.state = 'running'
-                    task.save()
+            for task in tasks:
+                if not self._take(task):
+                    break
 
-                    # update the node to show we are running this task
-                    myself = self.endpoint.nodes[self.host_id]
-                    myself._request_get()
-                    myself.task_id = task['id']
-                    myself.save()
+        self.running = False
 
-                    self.pending_tasks.append(task.to_hash())
-                    self.producer_condition.notify()
-                    LOG.debug('added task to work queue' % task.to_hash())
-                self.producer_lock.release()
+    def _take(self, task):
+        """Claim a task from the server and queue it.
 
-        self.running = False
+        :returns: False if the endpoint went away
+        """
+        self.producer_lock.acquire()
+        new_task = self.tasks.claim(task.id)
+        self.producer_lock.release()
+
+        if not new_task:
+            return True
+
+        LOG.debug('Found new pending task with id %s' % task.id)
+
+        # the claim talks to the server, so fetch() and result()
+        # carry on meanwhile.  the task stays claimed in
+        # self.tasks so we won't pick it up twice.
+        try:
+            self._claim(task)
+        except ConnectionError as e:
+            self.producer_lock.acquire()
+            self.tasks.unclaim(task.id)
+            self.producer_lock.release()
+            self._failed(e)
+            return False
+
+        self.producer_lock.acquire()
+        task = task.to_hash()
+        self.tasks.add(task['id'], task, self._priority(task))
+        running = self.running
+        self.producer_condition.notify_all()
+        self.producer_lock.release()
+
+        if not running:
+            # stop() has already returned what was queued
+            self._return_pending()
+            return False
+
+        notify_ready()
+        LOG.debug('added task %s to work queue' % task['id'])
+        return True
 
     def fetch(self, blocking=True):
         # we'll assume any task we've marked as running
@@ -173,71 +458,117 @@ class TaskThread(threading.Thread):
         LOG.debug("fetching new work item")
         self.producer_lock.acquire()
 
-        while(blocking and len(self.pending_tasks) == 0):
+        while(blocking and len(self.tasks) == 0):
             self.producer_condition.wait()
 
-        if len(self.pending_tasks) > 0:
-            LOG.debug('Found %d queued tasks' % len(self.pending_tasks))
+        if len(self.tasks) > 0:
+            LOG.debug('Found %d queued tasks' % len(self.tasks))
 
-            task = self.pending_tasks.pop()
+            # oldest first.  this also marks it running.
+            key, task = self.tasks.fetch()
             LOG.debug('Preparing to process task: %s' % task)
             retval = {'id': task['id'],
                       'action': task['action'],
                       'payload': task['payload']}
 
-            LOG.debug('Marking task %s as running' % task['id'])
-
-            # throw it into the running list -- I don't know that we really
-            # need this list, but meh.
-            self.running_tasks[retval['id']] = retval
+            # room to prefetch another
+            self.producer_condition.notify_all()
 
         self.producer_lock.release()
         return retval
 
-    def result(self, txid, result):
+    def pending(self):
         self.producer_lock.acquire()
-        if txid in self.running_tasks.keys():
-            try:
-                if txid > 0:
-                    # update the db
-                    task = self.endpoint.tasks[txid]
-                    task._request_get()
-                    task.state = 'done'
-                    task.result = result
-                    task.save()
-                    del self.running_tasks[txid]
-
-                    myself = self.endpoint.nodes[self.host_id]
-                    myself._request_get()
-                    if myself.task_id == task['id']:
-                        myself.task_id = None
-                        myself.save()
-
-                elif txid == -1:
-                    # module list?
-                    if result['result_code'] == 0:
-                        newattr = self.endpoint.attrs.new(
-                            node_id=self.host_id,
-                            key=result['result_data']['name'],
-                            value=result['result_data']['value'])
-                        newattr.save()
+        count = len(self.tasks)
+        self.producer_lock.release()
 
-            except ConnectionError:
-                # FIXME(rp):
-                # we should enqueue the task into a "retry update" list
-                # so we can update it once we get back to a connected
-                # state
-                pass
+        return count
+
+    def stats(self):
+        self.producer_lock.acquire()
+        stats = self.tasks.stats()
+        self.producer_lock.release()
+        stats['published'] = self.published.stats()
+
+        return stats
 
+    def result(self, txid, result, action=None):
+        # results go out from the reporter thread, so a slow or
+        # unreachable endpoint never holds up the dispatch workers
+        self.producer_lock.acquire()
+        task = self.tasks.finish(self._key(txid, action))
         self.producer_lock.release()
 
+        if task is None:
+            return
+
+        if txid > 0:
+            self.reporter.report('task:%s' % txid,
+                                 {'task_id': txid, 'result': result})
+            self.node_updater.clear(txid)
+
+        elif txid == -1:
+            # module list?
+            if result['result_code'] == 0:
+                if result['result_data']['name'] == \
+                        'opencenter_agent_actions':
+                    self._learn_priorities(result['result_data']['value'])
+
+                # only the latest value of an attr matters, and only
+                # if it differs from what the server already has
+                key = result['result_data']['name']
+                value = result['result_data']['value']
+                if self.published.unchanged(key, value):
+                    LOG.debug('attr %s unchanged, not publishing' % key)
+                    return
+
+                self.published.queue(key, value)
+                self.reporter.report('attr:%s' % key,
+                                     {'key': key, 'value': value})
+
+    def _learn_priorities(self, actions):
+        priorities = {}
+        for action, details in actions.items():
+            priorities[action] = details.get('priority', 0)
+
+        self.producer_lock.acquire()
+        self.priorities = priorities
+        self.producer_lock.release()
+
+    def _send_result(self, key, report):
+        # runs on the reporter thread; ConnectionError means retry.
+        # _invalidate() may drop the endpoint meanwhile, so keep our own.
+        endpoint = self.endpoint
+        if endpoint is None:
+            raise ConnectionError('not connected')
+
+        if 'task_id' in report:
+            # update the db
+            task = endpoint.tasks[report['task_id']]
+            task._request_get()
+            task.state = 'done'
+            task.result = report['result']
+            task.save()
+        else:
+            newattr = endpoint.attrs.new(node_id=self.host_id,
+                                         key=report['key'],
+                                         value=report['value'])
+            newattr.save()
+            self.published.record(report['key'], report['value'])
+
 
 class TaskGetter:
-    def __init__(self, endpoint, name, host_id, hostidfile):
+    def __init__(self, endpoint, name, host_id, hostidfile, spool_dir=None,
+                 aging=30, prefetch=1, backoff=None, publish_cache=None):
         self.endpoint = endpoint
         self.name = name
         self.host_id = host_id
         self.hostidfile = hostidfile
+        self.spool_dir = spool_dir
+        self.aging = aging
+        self.prefetch = prefetch
+        self.backoff = backoff
+        self.publish_cache = publish_cache
         self.running = False
         self.server_thread = None
 
@@ -246,7 +577,10 @@ class TaskGetter:
             raise RuntimeError
 
         self.server_thread = TaskThread(self.endpoint, self.name,
-                                        self.host_id, self.hostidfile)
+                                        self.host_id, self.hostidfile,
+                                        self.spool_dir, self.aging,
+                                        self.prefetch, self.backoff,
+                                        self.publish_cache)
         self.server_thread.setDaemon(True)
         self.server_thread.start()
         self.running = True
@@ -258,10 +592,24 @@ class TaskGetter:
         self.server_thread.terminate()
 
     def fetch(self):
-        return self.server_thread.fetch()
+        # never block the dispatch loop: new tasks wake it through
+        # notify_ready() instead.
+        return self.server_thread.fetch(blocking=False)
 
-    def result(self, txid, result):
-        return self.server_thread.result(txid, result)
+    def pending(self):
+        return self.server_thread.pending()
+
+    def stats(self):
+        return self.server_thread.stats()
+
+    def health(self):
+        return self.server_thread.health()
+
+    def result(self, txid, result, action=None):
+        return self.server_thread.result(txid, result, action)
+
+    def unclaim(self, txid, action=None):
+        return self.server_thread.unclaim(txid, action)
 
 
 def setup(config=None):
@@ -282,7 +630,29 @@ def setup(config=None):
     endpoint = global_config.get('endpoints', {}).get(
         'admin', 'http://localhost:8080/admin')
 
-    task_getter = TaskGetter(endpoint, name, host_id, hostidfile)
+    # unsent results are kept here across restarts
+    spool_dir = config.get('result_spool_dir', os.path.join(
+        os.path.dirname(hostidfile), 'results'))
+
+    # queued tasks gain a priority level for every priority_aging
+    # seconds they wait, so batch work isn't starved
+    aging = float(config.get('priority_aging', 30))
+
+    # claim up to this many tasks ahead of the dispatch pool
+    prefetch = int(config.get('prefetch', 1))
+
+    # reconnect delays: a quick first retry, then reconnect_delay
+    # seconds doubling up to reconnect_max
+    backoff = Backoff(initial=float(config.get('reconnect_delay', 1)),
+                      cap=float(config.get('reconnect_max', 120)))
+
+    # digests of the attrs we last published, so a restart only
+    # publishes what changed.  an empty value disables the cache.
+    publish_cache = config.get('publish_cache', os.path.join(
+        os.path.dirname(hostidfile), 'published.json')) or None
+
+    task_getter = TaskGetter(endpoint, name, host_id, hostidfile, spool_dir,
+                             aging, prefetch, backoff, publish_cache)
     task_getter.run()
 
 
@@ -296,9 +666,24 @@ def fetch():
     return task_getter.fetch()
 
 
+def pending():
+    global task_getter
+    return task_getter.pending()
+
+
+def health():
+    global task_getter
+    return task_getter.health()
+
+
 def result(input_data, output_data):
     global task_getter
 
     txid = input_data['id']
     result_hash = output_data
-    return task_getter.result(txid, result_hash)
+    return task_getter.result(txid, result_hash, input_data.get('action'))
+
+
+def unclaim(input_data):
+    global task_getter
+    task_getter.unclaim(input_data['id'], input_data.get('action'))
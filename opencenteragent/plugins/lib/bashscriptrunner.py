@@ -1,7 +1,16 @@
 
-import fcntl
+import ctypes
+import ctypes.util
+import errno
 import os
+import resource
+import select
+import signal
 import string
+import threading
+import time
+
+from opencenteragent import task_context
 
 
 def name_mangle(s, prefix=""):
@@ -41,29 +50,241 @@ def find_script(script, script_path):
     return None
 
 
+# how many malformed records to report back
+MAX_MALFORMED = 10
+
+# seconds between SIGTERM and SIGKILL for a script that overstays
+KILL_GRACE = 5
+
+# same as timeout(1)
+TIMEOUT_RESULT_CODE = 124
+
+
+def _apply_rlimits(rlimits):
+    # runs in the child.  limits can only be lowered, so never ask
+    # for more than the hard limit we have
+    for name, limit in rlimits.items():
+        res = getattr(resource, 'RLIMIT_%s' % name.upper())
+        hard = resource.getrlimit(res)[1]
+        if hard != resource.RLIM_INFINITY:
+            limit = min(limit, hard)
+        resource.setrlimit(res, (limit, limit))
+
+
+def _open_fds():
+    # the descriptors this process has open
+    try:
+        return [int(fd) for fd in os.listdir('/proc/self/fd')]
+    except OSError:
+        return range(os.sysconf('SC_OPEN_MAX'))
+
+
+def _consequence(vtype, key, value):
+    # facts and attrs have convenience functions and may be returned
+    # as key/value pairs.  The format is type\0key\0value\0.
+    # Consequences may be returned directly using a format
+    # consequence\0\0consequence_string\0.
+    if vtype == "consequences":
+        return value
+    return '%s.%s := %s' % (vtype, key, value)
+
+
+class RecordDecoder(object):
+    """Incremental decoder for the records scripts write to fd 3.
+
+    Records are type\\0key\\0value\\0, and may be fed in chunks split
+    anywhere.  Decoding is linear in the size of the input: partial
+    fields are kept as a list of chunks and joined once, when their
+    terminator arrives.
+
+    Records with an unknown type, or facts and attrs without a key,
+    are not returned but counted in "malformed_count", as is whatever
+    is left of an unterminated record when the stream is closed.  The
+    first max_malformed of them are kept in "malformed".
+
+    A record cut short throws the following records out of step.  So
+    a type name in the key or value of a record is taken as the start
+    of the next record, unless the field after the record is a type
+    too.  Such a record is held back until that field arrives.
+    """
+
+    TYPES = ("facts", "attrs", "consequences")
+
+    def __init__(self, max_malformed=MAX_MALFORMED):
+        self.partial = []
+        self.fields = []
+        self.records = 0
+        self.max_malformed = max_malformed
+        self.malformed = []
+        self.malformed_count = 0
+
+    def feed(self, data):
+        """Decode a chunk, returning the (type, key, value) records
+        it completes."""
+        parts = data.split("\0")
+        # the last part is unterminated (empty if data ended on a \0)
+        tail = parts.pop()
+
+        if parts and self.partial:
+            self.partial.append(parts[0])
+            parts[0] = "".join(self.partial)
+            self.partial = []
+        if tail:
+            self.partial.append(tail)
+
+        if self.fields:
+            parts = self.fields + parts
+
+        records = self._decode(parts, False)
+        self.records += len(records)
+        return records
+
+    def close(self):
+        """End of stream, returning any records still held back.  A
+        trailing partial record is malformed."""
+        parts = self.fields
+        if self.partial:
+            parts = parts + ["".join(self.partial)]
+        self.partial = []
+
+        records = self._decode(parts, True)
+        if self.fields:
+            self._malformed(tuple(self.fields))
+        self.fields = []
+
+        self.records += len(records)
+        return records
+
+    def _decode(self, parts, final):
+        # leaves whatever doesn't make a record yet in self.fields
+        records = []
+        i = 0
+        while len(parts) - i >= 3:
+            record = (parts[i], parts[i + 1], parts[i + 2])
+            sync = self._sync(parts, i)
+            if self._valid(record):
+                if sync is None:
+                    records.append(record)
+                    i += 3
+                    continue
+                if i + 3 == len(parts):
+                    if not final:
+                        break
+                    records.append(record)
+                    i += 3
+                    continue
+                if parts[i + 3] in self.TYPES:
+                    records.append(record)
+                    i += 3
+                    continue
+            elif sync is None:
+                sync = i + 3
+
+            # out of step: drop fields up to the next type name
+            self._malformed(tuple(parts[i:sync]))
+            i = sync
+        self.fields = parts[i:]
+        return records
+
+    def _sync(self, parts, i):
+        # where the next record starts, if one starts inside this one
+        for j in (i + 1, i + 2):
+            if parts[j] in self.TYPES:
+                return j
+        return None
+
+    def _malformed(self, record):
+        # a script spewing garbage shouldn't cost unbounded memory
+        self.malformed_count += 1
+        if len(self.malformed) < self.max_malformed:
+            self.malformed.append(record)
+
+    def _valid(self, record):
+        vtype, key, value = record
+        if vtype not in self.TYPES:
+            return False
+        return vtype == "consequences" or key != ""
+
+
+def rlimits_from_config(config):
+    """Script resource limits from a plugin config section.
+
+    Reads rlimit_cpu (seconds), rlimit_as (bytes) and rlimit_nofile,
+    any of which may be left out.
+    """
+    rlimits = {}
+    for name in ['cpu', 'as', 'nofile']:
+        value = config.get('rlimit_%s' % name)
+        if value:
+            rlimits[name] = int(value)
+    return rlimits
+
+
 class BashScriptRunner(object):
-    def __init__(self, script_path=["scripts"], environment=None, log=None):
+    def __init__(self, script_path=["scripts"], environment=None, log=None,
+                 rlimits=None, kill_grace=KILL_GRACE):
         self.script_path = script_path
         self.environment = environment or {"PATH":
                                            "/usr/sbin:/usr/bin:/sbin:/bin"}
         self.log = log
+        self.rlimits = rlimits or {}
+        self.kill_grace = kill_grace
 
-    def run(self, script, *args):
-        return self.run_env(script, {}, "RCB", *args)
+        # the environment every script starts from
+        self.base_env = {"PATH": "/usr/sbin:/usr/bin:/sbin:/bin"}
+        keep_env = ['http_proxy', 'https_proxy', 'no_proxy']
+        for key in set(keep_env).intersection(os.environ):
+            self.base_env[key] = os.environ[key]
+        self.base_env.update(self.environment)
 
-    def run_env(self, script, environment, prefix, *args):
-        env = {"PATH": "/usr/sbin:/usr/bin:/sbin:/bin"}
+        # script name -> path, valid while the script directories
+        # are unchanged
+        self.script_lock = threading.Lock()
+        self.script_index = {}
+        self.script_dirs = None
 
-        keep_env = ['http_proxy', 'https_proxy', 'no_proxy']
+    def _dir_state(self):
+        state = []
+        for path in self.script_path:
+            try:
+                st = os.stat(path)
+                state.append((st.st_ino, st.st_mtime))
+            except OSError:
+                state.append(None)
+        return state
 
-        for key in set(keep_env).intersection(os.environ):
-            env[key] = os.environ[key]
+    def find_script(self, script):
+        """find_script() over script_path, cached.
 
-        env.update(self.environment)
+        Adding, removing or renaming a script changes the mtime of
+        its directory, which throws the cache away.
+        """
+        state = self._dir_state()
+        with self.script_lock:
+            if state != self.script_dirs:
+                self.script_index = {}
+                self.script_dirs = state
+            elif script in self.script_index:
+                return self.script_index[script]
+
+        # misses aren't cached: a script may be added within the
+        # mtime granularity of its directory
+        path = find_script(script, self.script_path)
+        if path is not None:
+            with self.script_lock:
+                if state == self.script_dirs:
+                    self.script_index[script] = path
+        return path
+
+    def run(self, script, *args):
+        return self.run_env(script, {}, "RCB", *args)
+
+    def run_env(self, script, environment, prefix, *args):
+        env = dict(self.base_env)
         env.update(dict([(name_mangle(k, prefix), str(v))
                          for k, v in environment.iteritems()]))
         response = {"response": {}}
-        path = find_script(script, self.script_path)
+        path = self.find_script(script)
 
         if path is None:
             response['result_code'] = 127
@@ -78,14 +299,29 @@ class BashScriptRunner(object):
                   h.stream.fileno() > 2][0].stream.fileno()
         except IndexError:
             fh = 2
+        # the script gets whatever is left of the action's timeout
+        deadline = None
+        context = task_context.current()
+        if context is not None:
+            deadline = context.deadline
+
         #first pass, never use bash to run things
         c = BashExec(to_run,
                      stdout=fh,
                      stderr=fh,
-                     env=env)
+                     env=env,
+                     deadline=deadline,
+                     kill_grace=self.kill_grace,
+                     rlimits=self.rlimits)
         response['result_data'] = {"script": path}
         ret_code, outputs = c.wait()
         response['result_data'].update(outputs)
+        if c.timed_out:
+            response['result_code'] = TIMEOUT_RESULT_CODE
+            response['result_str'] = 'Timed out after %s seconds' % \
+                context.timeout
+            return response
+
         response['result_code'] = ret_code
         # not os.strerror... bash return values are not posix errnos
         response['result_str'] = 'Success' if ret_code == 0 else \
@@ -93,72 +329,334 @@ class BashScriptRunner(object):
         return response
 
 
+def _libc_posix_spawn():
+    # python 2 has no os.posix_spawn.  glibc's posix_spawn starts the
+    # child with vfork semantics, without copying the agent's page
+    # tables and without running any python in the child.
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        fns = dict((name, getattr(libc, name)) for name in [
+            'posix_spawn',
+            'posix_spawn_file_actions_init',
+            'posix_spawn_file_actions_destroy',
+            'posix_spawn_file_actions_adddup2',
+            'posix_spawn_file_actions_addclose',
+            'posix_spawn_file_actions_addopen',
+            'posix_spawnattr_init',
+            'posix_spawnattr_destroy',
+            'posix_spawnattr_setflags'])
+    except (OSError, AttributeError, TypeError):
+        return None
+
+    # glibc 2.34 and later.  otherwise "closefrom" is done with a
+    # close action for each descriptor open now.
+    closefrom = getattr(libc, 'posix_spawn_file_actions_addclosefrom_np',
+                        None)
+    if closefrom is not None:
+        closefrom.argtypes = [ctypes.c_void_p, ctypes.c_int]
+
+    # the opaque posix_spawn types are well under this on any libc
+    opaque_size = 1024
+    fns['posix_spawn'].argtypes = [
+        ctypes.POINTER(ctypes.c_int), ctypes.c_char_p, ctypes.c_void_p,
+        ctypes.c_void_p, ctypes.POINTER(ctypes.c_char_p),
+        ctypes.POINTER(ctypes.c_char_p)]
+    fns['posix_spawn_file_actions_adddup2'].argtypes = [
+        ctypes.c_void_p, ctypes.c_int, ctypes.c_int]
+    fns['posix_spawn_file_actions_addclose'].argtypes = [
+        ctypes.c_void_p, ctypes.c_int]
+    fns['posix_spawn_file_actions_addopen'].argtypes = [
+        ctypes.c_void_p, ctypes.c_int, ctypes.c_char_p, ctypes.c_int,
+        ctypes.c_uint]
+    fns['posix_spawnattr_setflags'].argtypes = [
+        ctypes.c_void_p, ctypes.c_short]
+
+    def check(ret):
+        # these return an errno rather than setting errno
+        if ret != 0:
+            raise OSError(ret, os.strerror(ret))
+
+    def add_action(actions, action):
+        if action[0] != 'closefrom':
+            fn = fns['posix_spawn_file_actions_add%s' % action[0]]
+            check(fn(actions, *action[1:]))
+        elif closefrom is not None:
+            check(closefrom(actions, action[1]))
+        else:
+            # glibc ignores EBADF here, so fds closed meanwhile are fine
+            for fd in _open_fds():
+                if fd >= action[1]:
+                    add_action(actions, ('close', fd))
+
+    def posix_spawn(path, argv, env, file_actions, setsid=False):
+        """Spawn path.  file_actions is a list of ("dup2", fd, newfd),
+        ("close", fd), ("closefrom", lowfd) or ("open", fd, path,
+        flags, mode).  With env None the child gets our environment.
+
+        :returns: the child pid
+        """
+        if env is None:
+            env = os.environ
+
+        actions = ctypes.create_string_buffer(opaque_size)
+        attr = ctypes.create_string_buffer(opaque_size)
+        check(fns['posix_spawn_file_actions_init'](actions))
+        try:
+            check(fns['posix_spawnattr_init'](attr))
+            try:
+                for action in file_actions:
+                    add_action(actions, action)
+                if setsid:
+                    check(fns['posix_spawnattr_setflags'](
+                        attr, POSIX_SPAWN_SETSID))
+
+                c_argv = (ctypes.c_char_p * (len(argv) + 1))(*argv)
+                envp = ['%s=%s' % item for item in env.items()]
+                c_envp = (ctypes.c_char_p * (len(envp) + 1))(*envp)
+                pid = ctypes.c_int()
+                check(fns['posix_spawn'](ctypes.byref(pid), path, actions,
+                                         attr, c_argv, c_envp))
+                return pid.value
+            finally:
+                fns['posix_spawnattr_destroy'](attr)
+        finally:
+            fns['posix_spawn_file_actions_destroy'](actions)
+
+    return posix_spawn
+
+
+# glibc 2.26 and later
+POSIX_SPAWN_SETSID = 0x80
+
+posix_spawn = _libc_posix_spawn()
+
+
 class BashExec(object):
-    def __init__(self, cmd, stdin=None, stdout=None, stderr=None, env=None):
+    """Runs a command with fd 3 open for output records.
+
+    The command runs in a session (and process group) of its own, so
+    everything it starts can be killed along with it.  If the
+    deadline (a time.time() value) passes, or the running task is
+    cancelled, the group gets SIGTERM, then SIGKILL kill_grace
+    seconds later if the command is still running.
+
+    rlimits maps resource names ("cpu", "as", "nofile", ...) to
+    limits applied in the child, see resource.setrlimit.
+
+    The command gets stdin, stdout, stderr and fd 3, and none of the
+    agent's other descriptors.
+
+    The command is started with posix_spawn where possible, which is
+    much cheaper than forking a large, threaded agent.  Commands with
+    rlimits, or not given by path, or on a libc without posix_spawn
+    (or its setsid flag) are forked as before.
+    """
+
+    def __init__(self, cmd, stdin=None, stdout=None, stderr=None, env=None,
+                 deadline=None, kill_grace=KILL_GRACE, rlimits=None,
+                 use_spawn=True):
         self.env = env
+        self.deadline = deadline
+        self.kill_grace = kill_grace
+        self.kill_at = None
+        self.timed_out = False
+        self.spawned = False
         self.pipe_read, self.pipe_write = os.pipe()
-        pid = os.fork()
+
+        try:
+            if use_spawn and posix_spawn is not None and not rlimits and \
+                    os.sep in cmd[0]:
+                try:
+                    pid = self._spawn(cmd, stdin, stdout, stderr, env)
+                    self.spawned = True
+                except OSError:
+                    # EINVAL for an old libc without POSIX_SPAWN_SETSID,
+                    # or the exec failed, which the fork path reports
+                    # the usual way (exit 127)
+                    pid = os.fork()
+            else:
+                pid = os.fork()
+        except:
+            os.close(self.pipe_read)
+            os.close(self.pipe_write)
+            raise
+
         if pid != 0:
             # parent process
             self.child_pid = pid
             os.close(self.pipe_write)
+
+            # kill the script if the task running us is cancelled,
+            # e.g. because the action timed out
+            self.context = task_context.current()
+            if self.context is not None:
+                self.context.on_cancel(self.kill)
         else:
-            # child process
-            os.close(self.pipe_read)
-            if stdin is None:
-                f = open("/dev/null", "r")
-                stdin = f.fileno()
-            os.dup2(stdin, os.sys.stdin.fileno())
-            if stdout is not None:
-                os.dup2(stdout, os.sys.stdout.fileno())
-            if stderr is not None:
-                os.dup2(stderr, os.sys.stderr.fileno())
-            # FD 3 will be for communicating output variables
-            os.dup2(self.pipe_write, 3)
-            os.close(self.pipe_write)
-            os.execvpe(cmd[0], cmd, env)
+            # child process.  never return into the agent, even if
+            # the exec fails.
+            try:
+                os.setsid()
+                _apply_rlimits(rlimits or {})
+                os.close(self.pipe_read)
+                if stdin is None:
+                    f = open("/dev/null", "r")
+                    stdin = f.fileno()
+                os.dup2(stdin, 0)
+                if stdout is not None:
+                    os.dup2(stdout, 1)
+                if stderr is not None:
+                    os.dup2(stderr, 2)
+                # FD 3 will be for communicating output variables
+                os.dup2(self.pipe_write, 3)
+                # nothing else of the agent's is the script's business
+                for fd in _open_fds():
+                    if fd > 3:
+                        try:
+                            os.close(fd)
+                        except OSError:
+                            pass
+                os.execvpe(cmd[0], cmd, env)
+            finally:
+                os._exit(127)
+
+    def _spawn(self, cmd, stdin, stdout, stderr, env):
+        # the same descriptor shuffle as the fork path
+        actions = [('close', self.pipe_read)]
+        if stdin is None:
+            actions.append(('open', 0, '/dev/null', os.O_RDONLY, 0))
+        else:
+            actions.append(('dup2', stdin, 0))
+        if stdout is not None:
+            actions.append(('dup2', stdout, 1))
+        if stderr is not None:
+            actions.append(('dup2', stderr, 2))
+        actions.append(('dup2', self.pipe_write, 3))
+        actions.append(('closefrom', 4))
+
+        return posix_spawn(cmd[0], cmd, env, actions, setsid=True)
+
+    def _signal(self, sig):
+        try:
+            os.killpg(self.child_pid, sig)
+        except OSError:
+            # not in its own group yet
+            try:
+                os.kill(self.child_pid, sig)
+            except OSError:
+                pass
+
+    def kill(self, sig=signal.SIGTERM):
+        # SIGKILL follows from wait() if this isn't enough
+        if self.kill_at is None:
+            self.kill_at = time.time() + self.kill_grace
+        self._signal(sig)
+
+    def _poll_timeout(self, interval):
+        # how long wait() may sleep before checking on the child,
+        # with the deadline and kill escalation due
+        now = time.time()
+        if self.kill_at is not None:
+            if now >= self.kill_at:
+                self._signal(signal.SIGKILL)
+                self.kill_at = now + self.kill_grace
+            return max(0, min(interval, self.kill_at - now))
+
+        if self.deadline is not None:
+            if now >= self.deadline:
+                self.timed_out = True
+                self.kill()
+                return 0
+            return max(0, min(interval, self.deadline - now))
+
+        return interval
 
     def wait(self, output_variables=None):
         if output_variables is None:
             output_variables = []
 
-        # Wait for process to run
-        status_code = os.waitpid(self.child_pid, 0)[1]
-        ret_code = status_code >> 8
+        # read fd 3 while the script runs.  a script with more to say
+        # than fits in the pipe would otherwise block on its write
+        # while we block in waitpid.
+        outputs = {"consequences": []}
+        decoder = RecordDecoder()
 
-        fl = fcntl.fcntl(self.pipe_read, fcntl.F_GETFL)
-        fcntl.fcntl(self.pipe_read, fcntl.F_SETFL, fl | os.O_NONBLOCK)
+        status_code = None
+        pipe_open = True
+        # once fd 3 is closed nothing wakes us when the child exits,
+        # so poll for it, quickly at first
+        interval = 0.001
+        while True:
+            # once the script has exited, only drain what's left: a
+            # background process it started may still hold fd 3 open
+            if status_code is not None:
+                if not pipe_open:
+                    break
+                timeout = 0
+            elif pipe_open:
+                timeout = self._poll_timeout(0.5)
+            else:
+                timeout = self._poll_timeout(interval)
+                interval = min(0.5, interval * 2)
+
+            if pipe_open:
+                fds = [self.pipe_read]
+            else:
+                fds = []
 
-        output_str = ""
-        while(True):
             try:
-                n = os.read(self.pipe_read, 1024)
-            except OSError:  # EWOULDBLOCK/EAGAIN
-                break
+                readable = select.select(fds, [], [], timeout)[0]
+            except select.error as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+
+            if readable:
+                try:
+                    data = os.read(self.pipe_read, 65536)
+                except OSError as e:
+                    if e.errno in (errno.EINTR, errno.EAGAIN):
+                        continue
+                    raise
+
+                if data == "":
+                    pipe_open = False
+                    continue
+                for record in decoder.feed(data):
+                    outputs['consequences'].append(_consequence(*record))
+                continue
 
-            output_str += n
-            if n == "":
+            if status_code is not None:
                 break
 
-        outputs = {"consequences": []}
-        if len(output_str) > 0:
-            stuff = output_str.strip("\0").split("\0")
-            #output is in the form of type\0key\0value\0
-            while(len(stuff) > 0):
-                if len(stuff) % 3 == 0:
-                    # facts and attrs have convenience functions and
-                    # may be returned as key/value pairs.  The format
-                    # is type\0key\0value\0.  Consequences may be
-                    # returned directly using a format
-                    # consequence\0\0consequence_string\0.
-                    vtype, key, value = stuff[0:3]
-                    stuff = stuff[3:]
-                    if vtype == "consequences":
-                        outputs['consequences'].append(value)
-                    else:
-                        c = '%s.%s := %s' % (vtype, key, value)
-                        outputs['consequences'].append(c)
-                else:
-                    break
+            pid, status = os.waitpid(self.child_pid, os.WNOHANG)
+            if pid != 0:
+                status_code = status
+
+        os.close(self.pipe_read)
+
+        if self.kill_at is not None:
+            # whatever the script started goes too
+            try:
+                os.killpg(self.child_pid, signal.SIGKILL)
+            except OSError:
+                pass
+
+        for record in decoder.close():
+            outputs['consequences'].append(_consequence(*record))
+        if decoder.malformed_count:
+            # enough to see what went wrong, without echoing back
+            # megabytes of garbage
+            outputs['malformed'] = [repr(record)[:200] for record in
+                                    decoder.malformed]
+            outputs['malformed_count'] = decoder.malformed_count
+
+        if os.WIFSIGNALED(status_code):
+            # report signals the way bash does
+            ret_code = 128 + os.WTERMSIG(status_code)
+        else:
+            ret_code = os.WEXITSTATUS(status_code)
+
+        if self.context is not None:
+            self.context.remove_cancel(self.kill)
 
         return ret_code, outputs
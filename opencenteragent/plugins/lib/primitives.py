@@ -27,7 +27,7 @@
 import time
 import logging
 
-from opencenterclient.client import OpenCenterEndpoint
+from opencenteragent import endpoints
 from opencenteragent.utils import detailed_exception
 
 from state import StateMachine, StateMachineState
@@ -40,7 +40,7 @@ from opencenter.db import api as db_api
 class OrchestratorTasks:
     def __init__(self, endpoint='http://localhost:8080', logger=None,
                  parent_task_id=None, adventure_globals=None):
-        self.endpoint = OpenCenterEndpoint(endpoint)
+        self.endpoint = endpoints.pool.get(endpoint)
         self.logger = logger
         self.parent_task_id = parent_task_id
 
@@ -32,7 +32,6 @@ import random
 import time
 
 from opencenteragent.utils import detailed_exception
-from opencenterclient.client import OpenCenterEndpoint
 from state import StateMachine, StateMachineState
 from primitives import OrchestratorTasks
 
@@ -61,7 +60,7 @@ def handle_adventurate(input_data):
     adventure_dsl = None
     adventure_id = None
 
-    ep = OpenCenterEndpoint(endpoint)
+    ep = endpoints.get(endpoint)
 
     if 'adventure' in payload:
         adventure_obj = ep.adventures[int(payload['adventure'])]
@@ -28,11 +28,14 @@ import netifaces
 import json
 import urllib2
 
-from bashscriptrunner import BashScriptRunner
+from bashscriptrunner import BashScriptRunner, rlimits_from_config
 import os
 
 name = 'chef'
 
+# chef runs and installs drive the system package manager too
+CHEF_LOCKS = ['chef', 'package-manager']
+
 
 def setup(config={}):
     LOG.debug('Doing setup in plugin_chef.py using bash_path %s' %
@@ -48,7 +51,8 @@ def setup(config={}):
     script_path = [os.path.join(global_config['main']['bash_path'], name)]
     env = {'OPENCENTER_BASH_DIR': global_config['main']['bash_path']}
     script = BashScriptRunner(script_path=script_path, log=LOG,
-                              environment=env)
+                              environment=env,
+                              rlimits=rlimits_from_config(config))
     config['cookbook_channels_manifest_url'] \
         = global_config['chef']['cookbook_channels_manifest_url']
     chef = ChefThing(script, config)
@@ -67,13 +71,19 @@ def setup(config={}):
                              'facts.chef_server_pem'},
          'CHEF_SERVER_HOSTNAME': {'type': 'evaluated',
                                   'expression': 'nodes.{chef_server}.name'}},
-        timeout=300)
-    register_action('run_chef', chef.dispatch, timeout=600)
-    register_action('install_chef_server', chef.dispatch, timeout=600)
-    register_action('uninstall_chef_server', chef.dispatch)
-    register_action('rollback_install_chef_server', chef.dispatch)
-    register_action('get_chef_info', chef.dispatch)
-    register_action('get_cookbook_channels', chef.dispatch)
+        timeout=300, exclusive=CHEF_LOCKS)
+    register_action('run_chef', chef.dispatch, timeout=600,
+                    exclusive=CHEF_LOCKS, priority=PRIORITY_BATCH)
+    register_action('install_chef_server', chef.dispatch, timeout=600,
+                    exclusive=CHEF_LOCKS, priority=PRIORITY_BATCH)
+    register_action('uninstall_chef_server', chef.dispatch,
+                    exclusive=CHEF_LOCKS)
+    register_action('rollback_install_chef_server', chef.dispatch,
+                    exclusive=CHEF_LOCKS)
+    register_action('get_chef_info', chef.dispatch,
+                    priority=PRIORITY_INTERACTIVE)
+    register_action('get_cookbook_channels', chef.dispatch,
+                    priority=PRIORITY_INTERACTIVE)
     register_action(
         'get_latest_channel_version', chef.dispatch, [], [],
         {'channel_name': {'type': 'string',
@@ -83,12 +93,14 @@ def setup(config={}):
         {'CHEF_SERVER_COOKBOOK_CHANNELS': {
             'type': 'evaluated',
             'expression': 'self.facts.chef_server_cookbook_channels'}},
-        timeout=120)
-    register_action('uninstall_chef', chef.dispatch)
-    register_action('rollback_install_chef', chef.dispatch)
+        timeout=120, exclusive=['chef'])
+    register_action('uninstall_chef', chef.dispatch, exclusive=CHEF_LOCKS)
+    register_action('rollback_install_chef', chef.dispatch,
+                    exclusive=CHEF_LOCKS)
     register_action('update_cookbooks', chef.dispatch,
                     [],
-                    ['facts.chef_server_ready := true'])
+                    ['facts.chef_server_ready := true'],
+                    exclusive=['chef'])
     register_action(
         'subscribe_cookbook_channel',
         chef.dispatch,
@@ -31,8 +31,10 @@ name = 'files'
 
 def setup(config={}):
     LOG.debug('doing setup for files handler')
-    register_action('files_list', handle_files)
-    register_action('files_get', handle_files)
+    register_action('files_list', handle_files,
+                    priority=PRIORITY_INTERACTIVE)
+    register_action('files_get', handle_files,
+                    priority=PRIORITY_INTERACTIVE)
 
 
 def handle_files(input_data):
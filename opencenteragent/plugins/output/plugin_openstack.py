@@ -26,7 +26,7 @@
 
 import sys
 import os
-from bashscriptrunner import BashScriptRunner
+from bashscriptrunner import BashScriptRunner, rlimits_from_config
 import json
 name = 'openstack'
 
@@ -39,16 +39,17 @@ def setup(config={}):
     script_path = [os.path.join(global_config['main']['bash_path'], name)]
     env = {"OPENCENTER_BASH_DIR": global_config['main']['bash_path']}
     script = BashScriptRunner(script_path=script_path, log=LOG,
-                              environment=env)
+                              environment=env,
+                              rlimits=rlimits_from_config(config))
     openstack = OpenStackThing(script, config)
     register_action('openstack_upload_images', openstack.dispatch,
-                    timeout=300)
+                    timeout=300, priority=PRIORITY_BATCH)
     register_action('openstack_disable_host', openstack.dispatch,
-                    timeout=30)
+                    timeout=30, priority=PRIORITY_INTERACTIVE)
     register_action('openstack_enable_host', openstack.dispatch,
-                    timeout=30)
+                    timeout=30, priority=PRIORITY_INTERACTIVE)
     register_action('openstack_evacuate_host', openstack.dispatch,
-                    timeout=1200)
+                    timeout=1200, concurrency=1, priority=PRIORITY_BATCH)
 
 
 def get_environment(required, optional, payload):
@@ -30,8 +30,7 @@ import subprocess
 import sys
 import time
 
-from bashscriptrunner import BashScriptRunner
-from opencenterclient.client import OpenCenterEndpoint
+from bashscriptrunner import BashScriptRunner, rlimits_from_config
 
 name = 'packages'
 
@@ -44,11 +43,17 @@ def setup(config={}):
     script_path = [os.path.join(global_config['main']['bash_path'], name)]
     env = {"OPENCENTER_BASH_DIR": global_config['main']['bash_path']}
     script = BashScriptRunner(script_path=script_path, log=LOG,
-                              environment=env)
+                              environment=env,
+                              rlimits=rlimits_from_config(config))
     packages = PackageThing(script, config)
-    register_action('get_updates', packages.dispatch, timeout=300)  # 5 min
-    register_action('do_updates', packages.dispatch, timeout=600)   # 10 min
-    register_action('upgrade_agent', packages.dispatch, timeout=300)  # 5 min
+    # only one apt/yum operation may hold the package database
+    locks = ['package-manager']
+    register_action('get_updates', packages.dispatch, timeout=300,  # 5 min
+                    exclusive=locks)
+    register_action('do_updates', packages.dispatch, timeout=600,   # 10 min
+                    exclusive=locks, priority=PRIORITY_BATCH)
+    register_action('upgrade_agent', packages.dispatch, timeout=300,  # 5 min
+                    exclusive=locks)
 
 
 def get_environment(required, optional, payload):
@@ -95,7 +100,7 @@ class PackageThing(object):
     def _update_task(self, result, input_data):
         task_id = input_data['id']
         endpoint_url = global_config['endpoints']['admin']
-        ep = OpenCenterEndpoint(endpoint_url)
+        ep = endpoints.get(endpoint_url)
         task = ep.tasks[task_id]
         task._request_get()
         task.state = 'done'
@@ -35,9 +35,12 @@ name = 'service'
 def setup(config={}):
     LOG.debug('Setting up service "service"')
 
-    register_action('service_start', service_action)
-    register_action('service_stop', service_action)
-    register_action('service_restart', service_action)
+    register_action('service_start', service_action,
+                    priority=PRIORITY_INTERACTIVE)
+    register_action('service_stop', service_action,
+                    priority=PRIORITY_INTERACTIVE)
+    register_action('service_restart', service_action,
+                    priority=PRIORITY_INTERACTIVE)
 
 
 def service_action(input_data):
@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+#               OpenCenter(TM) is Copyright 2013 by Rackspace US, Inc.
+##############################################################################
+#
+# OpenCenter is licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.  This
+# version of OpenCenter includes Rackspace trademarks and logos, and in
+# accordance with Section 6 of the License, the provision of commercial
+# support services in conjunction with a version of OpenCenter which includes
+# Rackspace trademarks and logos is prohibited.  OpenCenter source code and
+# details are available at: # https://github.com/rcbops/opencenter or upon
+# written request.
+#
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0 and a copy, including this
+# notice, is available in the LICENSE file accompanying this software.
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the # specific language governing permissions and limitations
+# under the License.
+#
+##############################################################################
+#
+#
+#
+
+import json
+import logging
+import os
+import threading
+
+from opencenteragent.utils import digest
+
+LOG = logging.getLogger('opencenter.publishcache')
+
+
+def _host(host_id):
+    # host ids from the host id file are strings, from the server ints
+    if host_id is None:
+        return None
+    return str(host_id).strip()
+
+
+class PublishCache(object):
+    """Remembers what this host last published to the server.
+
+    Keeps a digest of the last value successfully published for each
+    attr, so a restarting agent can skip publishing attrs that haven't
+    changed.  The cache is kept in a json file at path and belongs to
+    one host_id; it's thrown away if the host is re-registered.
+
+    Call queue(key, value) when a value is queued for publishing and
+    record(key, value) once it has been published.  Queueing drops the
+    key from the cache until the latest queued value is recorded, so
+    a value that never made it out (say, it was still in the result
+    spool at shutdown) is never mistaken for a published one.
+    """
+
+    def __init__(self, path, host_id=None):
+        self.path = path
+        self.lock = threading.Lock()
+        self.host_id = _host(host_id)
+        self.digests = {}
+        # key -> digest of the latest queued value, not persisted
+        self.queued = {}
+        self.skipped = 0
+        self._load()
+
+    def _load(self):
+        if self.path is None:
+            return
+
+        try:
+            with open(self.path) as f:
+                cached = json.load(f)
+        except IOError:
+            return
+        except ValueError as e:
+            LOG.warning('Ignoring unreadable publish cache %s: %s' %
+                        (self.path, str(e)))
+            return
+
+        if cached.get('host_id') != self.host_id:
+            LOG.info('Publish cache is for another host, ignoring it')
+            return
+
+        self.digests = cached.get('digests', {})
+
+    def _save(self):
+        # call with the lock held.  write and rename, so a crash never
+        # leaves half a cache
+        if self.path is None:
+            return
+
+        tmp = '%s.tmp' % self.path
+        try:
+            with open(tmp, 'w') as f:
+                json.dump({'host_id': self.host_id,
+                           'digests': self.digests}, f)
+            os.rename(tmp, self.path)
+        except (IOError, OSError) as e:
+            LOG.error('Cannot write publish cache %s: %s' %
+                      (self.path, str(e)))
+
+    def unchanged(self, key, value):
+        """True if value is what was last published for key."""
+        with self.lock:
+            if self.digests.get(key) == digest(value):
+                self.skipped += 1
+                return True
+            return False
+
+    def queue(self, key, value):
+        with self.lock:
+            self.queued[key] = digest(value)
+            if key in self.digests:
+                del self.digests[key]
+                self._save()
+
+    def record(self, key, value):
+        value_digest = digest(value)
+        with self.lock:
+            if self.queued.get(key, value_digest) != value_digest:
+                # a newer value is on its way
+                return
+            self.queued.pop(key, None)
+            self.digests[key] = value_digest
+            self._save()
+
+    def reset(self, host_id):
+        """Start over for a (newly registered) host."""
+        with self.lock:
+            self.host_id = _host(host_id)
+            self.digests = {}
+            self.queued = {}
+            self._save()
+
+    def stats(self):
+        with self.lock:
+            return {'cached': len(self.digests),
+                    'skipped': self.skipped}
@@ -0,0 +1,303 @@
+#!/usr/bin/env python
+#               OpenCenter(TM) is Copyright 2013 by Rackspace US, Inc.
+##############################################################################
+#
+# OpenCenter is licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.  This
+# version of OpenCenter includes Rackspace trademarks and logos, and in
+# accordance with Section 6 of the License, the provision of commercial
+# support services in conjunction with a version of OpenCenter which includes
+# Rackspace trademarks and logos is prohibited.  OpenCenter source code and
+# details are available at: # https://github.com/rcbops/opencenter or upon
+# written request.
+#
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0 and a copy, including this
+# notice, is available in the LICENSE file accompanying this software.
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the # specific language governing permissions and limitations
+# under the License.
+#
+##############################################################################
+#
+#
+
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+from collections import OrderedDict
+
+from opencenteragent.backoff import Backoff
+
+LOG = logging.getLogger('opencenter.reporter')
+
+
+class ResultReporter(object):
+    """Delivers reports to a server from a background thread.
+
+    report(key, data) queues data and returns straight away; a thread
+    calls send(key, data) for each queued report.  Reporting the same
+    key again before it has been sent replaces the queued data, so
+    only the latest state for a key is ever sent.
+
+    If send raises one of retry_on, the report stays at the head of
+    the queue and is retried after a (jittered) delay that doubles
+    from backoff_min up to backoff_max.  Anything else is logged and the
+    report dropped, so one bad report can't wedge the queue.
+
+    With a spool_dir, every report is also written there (atomically,
+    one file per key) until it has been sent, and reports left over
+    from a previous run are picked up on start.  At most queue_size
+    reports are held in memory; beyond that they wait in the spool,
+    or are dropped if there is no spool.
+    """
+
+    def __init__(self, send, spool_dir=None, queue_size=1024,
+                 retry_on=(Exception,), backoff_min=1, backoff_max=300):
+        self.send = send
+        self.spool_dir = spool_dir
+        self.queue_size = queue_size
+        self.retry_on = retry_on
+        self.backoff = Backoff(initial=backoff_min, cap=backoff_max,
+                               first=backoff_min)
+
+        self.condition = threading.Condition()
+        self.queue = OrderedDict()
+        self.spilled = False
+        self.seq = 0
+        self.thread = None
+        self.running = False
+
+        self.sent = 0
+        self.retries = 0
+        self.dropped = 0
+        self.coalesced = 0
+
+        if self.spool_dir is not None and not os.path.isdir(spool_dir):
+            try:
+                os.makedirs(spool_dir)
+            except OSError as e:
+                LOG.error('Cannot create result spool %s (%s), unsent '
+                          'results will not survive a restart' %
+                          (spool_dir, str(e)))
+                self.spool_dir = None
+
+    def start(self):
+        self.condition.acquire()
+        try:
+            if self.thread is not None:
+                return
+            self.running = True
+            self.spilled = True
+            self._unspill()
+            self.thread = threading.Thread(target=self._run,
+                                           name='reporter')
+            self.thread.daemon = True
+            self.thread.start()
+        finally:
+            self.condition.release()
+
+    def stop(self, timeout=5):
+        """Stop sending.  Anything unsent stays in the spool."""
+        self.condition.acquire()
+        thread = self.thread
+        self.running = False
+        self.condition.notify_all()
+        self.condition.release()
+
+        if thread is not None:
+            thread.join(timeout)
+
+    def report(self, key, data):
+        self.condition.acquire()
+        try:
+            self.seq += 1
+            seq = self.seq
+
+            if self.spool_dir is not None:
+                self._spool(key, data, seq)
+
+            if key in self.queue:
+                self.queue[key] = (data, seq)
+                self.coalesced += 1
+            elif len(self.queue) < self.queue_size:
+                self.queue[key] = (data, seq)
+            elif self.spool_dir is not None:
+                # picked up from the spool once the queue drains
+                self.spilled = True
+            else:
+                LOG.error('Result queue full, dropping report %s' % key)
+                self.dropped += 1
+                return
+
+            self.condition.notify_all()
+        finally:
+            self.condition.release()
+
+    def pending(self):
+        self.condition.acquire()
+        try:
+            return len(self.queue)
+        finally:
+            self.condition.release()
+
+    def wait(self, timeout=None):
+        """Wait until everything queued has been sent.
+
+        :returns: True if the queue drained
+        """
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+
+        self.condition.acquire()
+        try:
+            while self.queue or self.spilled:
+                if deadline is None:
+                    self.condition.wait()
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return False
+                    self.condition.wait(remaining)
+            return True
+        finally:
+            self.condition.release()
+
+    def stats(self):
+        self.condition.acquire()
+        try:
+            return {'queued': len(self.queue),
+                    'spilled': self.spilled,
+                    'sent': self.sent,
+                    'retries': self.retries,
+                    'coalesced': self.coalesced,
+                    'dropped': self.dropped}
+        finally:
+            self.condition.release()
+
+    def _spool_path(self, key):
+        name = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        return os.path.join(self.spool_dir, '%s.json' % name)
+
+    def _spool(self, key, data, seq):
+        # write and rename, so a crash never leaves half a report
+        path = self._spool_path(key)
+        tmp = '%s.tmp' % path
+        try:
+            with open(tmp, 'w') as f:
+                json.dump({'key': key, 'data': data, 'seq': seq}, f)
+            os.rename(tmp, path)
+        except (IOError, OSError, TypeError, ValueError) as e:
+            # TypeError / ValueError: data that won't serialise
+            LOG.error('Cannot spool report %s: %s' % (key, str(e)))
+            try:
+                os.unlink(tmp)
+            except OSError:
+                pass
+
+    def _unspool(self, key):
+        try:
+            os.unlink(self._spool_path(key))
+        except OSError:
+            pass
+
+    def _unspill(self):
+        # call with the condition held.  refill the queue from the
+        # spool, oldest first.
+        if self.spool_dir is None:
+            self.spilled = False
+            return
+
+        spooled = []
+        for name in os.listdir(self.spool_dir):
+            if not name.endswith('.json'):
+                continue
+
+            path = os.path.join(self.spool_dir, name)
+            try:
+                with open(path) as f:
+                    entry = json.load(f)
+                spooled.append((os.path.getmtime(path), entry))
+            except (IOError, OSError, ValueError) as e:
+                LOG.error('Discarding unreadable spooled report %s: %s' %
+                          (name, str(e)))
+                try:
+                    os.unlink(path)
+                except OSError:
+                    pass
+
+        spooled.sort(key=lambda x: x[0])
+        self.spilled = False
+        for mtime, entry in spooled:
+            key = entry['key']
+            if key in self.queue:
+                continue
+            if len(self.queue) >= self.queue_size:
+                self.spilled = True
+                break
+
+            self.seq += 1
+            self.queue[key] = (entry['data'], self.seq)
+
+    def _run(self):
+        while True:
+            self.condition.acquire()
+            while self.running and not self.queue:
+                self.condition.wait()
+
+            if not self.running:
+                self.condition.release()
+                break
+
+            key, (data, seq) = self.queue.items()[0]
+            self.condition.release()
+
+            try:
+                self.send(key, data)
+            except self.retry_on as e:
+                delay = self.backoff.delay()
+                LOG.warning('Cannot send report %s (%s), retrying in '
+                            '%.1f seconds' % (key, str(e), delay))
+                # report() notifies too, so wait out the whole delay
+                # rather than retrying whenever something is reported
+                deadline = time.time() + delay
+                self.condition.acquire()
+                self.retries += 1
+                while self.running:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+                    self.condition.wait(remaining)
+                self.condition.release()
+                continue
+            except Exception as e:
+                LOG.exception('Dropping report %s' % key)
+                self.condition.acquire()
+                self.dropped += 1
+            else:
+                self.backoff.reset()
+                self.condition.acquire()
+                self.sent += 1
+
+            # if the key was reported again while we were sending,
+            # the newer data still needs to go out
+            if self.queue.get(key, (None, None))[1] == seq:
+                del self.queue[key]
+                if self.spool_dir is not None:
+                    self._unspool(key)
+            if self.spilled and len(self.queue) < self.queue_size:
+                self._unspill()
+            self.condition.notify_all()
+            self.condition.release()
+
+        self.condition.acquire()
+        self.thread = None
+        self.condition.release()
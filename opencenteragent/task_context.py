@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+#               OpenCenter(TM) is Copyright 2013 by Rackspace US, Inc.
+##############################################################################
+#
+# OpenCenter is licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.  This
+# version of OpenCenter includes Rackspace trademarks and logos, and in
+# accordance with Section 6 of the License, the provision of commercial
+# support services in conjunction with a version of OpenCenter which includes
+# Rackspace trademarks and logos is prohibited.  OpenCenter source code and
+# details are available at: # https://github.com/rcbops/opencenter or upon
+# written request.
+#
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0 and a copy, including this
+# notice, is available in the LICENSE file accompanying this software.
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the # specific language governing permissions and limitations
+# under the License.
+#
+##############################################################################
+#
+#
+
+import logging
+import threading
+import time
+
+# The task context holds per-task state for whichever thread is
+# currently running an action: the task id, the deadline the action
+# has to finish by, the task's transaction logger, and cleanup
+# callbacks to run if the action is cancelled (for example, to kill a
+# child process when the action times out).  Plugin helpers such as
+# the bash script runner look the context up with current() rather
+# than having it passed down.
+#
+# Output plugins get a TaskLogger as their LOG, so log lines from an
+# action land in the transaction log of the task that produced them,
+# even with several tasks from the same plugin running at once.
+# Threads started by an action don't inherit its context and log to
+# the plugin logger.
+
+LOG = logging.getLogger('opencenter.task_context')
+
+_local = threading.local()
+
+
+class TaskContext(object):
+    def __init__(self, task_id=None, action=None, timeout=None,
+                 logger=None):
+        self.task_id = task_id
+        self.action = action
+        self.logger = logger
+        self.timeout = timeout
+        self.deadline = None
+        if timeout:
+            self.deadline = time.time() + timeout
+
+        self.cancelled = False
+        self.lock = threading.Lock()
+        self.cancel_callbacks = []
+
+    def remaining(self):
+        """Seconds left before the deadline, or None if there is none."""
+        if self.deadline is None:
+            return None
+        return max(0, self.deadline - time.time())
+
+    def on_cancel(self, callback):
+        """Register a callback to run if the task is cancelled.
+
+        If the task has already been cancelled the callback runs
+        immediately.
+        """
+        with self.lock:
+            if not self.cancelled:
+                self.cancel_callbacks.append(callback)
+                return
+
+        callback()
+
+    def remove_cancel(self, callback):
+        with self.lock:
+            if callback in self.cancel_callbacks:
+                self.cancel_callbacks.remove(callback)
+
+    def cancel(self):
+        with self.lock:
+            if self.cancelled:
+                return
+            self.cancelled = True
+            callbacks = self.cancel_callbacks
+            self.cancel_callbacks = []
+
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception:
+                LOG.exception('cancel callback failed for task %s' %
+                              self.task_id)
+
+
+class TaskLogger(object):
+    """A logger that follows the task running in the current thread.
+
+    Everything is delegated to the current task's logger if there is
+    one, and to the wrapped logger otherwise.
+    """
+
+    def __init__(self, default):
+        self._default = default
+
+    def _target(self):
+        context = current()
+        if context is not None and context.logger is not None:
+            return context.logger
+        return self._default
+
+    def __getattr__(self, name):
+        return getattr(self._target(), name)
+
+
+def current():
+    """Return the context of the task running in this thread, if any."""
+    return getattr(_local, 'context', None)
+
+
+def activate(context):
+    _local.context = context
+
+
+def deactivate():
+    _local.context = None
@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+#               OpenCenter(TM) is Copyright 2013 by Rackspace US, Inc.
+##############################################################################
+#
+# OpenCenter is licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.  This
+# version of OpenCenter includes Rackspace trademarks and logos, and in
+# accordance with Section 6 of the License, the provision of commercial
+# support services in conjunction with a version of OpenCenter which includes
+# Rackspace trademarks and logos is prohibited.  OpenCenter source code and
+# details are available at: # https://github.com/rcbops/opencenter or upon
+# written request.
+#
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0 and a copy, including this
+# notice, is available in the LICENSE file accompanying this software.
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the # specific language governing permissions and limitations
+# under the License.
+#
+##############################################################################
+#
+#
+
+import time
+
+from collections import OrderedDict
+
+
+class TaskQueue(object):
+    """Tasks an input plugin has taken on, from claim to result.
+
+    A task is claimed while we tell the server we're taking it,
+    pending while it waits to be fetched, and running until its
+    result comes in.  Each task is indexed by a key (normally its
+    task id), so checking whether we already have a task is O(1).
+
+    Pending tasks are fetched highest priority first, oldest first
+    within a priority.  So that low priority work isn't starved, a
+    task's priority rises by one for every aging seconds it waits.
+
+    Not thread safe: callers hold their own lock.
+    """
+
+    def __init__(self, aging=30):
+        self.aging = float(aging)
+        self.claiming = set()
+        # priority -> OrderedDict of key -> (task, queued time)
+        self.classes = {}
+        # key -> priority, for everything pending
+        self.pending = {}
+        self.running = {}
+
+        self.added = 0
+        self.fetched = 0
+        self.finished = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def __contains__(self, key):
+        return key in self.claiming or key in self.pending or \
+            key in self.running
+
+    def __len__(self):
+        return len(self.pending)
+
+    def claim(self, key):
+        """Mark key as being claimed.
+
+        :returns: False if we already have the task
+        """
+        if key in self:
+            return False
+        self.claiming.add(key)
+        return True
+
+    def unclaim(self, key):
+        self.claiming.discard(key)
+
+    def add(self, key, task, priority=0):
+        """Queue a task for fetching.
+
+        :returns: False if the task is already pending or running
+        """
+        self.claiming.discard(key)
+        if key in self.pending or key in self.running:
+            return False
+
+        self.classes.setdefault(priority, OrderedDict())[key] = \
+            (task, time.time())
+        self.pending[key] = priority
+        self.added += 1
+        return True
+
+    def _next(self, now):
+        # the head of each class is its oldest, so it's the only
+        # candidate there.  ties go to the longest waiting.
+        best = None
+        for priority, tasks in self.classes.iteritems():
+            queued = tasks.itervalues().next()[1]
+            rank = (priority + (now - queued) / self.aging, -queued)
+            if best is None or rank > best[0]:
+                best = (rank, priority)
+        return best[1]
+
+    def _pop(self, now):
+        priority = self._next(now)
+        tasks = self.classes[priority]
+        key, (task, queued) = tasks.popitem(last=False)
+        if not tasks:
+            del self.classes[priority]
+        del self.pending[key]
+        return key, task, queued
+
+    def fetch(self):
+        """Move the next pending task to running.
+
+        :returns: (key, task), or None if nothing is pending
+        """
+        if not self.pending:
+            return None
+
+        now = time.time()
+        key, task, queued = self._pop(now)
+        self.running[key] = (task, now)
+
+        wait = now - queued
+        self.fetched += 1
+        self.total_wait += wait
+        self.max_wait = max(self.max_wait, wait)
+        return key, task
+
+    def drain(self):
+        """Remove every pending task, in fetch order.
+
+        :returns: a list of (key, task)
+        """
+        drained = []
+        while self.pending:
+            key, task, queued = self._pop(time.time())
+            drained.append((key, task))
+        return drained
+
+    def finish(self, key):
+        """Forget a running task.
+
+        :returns: the task, or None if it wasn't running
+        """
+        entry = self.running.pop(key, None)
+        if entry is None:
+            return None
+
+        self.finished += 1
+        return entry[0]
+
+    def stats(self):
+        now = time.time()
+        oldest_pending = 0
+        if self.pending:
+            oldest_pending = now - min(
+                [tasks.itervalues().next()[1]
+                 for tasks in self.classes.itervalues()])
+        oldest_running = 0
+        if self.running:
+            oldest_running = now - min([started for task, started
+                                        in self.running.itervalues()])
+
+        mean_wait = 0
+        if self.fetched:
+            mean_wait = self.total_wait / self.fetched
+
+        return {'claiming': len(self.claiming),
+                'pending': len(self.pending),
+                'by_priority': dict([(priority, len(tasks)) for
+                                     priority, tasks in
+                                     self.classes.iteritems()]),
+                'running': len(self.running),
+                'added': self.added,
+                'fetched': self.fetched,
+                'finished': self.finished,
+                'oldest_pending': oldest_pending,
+                'oldest_running': oldest_running,
+                'mean_wait': mean_wait,
+                'max_wait': self.max_wait}
@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+#               OpenCenter(TM) is Copyright 2013 by Rackspace US, Inc.
+##############################################################################
+#
+# OpenCenter is licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.  This
+# version of OpenCenter includes Rackspace trademarks and logos, and in
+# accordance with Section 6 of the License, the provision of commercial
+# support services in conjunction with a version of OpenCenter which includes
+# Rackspace trademarks and logos is prohibited.  OpenCenter source code and
+# details are available at: # https://github.com/rcbops/opencenter or upon
+# written request.
+#
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0 and a copy, including this
+# notice, is available in the LICENSE file accompanying this software.
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the # specific language governing permissions and limitations
+# under the License.
+#
+##############################################################################
+#
+#
+
+import logging
+import os
+import threading
+
+from collections import OrderedDict
+
+LOG = logging.getLogger('opencenter.translog')
+
+
+class TransactionLogs(object):
+    """Per-task transaction logs in the trans_log_dir.
+
+    Each dispatched task gets a trans_<id>.log file and a logger
+    writing to it.  The loggers are not registered with the logging
+    module (which would keep every one of them forever); instead
+    they're tracked here until the task closes them.  At most
+    max_open logs are kept open; past that the oldest is closed, so
+    leaked logs can't exhaust file descriptors.
+
+    The log directory is checked once and the result cached until
+    the configured directory changes or a log file can't be created.
+    """
+
+    def __init__(self, max_open=256):
+        self.max_open = max_open
+        self.lock = threading.Lock()
+        self.validated = None
+        self.open_logs = OrderedDict()
+
+    def path(self, base, task_id):
+        return os.path.join(base, 'trans_%s.log' % task_id)
+
+    def validate(self, base):
+        if self.validated == base:
+            return
+
+        if not os.path.isdir(base):
+            raise OSError(2, 'Specified path "%s" ' % (base) +
+                          'does not exist or is not a directory.')
+
+        if not os.access(base, os.W_OK):
+            raise OSError(13,
+                          'Specified path "%s" is not writable.' %
+                          base)
+
+        self.validated = base
+
+    def open(self, base, task_id):
+        """Create the transaction log for a task.
+
+        :param: base:    the transaction log directory
+        :param: task_id: the id of the task
+
+        :returns: a logger writing to the transaction log
+        """
+        self.validate(base)
+
+        try:
+            handler = logging.FileHandler(self.path(base, task_id), 'w')
+        except IOError:
+            # directory went away or changed permissions under us
+            self.validated = None
+            raise
+
+        logger = logging.Logger('opencenter.output.trans_%s' % task_id)
+        logger.parent = logging.getLogger('opencenter.output')
+        logger.addHandler(handler)
+
+        evicted = []
+        with self.lock:
+            self.open_logs[id(logger)] = logger
+            while len(self.open_logs) > self.max_open:
+                evicted.append(self.open_logs.popitem(last=False)[1])
+
+        for old in evicted:
+            LOG.warning('Too many open transaction logs, closing %s' %
+                        old.name)
+            self._close_handlers(old)
+
+        return logger
+
+    def close(self, logger):
+        with self.lock:
+            self.open_logs.pop(id(logger), None)
+
+        self._close_handlers(logger)
+
+    def open_count(self):
+        with self.lock:
+            return len(self.open_logs)
+
+    def _close_handlers(self, logger):
+        for handler in list(logger.handlers):
+            logger.removeHandler(handler)
+            handler.close()
@@ -25,6 +25,10 @@
 #
 
 import contextlib
+import ctypes
+import ctypes.util
+import hashlib
+import json
 import logging
 import os
 import shutil
@@ -33,6 +37,37 @@ import tempfile
 import traceback
 
 
+def _libc_sendfile():
+    # python 2 has no os.sendfile, but glibc's sendfile64 is easy
+    # enough to call directly.
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        fn = libc.sendfile64
+    except (OSError, AttributeError, TypeError):
+        return None
+
+    fn.argtypes = [ctypes.c_int, ctypes.c_int,
+                   ctypes.POINTER(ctypes.c_int64), ctypes.c_size_t]
+    fn.restype = ctypes.c_ssize_t
+
+    def sendfile(out_fd, in_fd, offset, count):
+        off = ctypes.c_int64(offset)
+        sent = fn(out_fd, in_fd, ctypes.byref(off), count)
+        if sent < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        return sent
+
+    return sendfile
+
+
+# sendfile(out_fd, in_fd, offset, count) copies up to count bytes
+# starting at offset from in_fd to out_fd inside the kernel, and
+# returns the number of bytes copied (0 at EOF).  It is None where
+# neither os.sendfile nor libc sendfile is available.
+sendfile = getattr(os, 'sendfile', None) or _libc_sendfile()
+
+
 def detailed_exception():
     exc_type, exc_value, exc_traceback = sys.exc_info()
     full_traceback = repr(
@@ -42,6 +77,11 @@ def detailed_exception():
     return full_traceback
 
 
+def digest(value):
+    """Stable digest of a jsonable value (dict key order is ignored)."""
+    return hashlib.sha1(json.dumps(value, sort_keys=True)).hexdigest()
+
+
 @contextlib.contextmanager
 def temporary_file():
     try:
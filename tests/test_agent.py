@@ -31,11 +31,15 @@ import os
 import StringIO
 import sys
 import testtools
+import threading
+import time
 import unittest
 
 from opencenteragent import exceptions
 from opencenteragent import OpenCenterAgent
+from opencenteragent import OpenCenterAgentDispatchPool
 from opencenteragent import utils
+from opencenteragent.modules import output_manager
 
 
 # Suppress WARNING logs
@@ -513,5 +517,231 @@ endpoint = butthis""")
         self.assertTrue(self.fork_called)
 
 
+class FakeOutputHandler(object):
+    def __init__(self):
+        self.release = threading.Event()
+
+    def dispatch(self, input_data):
+        self.release.wait(5)
+        return {'result_code': 0,
+                'result_str': 'success',
+                'result_data': input_data['id']}
+
+
+class FakeInputHandler(object):
+    def __init__(self):
+        self.results = []
+        self.unclaimed = []
+        self.done = threading.Event()
+
+    def result(self, data):
+        self.results.append(data)
+        self.done.set()
+
+    def unclaim(self, data):
+        self.unclaimed.append(data)
+        return True
+
+
+class TestDispatchPool(testtools.TestCase):
+    def setUp(self):
+        super(TestDispatchPool, self).setUp()
+        self.input_handler = FakeInputHandler()
+        self.output_handler = FakeOutputHandler()
+        self.pool = OpenCenterAgentDispatchPool(self.input_handler,
+                                                self.output_handler,
+                                                size=2, queue_size=2)
+        self.addCleanup(self.pool.stop)
+        self.addCleanup(self.output_handler.release.set)
+
+    def _task(self, task_id):
+        return {'plugin': 'input',
+                'input': {'id': task_id, 'action': 'test', 'payload': {}}}
+
+    def _wait_for(self, predicate):
+        for _ in range(500):
+            if predicate():
+                return True
+            threading.Event().wait(0.01)
+        return False
+
+    def test_dispatch(self):
+        self.pool.start()
+        self.output_handler.release.set()
+        self.pool.submit(self._task(1))
+        self.assertTrue(self.input_handler.done.wait(5))
+        output = self.input_handler.results[0]['output']
+        self.assertEqual(output['result_data'], 1)
+        self.assertTrue(self._wait_for(
+            lambda: self.pool.stats()['completed'] == 1))
+
+    def test_backpressure(self):
+        self.pool.start()
+        for task_id in range(4):
+            self.pool.submit(self._task(task_id))
+
+        # two tasks running, two waiting: the pool is full
+        self.assertTrue(self._wait_for(
+            lambda: self.pool.stats()['busy'] == 2))
+        stats = self.pool.stats()
+        self.assertEqual(stats['queue_depth'], 2)
+        self.assertEqual(stats['utilisation'], 1.0)
+        self.assertTrue(self.pool.saturated())
+        self.assertFalse(self.pool.wait_for_capacity(timeout=0.05))
+
+        self.output_handler.release.set()
+        self.assertTrue(self._wait_for(
+            lambda: self.pool.stats()['completed'] == 4))
+        self.assertTrue(self.pool.wait_for_capacity(timeout=0.05))
+        self.assertEqual(len(self.input_handler.results), 4)
+
+    def test_conflicting_tasks_held_back(self):
+        class LimitedOutputHandler(FakeOutputHandler):
+            def __init__(self):
+                super(LimitedOutputHandler, self).__init__()
+                self.running = []
+                self.listeners = []
+
+            def add_release_listener(self, listener):
+                self.listeners.append(listener)
+
+            def reserve(self, input_data):
+                # the pool reserves under its lock, so two workers
+                # can't both get the slot
+                if input_data['action'] in self.running:
+                    return False
+                self.running.append(input_data['action'])
+                return True
+
+            def dispatch(self, input_data, reserved=False):
+                try:
+                    return super(LimitedOutputHandler, self).dispatch(
+                        input_data)
+                finally:
+                    self.running.remove(input_data['action'])
+                    for listener in self.listeners:
+                        listener()
+
+        output_handler = LimitedOutputHandler()
+        pool = OpenCenterAgentDispatchPool(self.input_handler,
+                                           output_handler,
+                                           size=2, queue_size=4)
+        self.addCleanup(pool.stop)
+        self.addCleanup(output_handler.release.set)
+        pool.start()
+
+        first = self._task(1)
+        second = self._task(2)
+        pool.submit(first)
+        pool.submit(second)
+        other = self._task(3)
+        other['input']['action'] = 'other'
+        pool.submit(other)
+
+        # the second "test" task waits for the first, but doesn't
+        # stop the unrelated task from using the free worker
+        self.assertTrue(self._wait_for(
+            lambda: sorted(output_handler.running) == ['other', 'test']))
+        self.assertEqual(pool.stats()['queue_depth'], 1)
+
+        output_handler.release.set()
+        self.assertTrue(self._wait_for(
+            lambda: pool.stats()['completed'] == 3))
+
+    def test_stop_unclaims_queued_tasks(self):
+        self.pool.start()
+        for task_id in range(4):
+            self.pool.submit(self._task(task_id))
+        self.assertTrue(self._wait_for(
+            lambda: self.pool.stats()['busy'] == 2))
+
+        # the queued tasks go back to the input handler before the
+        # running ones finish, without a result
+        stopper = threading.Thread(target=self.pool.stop)
+        stopper.start()
+        self.assertTrue(self._wait_for(
+            lambda: len(self.input_handler.unclaimed) == 2))
+        self.assertEqual(
+            sorted([data['input']['id']
+                    for data in self.input_handler.unclaimed]), [2, 3])
+        self.assertEqual(self.input_handler.results, [])
+
+        self.output_handler.release.set()
+        stopper.join(5)
+        self.assertEqual(
+            sorted([data['input']['id']
+                    for data in self.input_handler.results]), [0, 1])
+        self.assertEqual(self.pool.stats()['queue_depth'], 0)
+
+    def _prioritised_pool(self, path, aging=30):
+        # a real output manager, and a single worker held busy by the
+        # first task until release is set
+        release = threading.Event()
+        self.order = []
+
+        def run(input_data):
+            self.order.append(input_data['id'])
+            release.wait(5)
+            return output_manager._ok()
+
+        om = output_manager.OutputManager(path)
+        om.config = {'main': {'trans_log_dir': path}}
+        om.register_action('test', 'test.py', 'batch', run,
+                           priority=output_manager.PRIORITY_BATCH)
+        om.register_action('test', 'test.py', 'normal', run)
+        om.register_action('test', 'test.py', 'urgent', run,
+                           priority=output_manager.PRIORITY_INTERACTIVE)
+
+        pool = OpenCenterAgentDispatchPool(self.input_handler, om,
+                                           size=1, queue_size=8,
+                                           aging=aging)
+        self.addCleanup(pool.stop)
+        self.addCleanup(release.set)
+        pool.start()
+        return pool, release
+
+    def _action(self, task_id, action, payload=None):
+        return {'plugin': 'input',
+                'input': {'id': task_id, 'action': action,
+                          'payload': payload or {}}}
+
+    def test_priority_order(self):
+        with utils.temporary_directory() as path:
+            pool, release = self._prioritised_pool(path)
+            pool.submit(self._action(1, 'batch'))
+            self.assertTrue(self._wait_for(lambda: self.order == [1]))
+
+            pool.submit(self._action(2, 'batch'))
+            pool.submit(self._action(3, 'normal'))
+            pool.submit(self._action(4, 'urgent'))
+            pool.submit(self._action(5, 'batch', {'priority': 100}))
+
+            # queued behind batch work, the urgent task still goes
+            # first, unless a payload says otherwise
+            release.set()
+            self.assertTrue(self._wait_for(
+                lambda: pool.stats()['completed'] == 5))
+            self.assertEqual(self.order, [1, 5, 4, 3, 2])
+
+    def test_priority_aging(self):
+        with utils.temporary_directory() as path:
+            pool, release = self._prioritised_pool(path, aging=0.05)
+            pool.submit(self._action(1, 'normal'))
+            self.assertTrue(self._wait_for(lambda: self.order == [1]))
+
+            # waiting 12 aging periods lifts batch over normal work
+            pool.submit(self._action(2, 'batch'))
+            time.sleep(0.6)
+            pool.submit(self._action(3, 'normal'))
+
+            release.set()
+            self.assertTrue(self._wait_for(
+                lambda: pool.stats()['completed'] == 3))
+            self.assertEqual(self.order, [1, 2, 3])
+
+    def test_submit_stopped(self):
+        self.assertRaises(RuntimeError, self.pool.submit, self._task(1))
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+#               OpenCenter(TM) is Copyright 2013 by Rackspace US, Inc.
+##############################################################################
+#
+# OpenCenter is licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.  This
+# version of OpenCenter includes Rackspace trademarks and logos, and in
+# accordance with Section 6 of the License, the provision of commercial
+# support services in conjunction with a version of OpenCenter which includes
+# Rackspace trademarks and logos is prohibited.  OpenCenter source code and
+# details are available at: # https://github.com/rcbops/opencenter or upon
+# written request.
+#
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0 and a copy, including this
+# notice, is available in the LICENSE file accompanying this software.
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the # specific language governing permissions and limitations
+# under the License.
+#
+##############################################################################
+#
+#
+
+import fixtures
+import testtools
+import unittest
+
+from opencenteragent import backoff
+
+
+class TestBackoff(testtools.TestCase):
+    def _no_jitter(self, value):
+        self.useFixture(fixtures.MonkeyPatch(
+            'opencenteragent.backoff.random.random', lambda: value))
+
+    def test_sequence(self):
+        self._no_jitter(0)
+        b = backoff.Backoff(initial=1, cap=10, first=0.2)
+        self.assertEqual([b.delay() for x in range(7)],
+                         [0.2, 1, 2, 4, 8, 10, 10])
+        self.assertEqual(b.failures, 7)
+
+    def test_long_outage(self):
+        # the delay stays at the cap, however long the server is down
+        b = backoff.Backoff(initial=1, cap=10, first=0.2)
+        for x in range(5000):
+            delay = b.delay()
+            self.assertTrue(0 < delay <= 10)
+        self.assertEqual(b.base, 10)
+        self.assertEqual(b.failures, 5000)
+
+    def test_reset(self):
+        self._no_jitter(0)
+        b = backoff.Backoff(initial=1, first=0.2)
+        b.delay()
+        b.delay()
+        b.reset()
+        self.assertEqual(b.failures, 0)
+        self.assertEqual(b.total_failures, 2)
+        # back to the fast first retry
+        self.assertEqual(b.delay(), 0.2)
+
+    def test_jitter(self):
+        self._no_jitter(1)
+        b = backoff.Backoff(initial=1, first=4, jitter=0.25)
+        self.assertEqual(b.delay(), 3)
+
+    def test_jitter_range(self):
+        b = backoff.Backoff(initial=8, first=8, jitter=0.5)
+        for x in range(100):
+            b.reset()
+            delay = b.delay()
+            self.assertTrue(4 <= delay <= 8)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,330 @@
+#!/usr/bin/env python
+#               OpenCenter(TM) is Copyright 2013 by Rackspace US, Inc.
+##############################################################################
+#
+# OpenCenter is licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.  This
+# version of OpenCenter includes Rackspace trademarks and logos, and in
+# accordance with Section 6 of the License, the provision of commercial
+# support services in conjunction with a version of OpenCenter which includes
+# Rackspace trademarks and logos is prohibited.  OpenCenter source code and
+# details are available at: # https://github.com/rcbops/opencenter or upon
+# written request.
+#
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0 and a copy, including this
+# notice, is available in the LICENSE file accompanying this software.
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the # specific language governing permissions and limitations
+# under the License.
+#
+##############################################################################
+#
+#
+
+import fixtures
+import logging
+import os
+import sys
+import testtools
+import threading
+import time
+import unittest
+
+from opencenteragent import task_context
+
+# the agent puts plugins/lib on sys.path for the plugins that use it
+sys.path.append(os.path.join(os.path.dirname(__file__), '..',
+                             'opencenteragent', 'plugins', 'lib'))
+import bashscriptrunner  # noqa
+
+
+class TestRecordDecoder(testtools.TestCase):
+    def test_split_anywhere(self):
+        data = 'facts\0a\0b\0consequences\0\0x := 1\0attrs\0c\0d\0'
+        expected = [('facts', 'a', 'b'), ('consequences', '', 'x := 1'),
+                    ('attrs', 'c', 'd')]
+        for size in range(1, len(data) + 1):
+            decoder = bashscriptrunner.RecordDecoder()
+            records = []
+            for i in range(0, len(data), size):
+                records.extend(decoder.feed(data[i:i + size]))
+            records.extend(decoder.close())
+            self.assertEqual(records, expected)
+            self.assertEqual(decoder.malformed, [])
+            self.assertEqual(decoder.records, 3)
+
+    def test_resync(self):
+        # a record cut short mid-stream costs only that record
+        data = 'facts\0a\0facts\0b\0one\0facts\0c\0two\0'
+        for size in range(1, len(data) + 1):
+            decoder = bashscriptrunner.RecordDecoder()
+            records = []
+            for i in range(0, len(data), size):
+                records.extend(decoder.feed(data[i:i + size]))
+            records.extend(decoder.close())
+            self.assertEqual(
+                [bashscriptrunner._consequence(*record)
+                 for record in records],
+                ['facts.b := one', 'facts.c := two'])
+            self.assertEqual(decoder.malformed, [('facts', 'a')])
+            self.assertEqual(decoder.records, 2)
+
+    def test_type_name_as_value(self):
+        decoder = bashscriptrunner.RecordDecoder()
+        records = decoder.feed('attrs\0kind\0facts\0facts\0a\0b\0'
+                               'facts\0x\0attrs\0')
+        self.assertEqual(records, [('attrs', 'kind', 'facts'),
+                                   ('facts', 'a', 'b')])
+        # nothing follows to say whether this one is in step
+        self.assertEqual(decoder.close(), [('facts', 'x', 'attrs')])
+        self.assertEqual(decoder.malformed, [])
+
+    def test_malformed(self):
+        decoder = bashscriptrunner.RecordDecoder()
+        records = decoder.feed('bogus\0a\0b\0facts\0\0b\0'
+                               'facts\0a\0b\0facts\0trunc')
+        self.assertEqual(records, [('facts', 'a', 'b')])
+        self.assertEqual(decoder.close(), [])
+        self.assertEqual(decoder.malformed, [('bogus', 'a', 'b'),
+                                             ('facts', '', 'b'),
+                                             ('facts', 'trunc')])
+        self.assertEqual(decoder.malformed_count, 3)
+
+    def test_malformed_bounded(self):
+        decoder = bashscriptrunner.RecordDecoder()
+        records = decoder.feed('bogus\0a\0b\0' * 10000)
+        self.assertEqual(records, [])
+        self.assertEqual(decoder.malformed_count, 10000)
+        self.assertEqual(len(decoder.malformed),
+                         bashscriptrunner.MAX_MALFORMED)
+
+
+class TestBashScriptRunner(testtools.TestCase):
+    def setUp(self):
+        super(TestBashScriptRunner, self).setUp()
+        self.path = self.useFixture(fixtures.TempDir()).path
+        self.runner = bashscriptrunner.BashScriptRunner(
+            script_path=[self.path], log=logging.getLogger('test'))
+
+    def _in_task(self, timeout):
+        context = task_context.TaskContext(1, 'test', timeout)
+        task_context.activate(context)
+        self.addCleanup(task_context.deactivate)
+        return context
+
+    def _alive(self, pid):
+        try:
+            with open('/proc/%d/stat' % pid) as f:
+                return f.read().split()[2] != 'Z'
+        except IOError:
+            return False
+
+    def _script(self, name, body):
+        script = os.path.join(self.path, name)
+        with open(script, 'w') as f:
+            f.write('#!/bin/bash\n%s\n' % body)
+        os.chmod(script, 0755)
+
+    def test_outputs(self):
+        self._script('facts.sh',
+                     "printf 'facts\\0a\\0b\\0consequences\\0\\0x := 1\\0' >&3"
+                     "\nexit 3")
+        result = self.runner.run('facts.sh')
+        self.assertEqual(result['result_code'], 3)
+        self.assertEqual(result['result_data']['consequences'],
+                         ['facts.a := b', 'x := 1'])
+
+    def test_malformed_output(self):
+        self._script('bad.sh',
+                     "printf 'facts\\0a\\0b\\0facts\\0partial' >&3")
+        result = self.runner.run('bad.sh')
+        self.assertEqual(result['result_data']['consequences'],
+                         ['facts.a := b'])
+        self.assertEqual(len(result['result_data']['malformed']), 1)
+        self.assertEqual(result['result_data']['malformed_count'], 1)
+
+    def test_spawn(self):
+        if bashscriptrunner.posix_spawn is None:
+            self.skipTest('no posix_spawn')
+
+        c = bashscriptrunner.BashExec(
+            ['/bin/sh', '-c', 'printf "facts\\0pgid\\0%s\\0" '
+             '"$(ps -o pgid= -p $$ | tr -d \\ )" >&3; exit 4'],
+            env={'PATH': '/bin:/usr/bin'})
+        self.assertTrue(c.spawned)
+        ret_code, outputs = c.wait()
+        self.assertEqual(ret_code, 4)
+        # in a process group of its own
+        self.assertEqual(outputs['consequences'],
+                         ['facts.pgid := %d' % c.child_pid])
+
+    def _fd_open(self, fd, **kwargs):
+        c = bashscriptrunner.BashExec(
+            ['/bin/sh', '-c', 'if [ -e /dev/fd/%d ]; then s=open; '
+             'else s=closed; fi; printf "facts\\0fd\\0%%s\\0" $s >&3'
+             % fd], env={'PATH': '/bin:/usr/bin'}, **kwargs)
+        outputs = c.wait()[1]
+        return c.spawned, outputs['consequences']
+
+    def test_fds_not_inherited(self):
+        null = os.open('/dev/null', os.O_RDONLY)
+        fd = 100
+        os.dup2(null, fd)
+        os.close(null)
+        self.addCleanup(os.close, fd)
+
+        spawned, consequences = self._fd_open(fd)
+        self.assertEqual(spawned, bashscriptrunner.posix_spawn is not None)
+        self.assertEqual(consequences, ['facts.fd := closed'])
+        spawned, consequences = self._fd_open(fd, use_spawn=False)
+        self.assertFalse(spawned)
+        self.assertEqual(consequences, ['facts.fd := closed'])
+
+        # but fd 3 is there
+        self.assertEqual(self._fd_open(3)[1], ['facts.fd := open'])
+
+    def test_spawn_inherits_environment(self):
+        if bashscriptrunner.posix_spawn is None:
+            self.skipTest('no posix_spawn')
+
+        self.useFixture(fixtures.EnvironmentVariable('BASHEXEC_TEST', 'x'))
+        c = bashscriptrunner.BashExec(
+            ['/bin/sh', '-c',
+             'printf "facts\\0env\\0%s\\0" "$BASHEXEC_TEST" >&3'])
+        self.assertTrue(c.spawned)
+        self.assertEqual(c.wait()[1]['consequences'], ['facts.env := x'])
+
+    def test_spawn_failure_closes_pipe(self):
+        def broken(*args, **kwargs):
+            raise ValueError('broken')
+
+        self.useFixture(fixtures.MonkeyPatch(
+            'bashscriptrunner.posix_spawn', broken))
+        before = sorted(bashscriptrunner._open_fds())
+        self.assertRaises(ValueError, bashscriptrunner.BashExec,
+                          ['/bin/true'], env={})
+        self.assertEqual(sorted(bashscriptrunner._open_fds()), before)
+
+    def test_spawn_fallback(self):
+        # rlimits need the fork path
+        c = bashscriptrunner.BashExec(['/bin/true'], env={},
+                                      rlimits={'nofile': 64})
+        self.assertFalse(c.spawned)
+        self.assertEqual(c.wait()[0], 0)
+
+        # so does reporting a failed exec
+        c = bashscriptrunner.BashExec([os.path.join(self.path, 'none')],
+                                      env={})
+        self.assertEqual(c.wait()[0], 127)
+
+    def test_script_index(self):
+        self._script('a.sh', 'exit 0')
+        self.assertEqual(self.runner.find_script('a.sh'),
+                         os.path.join(self.path, 'a.sh'))
+        self.assertTrue('a.sh' in self.runner.script_index)
+
+        # removing it changes the directory, dropping the cache
+        os.unlink(os.path.join(self.path, 'a.sh'))
+        self.assertEqual(self.runner.find_script('a.sh'), None)
+        self.assertEqual(self.runner.script_index, {})
+
+        self._script('b.sh', 'exit 0')
+        self.assertEqual(self.runner.find_script('b.sh'),
+                         os.path.join(self.path, 'b.sh'))
+
+    def test_base_env(self):
+        runner = bashscriptrunner.BashScriptRunner(
+            script_path=[self.path], log=logging.getLogger('test'),
+            environment={'PATH': '/bin', 'FOO': 'bar'})
+        self._script('env.sh',
+                     'printf "facts\\0env\\0%s\\0" "$FOO:$RCB_BAZ" >&3')
+        result = runner.run_env('env.sh', {'baz': 1}, 'RCB')
+        self.assertEqual(result['result_data']['consequences'],
+                         ['facts.env := bar:1'])
+        self.assertFalse('RCB_BAZ' in runner.base_env)
+
+    def test_not_found(self):
+        result = self.runner.run('missing.sh')
+        self.assertEqual(result['result_code'], 127)
+
+    def test_large_output(self):
+        # far more than a pipe buffer, so the script blocks unless
+        # fd 3 is read while it runs
+        self._script('big.sh',
+                     'value=$(head -c 200 /dev/zero | tr "\\0" x)\n'
+                     'for i in $(seq 2000); do\n'
+                     '    printf "facts\\0k$i\\0$value\\0" >&3\n'
+                     'done')
+        result = self.runner.run('big.sh')
+        self.assertEqual(result['result_code'], 0)
+        consequences = result['result_data']['consequences']
+        self.assertEqual(len(consequences), 2000)
+        self.assertEqual(consequences[-1], 'facts.k2000 := %s' % ('x' * 200))
+
+    def test_background_holds_output(self):
+        # a daemon started by the script inherits fd 3; we mustn't
+        # wait for it to exit
+        self._script('daemon.sh',
+                     "sleep 10 >/dev/null 2>&1 &\n"
+                     "printf 'facts\\0a\\0b\\0' >&3")
+        start = time.time()
+        result = self.runner.run('daemon.sh')
+        self.assertTrue(time.time() - start < 5)
+        self.assertEqual(result['result_data']['consequences'],
+                         ['facts.a := b'])
+
+    def test_deadline_kills_group(self):
+        pidfile = os.path.join(self.path, 'helper.pid')
+        self._script('slow.sh',
+                     'sleep 30 &\n'
+                     'echo $! > %s\n'
+                     'sleep 30' % pidfile)
+        self._in_task(0.5)
+        start = time.time()
+        result = self.runner.run('slow.sh')
+        self.assertTrue(time.time() - start < 5)
+        self.assertEqual(result['result_code'], 124)
+
+        # the helper went with it
+        with open(pidfile) as f:
+            helper = int(f.read())
+        for _ in range(50):
+            if not self._alive(helper):
+                break
+            time.sleep(0.1)
+        self.assertFalse(self._alive(helper))
+
+    def test_kill_escalates(self):
+        self.runner.kill_grace = 0.5
+        self._script('stubborn.sh', "trap '' TERM\nsleep 30")
+        self._in_task(0.3)
+        start = time.time()
+        result = self.runner.run('stubborn.sh')
+        self.assertTrue(time.time() - start < 5)
+        self.assertEqual(result['result_code'], 124)
+
+    def test_cancel_kills(self):
+        self._script('slow.sh', 'sleep 30')
+        context = self._in_task(None)
+        threading.Timer(0.3, context.cancel).start()
+        start = time.time()
+        result = self.runner.run('slow.sh')
+        self.assertTrue(time.time() - start < 5)
+        self.assertEqual(result['result_code'], 128 + 15)
+
+    def test_rlimits(self):
+        self.runner.rlimits = bashscriptrunner.rlimits_from_config(
+            {'rlimit_nofile': '20'})
+        self._script('limits.sh',
+                     'printf "facts\\0nofile\\0%s\\0" "$(ulimit -n)" >&3')
+        result = self.runner.run('limits.sh')
+        self.assertEqual(result['result_data']['consequences'],
+                         ['facts.nofile := 20'])
+
+
+if __name__ == '__main__':
+    unittest.main()
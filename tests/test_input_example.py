@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+#               OpenCenter(TM) is Copyright 2013 by Rackspace US, Inc.
+##############################################################################
+#
+# OpenCenter is licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.  This
+# version of OpenCenter includes Rackspace trademarks and logos, and in
+# accordance with Section 6 of the License, the provision of commercial
+# support services in conjunction with a version of OpenCenter which includes
+# Rackspace trademarks and logos is prohibited.  OpenCenter source code and
+# details are available at: # https://github.com/rcbops/opencenter or upon
+# written request.
+#
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0 and a copy, including this
+# notice, is available in the LICENSE file accompanying this software.
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the # specific language governing permissions and limitations
+# under the License.
+#
+##############################################################################
+#
+#
+
+import httplib
+import json
+import os
+import socket
+import testtools
+import unittest
+
+from opencenteragent.modules import input_manager
+
+PLUGIN = os.path.join(os.path.dirname(__file__), '..', 'opencenteragent',
+                      'plugins', 'input', 'input_example.py')
+
+
+class TestRestishInput(testtools.TestCase):
+    def setUp(self):
+        super(TestRestishInput, self).setUp()
+        config = {'restish': {'bind_address': '127.0.0.1',
+                              'bind_port': 0,
+                              'max_queue': 2,
+                              'max_request_size': 100}}
+        self.im = input_manager.InputManager([PLUGIN], config=config)
+        self.addCleanup(self.im.stop)
+        self.plugin = self.im.plugins['example']
+        self.address = self.plugin['server_thread'].httpd.server_address
+
+    def _connection(self):
+        return httplib.HTTPConnection(*self.address, timeout=5)
+
+    def _post(self, conn, path, body):
+        conn.request('POST', path, json.dumps(body),
+                     {'Content-Type': 'application/json'})
+        response = conn.getresponse()
+        response.read()
+        return response.status
+
+    def test_bind_config(self):
+        self.assertEqual(self.address[0], '127.0.0.1')
+        self.assertNotEqual(self.address[1], 8000)
+
+    def test_keepalive_and_order(self):
+        conn = self._connection()
+        self.assertEqual(self._post(conn, '/first', {'n': 1}), 200)
+        # same connection
+        self.assertEqual(self._post(conn, '/second', {'n': 2}), 200)
+        conn.close()
+
+        self.assertEqual(self.im.fetch()['input']['action'], 'first')
+        second = self.im.fetch()['input']
+        self.assertEqual(second['action'], 'second')
+        self.assertEqual(second['payload'], {'n': 2})
+
+    def test_queue_full(self):
+        conn = self._connection()
+        self.assertEqual(self._post(conn, '/a', {}), 200)
+        self.assertEqual(self._post(conn, '/b', {}), 200)
+        self.assertEqual(self._post(conn, '/c', {}), 503)
+        self.assertEqual(self.plugin['pending'](), 2)
+
+    def test_request_too_large(self):
+        conn = self._connection()
+        self.assertEqual(self._post(conn, '/a', {'x': 'y' * 200}), 413)
+        self.assertEqual(self.plugin['pending'](), 0)
+
+    def test_bad_json(self):
+        conn = self._connection()
+        conn.request('POST', '/a', '{nope',
+                     {'Content-Type': 'application/json'})
+        self.assertEqual(conn.getresponse().status, 400)
+
+    def test_length_required(self):
+        sock = socket.create_connection(self.address, 5)
+        sock.sendall('POST /a HTTP/1.1\r\n'
+                     'Content-Type: application/json\r\n\r\n')
+        self.assertTrue(sock.recv(1024).startswith('HTTP/1.1 411'))
+        sock.close()
+
+    def test_status(self):
+        conn = self._connection()
+        conn.request('GET', '/')
+        response = conn.getresponse()
+        self.assertEqual(json.loads(response.read()), {'pending': 0})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,266 @@
+#!/usr/bin/env python
+#               OpenCenter(TM) is Copyright 2013 by Rackspace US, Inc.
+##############################################################################
+#
+# OpenCenter is licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.  This
+# version of OpenCenter includes Rackspace trademarks and logos, and in
+# accordance with Section 6 of the License, the provision of commercial
+# support services in conjunction with a version of OpenCenter which includes
+# Rackspace trademarks and logos is prohibited.  OpenCenter source code and
+# details are available at: # https://github.com/rcbops/opencenter or upon
+# written request.
+#
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0 and a copy, including this
+# notice, is available in the LICENSE file accompanying this software.
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the # specific language governing permissions and limitations
+# under the License.
+#
+##############################################################################
+#
+#
+
+import errno
+import fixtures
+import os
+import socket
+import testtools
+import time
+import unittest
+
+from opencenteragent import logstream
+from opencenteragent import utils
+
+
+def wait_for(predicate, timeout=5):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if predicate():
+            return True
+        time.sleep(0.05)
+    return predicate()
+
+
+class TempDir(fixtures.Fixture):
+    def setUp(self):
+        super(TempDir, self).setUp()
+        context = utils.temporary_directory()
+        self.path = context.__enter__()
+        self.addCleanup(context.__exit__, None, None, None)
+
+
+class LogStreamerTests(object):
+    use_inotify = True
+    poll_interval = 1
+
+    def setUp(self):
+        super(LogStreamerTests, self).setUp()
+        self.streamer = logstream.LogStreamer(
+            poll_interval=self.poll_interval,
+            use_inotify=self.use_inotify)
+        self.addCleanup(self.streamer.stop)
+
+        self.logdir = self.useFixture(TempDir()).path
+        self.path = os.path.join(self.logdir, 'trans_1.log')
+        self.writer = open(self.path, 'w')
+        self.addCleanup(self.writer.close)
+
+    def _stream(self, timeout=10, offset=None):
+        local, remote = socket.socketpair()
+        self.addCleanup(remote.close)
+        remote.settimeout(5)
+
+        fd = open(self.path, 'rb')
+        if offset is None:
+            fd.seek(0, os.SEEK_END)
+        else:
+            fd.seek(offset)
+        self.streamer.add(fd, local, timeout)
+        return remote
+
+    def _append(self, data):
+        self.writer.write(data)
+        self.writer.flush()
+
+    def _recv_all(self, remote):
+        data = ''
+        while True:
+            chunk = remote.recv(65536)
+            if not chunk:
+                return data
+            data += chunk
+
+    def test_tail(self):
+        self._append('0123456789')
+        remote = self._stream(timeout=0, offset=4)
+        # sent to EOF, then closed
+        self.assertEqual(self._recv_all(remote), '456789')
+        self.assertTrue(wait_for(lambda: self.streamer.count() == 0))
+
+        stats = self.streamer.stats()
+        self.assertEqual(stats['opened'], 1)
+        self.assertEqual(stats['closed'], 1)
+        self.assertEqual(stats['failed'], 0)
+        self.assertEqual(stats['bytes_sent'], 6)
+
+    def test_tail_large_file(self):
+        # more than the socket buffer will take in one go
+        data = ''.join([chr(ord('a') + x % 26) for x in range(2000000)])
+        self._append(data)
+        remote = self._stream(timeout=0, offset=0)
+        time.sleep(0.2)
+        self.assertEqual(self._recv_all(remote), data)
+
+    def test_tail_without_sendfile(self):
+        self.useFixture(fixtures.MonkeyPatch(
+            'opencenteragent.utils.sendfile', None))
+        data = 'x' * 300000
+        self._append(data)
+        remote = self._stream(timeout=0, offset=0)
+        self.assertEqual(self._recv_all(remote), data)
+
+    def test_tail_remote_gone(self):
+        self._append('x' * 4000000)
+        remote = self._stream(timeout=0, offset=0)
+        remote.close()
+        self.assertTrue(wait_for(lambda: self.streamer.count() == 0))
+        self.assertEqual(self.streamer.stats()['failed'], 1)
+
+    def test_follows_writes(self):
+        remote = self._stream()
+        self._append('hello\n')
+        self.assertEqual(remote.recv(100), 'hello\n')
+        self._append('again\n')
+        self.assertEqual(remote.recv(100), 'again\n')
+        self.assertEqual(self.streamer.count(), 1)
+        self.assertEqual(self.streamer.stats()['following'], 1)
+
+    def test_many_streams_one_thread(self):
+        remotes = [self._stream() for x in range(200)]
+        self._append('shared\n')
+        for remote in remotes:
+            self.assertEqual(remote.recv(100), 'shared\n')
+        self.assertEqual(self.streamer.count(), 200)
+        self.assertTrue(wait_for(
+            lambda: self.streamer.stats()['bytes_sent'] == 200 * 7))
+
+    def test_remote_close(self):
+        remote = self._stream()
+        self.assertTrue(wait_for(lambda: self.streamer.count() == 1))
+        remote.close()
+        self.assertTrue(wait_for(lambda: self.streamer.count() == 0))
+
+    def test_idle_timeout(self):
+        remote = self._stream(timeout=0.3)
+        self.assertTrue(wait_for(lambda: self.streamer.count() == 0))
+        # closed from our end
+        self.assertEqual(remote.recv(100), '')
+
+    def test_stop_closes_streams(self):
+        remote = self._stream()
+        self.streamer.stop()
+        self.assertEqual(remote.recv(100), '')
+        self.assertEqual(self.streamer.count(), 0)
+
+
+class TestLogStreamerInotify(LogStreamerTests, testtools.TestCase):
+    def setUp(self):
+        try:
+            logstream.Inotify().close()
+        except OSError:
+            self.skipTest('no inotify on this platform')
+        super(TestLogStreamerInotify, self).setUp()
+
+    def test_uses_inotify(self):
+        self._stream()
+        self.assertTrue(wait_for(lambda: self.streamer.stats()['inotify']))
+        self.assertTrue(wait_for(lambda: self.streamer.wds != {}))
+
+
+class TestLogStreamerPolling(LogStreamerTests, testtools.TestCase):
+    use_inotify = False
+    poll_interval = 0.1
+
+
+class FakeSocket(object):
+    """Takes at most size bytes per send, and good_sends sends."""
+
+    def __init__(self, size=3, good_sends=1000, error=None):
+        self.size = size
+        self.good_sends = good_sends
+        self.error = error
+        self.data = ''
+
+    def send(self, data):
+        if self.good_sends == 0:
+            if self.error is not None:
+                raise self.error
+            return 0
+        self.good_sends -= 1
+        self.data += data[:self.size]
+        return len(data[:self.size])
+
+
+class TestLogStreamerSend(testtools.TestCase):
+    # the send() path used when sendfile() isn't available
+    def setUp(self):
+        super(TestLogStreamerSend, self).setUp()
+        self.useFixture(fixtures.FakeLogger())
+        self.streamer = logstream.LogStreamer()
+
+        path = os.path.join(self.useFixture(TempDir()).path, 'trans_1.log')
+        with open(path, 'w') as f:
+            f.write('0123456789')
+        self.fd = open(path, 'rb')
+        self.addCleanup(self.fd.close)
+
+    def _send(self, sock):
+        stream = logstream._Stream(self.fd, sock, 0)
+        stream.use_sendfile = False
+        stream.refresh()
+        return stream, self.streamer._send(stream)
+
+    def test_partial_sends(self):
+        sock = FakeSocket(size=3)
+        stream, ok = self._send(sock)
+        self.assertTrue(ok)
+        self.assertFalse(stream.behind())
+        self.assertEqual(sock.data, '0123456789')
+        self.assertEqual(self.streamer.bytes_sent, 10)
+
+    def test_socket_full(self):
+        sock = FakeSocket(size=3, good_sends=2,
+                          error=socket.error(errno.EAGAIN, 'try again'))
+        stream, ok = self._send(sock)
+        # still connected, the rest goes when the socket is writable
+        self.assertTrue(ok)
+        self.assertEqual(stream.offset, 6)
+
+        sock.good_sends = 1000
+        self.assertTrue(self.streamer._send(stream))
+        self.assertEqual(sock.data, '0123456789')
+
+    def test_socket_closed(self):
+        stream, ok = self._send(FakeSocket(size=3, good_sends=1))
+        self.assertFalse(ok)
+        self.assertEqual(stream.sent, 3)
+
+    def test_socket_error(self):
+        stream, ok = self._send(FakeSocket(
+            good_sends=0, error=socket.error(errno.EPIPE, 'broken pipe')))
+        self.assertFalse(ok)
+
+    def test_socket_raises(self):
+        stream, ok = self._send(FakeSocket(
+            good_sends=0, error=Exception('Unexpected banana!')))
+        self.assertFalse(ok)
+        self.assertEqual(stream.sent, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+#               OpenCenter(TM) is Copyright 2013 by Rackspace US, Inc.
+##############################################################################
+#
+# OpenCenter is licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.  This
+# version of OpenCenter includes Rackspace trademarks and logos, and in
+# accordance with Section 6 of the License, the provision of commercial
+# support services in conjunction with a version of OpenCenter which includes
+# Rackspace trademarks and logos is prohibited.  OpenCenter source code and
+# details are available at: # https://github.com/rcbops/opencenter or upon
+# written request.
+#
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0 and a copy, including this
+# notice, is available in the LICENSE file accompanying this software.
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the # specific language governing permissions and limitations
+# under the License.
+#
+##############################################################################
+#
+#
+
+import os
+import testtools
+import threading
+import unittest
+
+from opencenteragent.modules import input_manager
+from opencenteragent import utils
+
+
+PLUGIN = """
+name = '%s'
+queue = []
+
+
+def setup(config={}):
+    pass
+
+
+def put(item):
+    queue.append(item)
+    notify_ready()
+
+
+def pending():
+    return len(queue)
+
+
+def fetch():
+    if len(queue) > 0:
+        return queue.pop(0)
+    return {}
+"""
+
+
+class TestModuleInputManager(testtools.TestCase):
+    def _manager(self, path, names=None, config=None):
+        plugins = []
+        for name in names or ['queue']:
+            plugin = os.path.join(path, '%s.py' % name)
+            with open(plugin, 'w') as f:
+                f.write(PLUGIN % name)
+            plugins.append(plugin)
+        return input_manager.InputManager(plugins, config=config or {})
+
+    def _fill(self, im, name, count):
+        for i in range(count):
+            im.plugins[name]['put']({'id': '%s-%d' % (name, i)})
+
+    def _served(self, im, count):
+        served = []
+        for _ in range(count):
+            served.append(im.fetch()['plugin'])
+        return served
+
+    def test_notify_ready_injected(self):
+        with utils.temporary_directory() as path:
+            im = self._manager(path)
+            self.assertTrue('notify_ready' in im.plugins['queue'])
+
+    def test_wait_times_out(self):
+        with utils.temporary_directory() as path:
+            im = self._manager(path)
+            self.assertEqual(im.fetch(), {})
+            self.assertFalse(im.wait(0.01))
+
+    def test_wait_woken_by_plugin(self):
+        with utils.temporary_directory() as path:
+            im = self._manager(path)
+            self.assertEqual(im.fetch(), {})
+
+            put = im.plugins['queue']['put']
+            t = threading.Timer(0.05, put, [{'id': 1}])
+            t.start()
+            self.assertTrue(im.wait(5))
+            t.join()
+
+            self.assertEqual(im.fetch(), {'plugin': 'queue',
+                                          'input': {'id': 1}})
+
+    def test_notify_before_wait_not_lost(self):
+        with utils.temporary_directory() as path:
+            im = self._manager(path)
+            im.plugins['queue']['put']({'id': 1})
+            self.assertTrue(im.wait(0))
+
+    def test_fetch_round_robin(self):
+        with utils.temporary_directory() as path:
+            im = self._manager(path, ['a', 'b'])
+            self._fill(im, 'a', 10)
+            self._fill(im, 'b', 10)
+
+            served = self._served(im, 6)
+            self.assertEqual(served.count('a'), 3)
+            self.assertEqual(served.count('b'), 3)
+
+    def test_fetch_weighted(self):
+        with utils.temporary_directory() as path:
+            im = self._manager(path, ['a', 'b'],
+                               {'a': {'fetch_weight': '3'}})
+            self._fill(im, 'a', 10)
+            self._fill(im, 'b', 10)
+
+            served = self._served(im, 8)
+            self.assertEqual(served.count('a'), 6)
+            self.assertEqual(served.count('b'), 2)
+
+    def test_fetch_priority(self):
+        with utils.temporary_directory() as path:
+            im = self._manager(path, ['a', 'b'],
+                               {'b': {'fetch_priority': '1'}})
+            self._fill(im, 'a', 2)
+            self._fill(im, 'b', 2)
+
+            self.assertEqual(self._served(im, 4), ['b', 'b', 'a', 'a'])
+
+    def test_fetch_idle_plugin_keeps_no_credit(self):
+        with utils.temporary_directory() as path:
+            im = self._manager(path, ['a', 'b'])
+            self._fill(im, 'a', 5)
+            self._served(im, 5)
+
+            # b sat idle while a was served; it must not now get a
+            # run of dispatches to "catch up"
+            self._fill(im, 'a', 4)
+            self._fill(im, 'b', 4)
+            served = self._served(im, 4)
+            self.assertEqual(served.count('a'), 2)
+            self.assertEqual(served.count('b'), 2)
+
+    def test_stats(self):
+        with utils.temporary_directory() as path:
+            im = self._manager(path, ['a', 'b'])
+            self._fill(im, 'a', 3)
+            im.fetch()
+
+            stats = im.stats()
+            self.assertEqual(stats['a']['served'], 1)
+            self.assertEqual(stats['a']['waiting'], 2)
+            self.assertEqual(stats['a']['fetched'], 1)
+            self.assertEqual(stats['b']['served'], 0)
+            self.assertEqual(stats['b']['waiting'], 0)
+
+    def test_unclaim(self):
+        with utils.temporary_directory() as path:
+            im = self._manager(path, ['a', 'b'])
+            unclaimed = []
+            im.plugins['a']['unclaim'] = unclaimed.append
+
+            self.assertTrue(im.unclaim({'plugin': 'a', 'input': {'id': 1}}))
+            self.assertEqual(unclaimed, [{'id': 1}])
+            # b can't take input back
+            self.assertFalse(im.unclaim({'plugin': 'b',
+                                         'input': {'id': 2}}))
+
+    def test_health(self):
+        with utils.temporary_directory() as path:
+            im = self._manager(path, ['a', 'b', 'c'])
+            self.assertEqual(im.health(), {'state': 'ok', 'plugins': {}})
+
+            im.plugins['a']['health'] = lambda: {'state': 'ok'}
+            im.plugins['b']['health'] = lambda: {'state': 'degraded',
+                                                 'failures': 1}
+            health = im.health()
+            self.assertEqual(health['state'], 'degraded')
+            self.assertEqual(health['plugins']['b']['failures'], 1)
+            self.assertFalse('c' in health['plugins'])
+
+            def broken():
+                raise RuntimeError('boom')
+
+            im.plugins['c']['health'] = broken
+            health = im.health()
+            self.assertEqual(health['state'], 'down')
+            self.assertEqual(health['plugins']['c']['error'], 'boom')
+
+
+if __name__ == '__main__':
+    unittest.main()
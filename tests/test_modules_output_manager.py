@@ -28,9 +28,12 @@ import fixtures
 import os
 import socket
 import testtools
+import threading
+import time
 import unittest
 
 from opencenteragent.modules import output_manager
+from opencenteragent import task_context
 from opencenteragent import utils
 
 
@@ -52,9 +55,9 @@ class FakeSocket(object):
         return len(data)
 
 
-class FakeSocketSendFails(FakeSocket):
-    def send(self, data):
-        raise Exception('send failed')
+class FakeSocketConnectFails(FakeSocket):
+    def connect(self, ip_port):
+        raise socket.error('no route to host')
 
 
 class TestModuleOutputManager(testtools.TestCase):
@@ -98,6 +101,43 @@ class TestModuleOutputManager(testtools.TestCase):
                              'opencenter_agent_actions')
             self.assertTrue('value' in out['result_data'])
 
+    def test_actions_digest(self):
+        with utils.temporary_directory() as path:
+            om = output_manager.OutputManager(path)
+            before = om.actions_digest()
+            self.assertEqual(om.actions_digest(), before)
+
+            om.register_action('test', 'test', 'test.new', self.fake_loadfile)
+            self.assertNotEqual(om.actions_digest(), before)
+
+    def test_handle_modules_actions_since(self):
+        with utils.temporary_directory() as path:
+            om = output_manager.OutputManager(path)
+            out = om.handle_modules({'action': 'modules.actions'})
+            first = out['result_data']
+            self.assertEqual(first['digest'], om.actions_digest())
+
+            out = om.handle_modules({'action': 'modules.actions',
+                                     'payload': {'since': first['digest']}})
+            self.assertTrue(out['result_data']['unchanged'])
+            self.assertFalse('value' in out['result_data'])
+
+            om.register_action('test', 'test', 'test.new', self.fake_loadfile)
+            del om.dispatch_table['modules.reload']
+            out = om.handle_modules({'action': 'modules.actions',
+                                     'payload': {'since': first['digest']}})
+            delta = out['result_data']['delta']
+            self.assertEqual(delta['changed'].keys(), ['test.new'])
+            self.assertEqual(delta['removed'], ['modules.reload'])
+            self.assertEqual(
+                output_manager.apply_actions_delta(first['value'], delta),
+                om.actions())
+
+            # an unknown table gets the whole thing
+            out = om.handle_modules({'action': 'modules.actions',
+                                     'payload': {'since': 'nope'}})
+            self.assertEqual(out['result_data']['value'], om.actions())
+
     def fake_loadfile(self, path):
         self.loadfile_calls += 1
 
@@ -137,43 +177,6 @@ class TestModuleOutputManager(testtools.TestCase):
             self.assertEqual(out['result_code'], 0)
             self.assertEqual(out['result_str'], 'success')
 
-    def test_xter_to_eof(self):
-        class FileLikeObject(object):
-            def __init__(self, good_reads):
-                self.good_reads = good_reads
-
-            def read(self, size):
-                self.good_reads -= 1
-                if self.good_reads > 0:
-                    return '!' * size
-                return ''
-
-        class SocketLikeObject(object):
-            def __init__(self, good_writes):
-                self.good_writes = good_writes
-
-            def send(self, size):
-                self.good_writes -= 1
-                if self.good_writes > 0:
-                    return len(size)
-                return 0
-
-        class ExceptionalSocketLikeObject(object):
-            def send(self, data):
-                raise Exception('Unexpected banana!')
-
-        f = FileLikeObject(2)
-        s = SocketLikeObject(100)
-        self.assertTrue(output_manager._xfer_to_eof(f, s))
-
-        f = FileLikeObject(100)
-        s = SocketLikeObject(1)
-        self.assertFalse(output_manager._xfer_to_eof(f, s))
-
-        f = FileLikeObject(100)
-        s = ExceptionalSocketLikeObject()
-        self.assertFalse(output_manager._xfer_to_eof(f, s))
-
     def test_handle_logfile_no_payload(self):
         with utils.temporary_directory() as path:
             om = output_manager.OutputManager(path)
@@ -217,8 +220,22 @@ class TestModuleOutputManager(testtools.TestCase):
                 # self.assertEqual(out['result_str'],
                 #                  '[Errno 111] Connection refused')
 
+    def _listen(self):
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(1)
+        self.addCleanup(listener.close)
+        return listener, listener.getsockname()[1]
+
+    def _wait_for_streams(self, om, count):
+        for i in range(50):
+            if om.log_streamer.count() == count:
+                break
+            time.sleep(0.1)
+        self.assertEqual(om.log_streamer.count(), count)
+
     def test_handle_logfile_tail(self):
-        sock = FakeSocket(socket.AF_INET, socket.SOCK_STREAM)
+        listener, port = self._listen()
         with utils.temporary_directory() as path:
             with utils.temporary_directory() as logdir:
                 om = output_manager.OutputManager(path)
@@ -230,15 +247,26 @@ class TestModuleOutputManager(testtools.TestCase):
                 out = om.handle_logfile({'action': 'logfile.tail',
                                          'payload': {'task_id': '42',
                                                      'dest_ip': '127.0.0.1',
-                                                     'dest_port': 4242,
-                                                     'offset': 1024}},
-                                        sock=sock)
+                                                     'dest_port': port,
+                                                     'offset': {
+                                                         'position': 'end',
+                                                         'length': 7}}})
                 self.assertEqual(out['result_code'], 0)
-                self.assertNotEqual(sock.sent, [])
+
+                conn, addr = listener.accept()
+                self.assertEqual(self._recv_until(conn, 'ab' * 100),
+                                 'og\nfile')
+                conn.close()
+
+                self._wait_for_streams(om, 0)
+                stats = om.log_streamer.stats()
+                self.assertEqual(stats['bytes_sent'], 7)
+                self.assertEqual(stats['closed'], 1)
+                om.stop()
 
     def test_handle_logfile_tail_socket_fail(self):
         self.useFixture(fixtures.MonkeyPatch('socket.socket',
-                                             FakeSocketSendFails))
+                                             FakeSocketConnectFails))
 
         with utils.temporary_directory() as path:
             with utils.temporary_directory() as logdir:
@@ -254,18 +282,21 @@ class TestModuleOutputManager(testtools.TestCase):
                                                      'dest_port': 4242,
                                                      'offset': 1024}})
                 self.assertEqual(out['result_code'], 1)
-                self.assertEqual(out['result_str'],
-                                 'remote socket disconnect')
-
-    def fake_sleep(self, duration):
-        self.sleep_count += 1
-        if self.sleep_count < 11:
-            self.sleep_writes_to.write('This is more data!\n')
-            self.sleep_writes_to.flush()
+                self.assertEqual(out['result_str'], 'no route to host')
+                self.assertEqual(om.log_streamer.count(), 0)
+
+    def _recv_until(self, conn, expected):
+        conn.settimeout(5)
+        data = ''
+        while len(data) < len(expected):
+            chunk = conn.recv(4096)
+            if not chunk:
+                break
+            data += chunk
+        return data
 
     def test_handle_logfile_watch(self):
-        sock = FakeSocket(socket.AF_INET, socket.SOCK_STREAM)
-        self.useFixture(fixtures.MonkeyPatch('time.sleep', self.fake_sleep))
+        listener, port = self._listen()
 
         with utils.temporary_directory() as path:
             with utils.temporary_directory() as logdir:
@@ -274,28 +305,232 @@ class TestModuleOutputManager(testtools.TestCase):
 
                 with open(os.path.join(logdir, 'trans_42.log'), 'w') as f:
                     f.write('This\nis\na\nlog\nfile')
-
-                    self.sleep_count = 0
-                    self.sleep_writes_to = f
+                    f.flush()
 
                     out = om.handle_logfile(
                         {'action': 'logfile.watch',
                          'payload': {'task_id': '42',
                                      'dest_ip': '127.0.0.1',
-                                     'dest_port': 4242,
-                                     'timeout': 10}},
-                        sock=sock)
+                                     'dest_port': port,
+                                     'timeout': 10}})
+                    # returns straight away; the watcher carries on
                     self.assertEqual(out['result_code'], 0)
+                    self.assertEqual(om.log_streamer.count(), 1)
+
+                    conn, addr = listener.accept()
+                    self.assertEqual(
+                        self._recv_until(conn, 'This\nis\na\nlog\nfile'),
+                        'This\nis\na\nlog\nfile')
+
+                    f.write('This is more data!\n')
+                    f.flush()
+                    self.assertEqual(
+                        self._recv_until(conn, 'This is more data!\n'),
+                        'This is more data!\n')
+
+                    # hanging up ends the watch
+                    conn.close()
+                    self._wait_for_streams(om, 0)
+
+                om.stop()
+
+    def _limited_manager(self, path):
+        def noop(input_data):
+            return output_manager._ok()
+
+        om = output_manager.OutputManager(path)
+        om.config = {'main': {'trans_log_dir': path},
+                     'locked': {'max_concurrency': '2'}}
+        om.register_action('locked', 'locked.py', 'single', noop,
+                           concurrency=1)
+        om.register_action('locked', 'locked.py', 'apt', noop,
+                           exclusive=['package-manager'])
+        om.register_action('locked', 'locked.py', 'yum', noop,
+                           exclusive=['package-manager'])
+        om.register_action('free', 'free.py', 'free', noop)
+        return om
+
+    def test_reserve_concurrency(self):
+        with utils.temporary_directory() as path:
+            om = self._limited_manager(path)
+            self.assertTrue(om.reserve({'action': 'single'}))
+            self.assertFalse(om.reserve({'action': 'single'}))
+            self.assertTrue(om.reserve({'action': 'free'}))
+            self.assertTrue(om.reserve({'action': 'free'}))
 
-                    # NOTE(mikal): this one is a little complicated. The
-                    # timeout is from the last bit of seen data... So, because
-                    # we return data for the first ten sleeps, we expect to
-                    # sleep 20 times before we timeout.
-                    self.assertEqual(self.sleep_count, 20)
+    def test_reserve_exclusion_group(self):
+        with utils.temporary_directory() as path:
+            om = self._limited_manager(path)
+            self.assertTrue(om.reserve({'action': 'apt'}))
+            self.assertFalse(om.reserve({'action': 'yum'}))
+            om.limiter.release('apt', 'locked', ['package-manager'])
+            self.assertTrue(om.reserve({'action': 'yum'}))
+
+    def test_reserve_plugin_limit(self):
+        with utils.temporary_directory() as path:
+            om = self._limited_manager(path)
+            self.assertTrue(om.reserve({'action': 'single'}))
+            self.assertTrue(om.reserve({'action': 'apt'}))
+            self.assertFalse(om.reserve({'action': 'yum'}))
+            self.assertEqual(om.limiter.stats()['plugins'], {'locked': 2})
+
+    def test_reserve_unknown_action(self):
+        with utils.temporary_directory() as path:
+            om = self._limited_manager(path)
+            self.assertTrue(om.reserve({'action': 'no.such.action'}))
+
+    def test_dispatch_releases_reservation(self):
+        with utils.temporary_directory() as path:
+            om = self._limited_manager(path)
+            released = []
+            om.add_release_listener(lambda: released.append(True))
+
+            self.assertTrue(om.reserve({'action': 'single'}))
+            out = om.dispatch({'action': 'single', 'payload': {}},
+                              reserved=True)
+            self.assertEqual(out['result_code'], 0)
+            self.assertEqual(released, [True])
+            self.assertEqual(om.limiter.stats()['actions'], {})
+
+            # unreserved dispatch takes and releases its own slot
+            out = om.dispatch({'action': 'single', 'payload': {}})
+            self.assertEqual(out['result_code'], 0)
+            self.assertTrue(om.reserve({'action': 'single'}))
+
+    def test_actions_default_timeout(self):
+        with utils.temporary_directory() as path:
+            om = self._limited_manager(path)
+            om.register_action('locked', 'locked.py', 'slow', self.fail,
+                               timeout=600)
+            actions = om.actions()
+            self.assertEqual(actions['free']['timeout'], 30)
+            self.assertEqual(actions['slow']['timeout'], 600)
+
+    def test_actions_priority(self):
+        with utils.temporary_directory() as path:
+            om = self._limited_manager(path)
+            om.register_action('batch', 'batch.py', 'batch', self.fail,
+                               priority=output_manager.PRIORITY_BATCH)
+            actions = om.actions()
+            self.assertEqual(actions['free']['priority'], 0)
+            self.assertEqual(actions['batch']['priority'], -10)
+            self.assertEqual(actions['logfile.watch']['priority'],
+                             output_manager.PRIORITY_INTERACTIVE)
+
+    def test_priority(self):
+        with utils.temporary_directory() as path:
+            om = self._limited_manager(path)
+            om.register_action('batch', 'batch.py', 'batch', self.fail,
+                               priority=output_manager.PRIORITY_BATCH)
+            self.assertEqual(om.priority({'action': 'batch'}), -10)
+            self.assertEqual(om.priority({'action': 'free'}), 0)
+            self.assertEqual(om.priority({'action': 'no.such.action'}), 0)
+
+            # the payload wins, if it makes sense
+            self.assertEqual(om.priority({'action': 'batch',
+                                          'payload': {'priority': '5'}}),
+                             5)
+            self.assertEqual(om.priority({'action': 'batch',
+                                          'payload': {'priority': 'x'}}),
+                             -10)
+            self.assertEqual(om.priority({'action': 'batch',
+                                          'payload': 'bogus'}), -10)
+
+    def test_dispatch_timeout(self):
+        release = threading.Event()
+        cancelled = []
+
+        def hang(input_data):
+            task_context.current().on_cancel(lambda: cancelled.append(1))
+            release.wait(5)
+            return output_manager._ok()
 
-                    self.assertNotEqual(sock.sent, [])
-                    self.assertEqual(len(sock.sent), 10)
+        with utils.temporary_directory() as path:
+            om = self._limited_manager(path)
+            om.register_action('locked', 'locked.py', 'hang', hang,
+                               timeout=0.1, concurrency=1)
+
+            out = om.dispatch({'action': 'hang', 'payload': {}})
+            self.assertEqual(out['result_code'],
+                             output_manager.TIMEOUT_RESULT_CODE)
+            self.assertEqual(cancelled, [1])
+
+            # the slot is held until the action really returns
+            self.assertFalse(om.reserve({'action': 'hang'}))
+            release.set()
+            for _ in range(500):
+                if om.limiter.stats()['actions'] == {}:
+                    break
+                time.sleep(0.01)
+            self.assertTrue(om.reserve({'action': 'hang'}))
+
+    def test_dispatch_timeout_not_reached(self):
+        def fail(input_data):
+            raise ValueError('broken action')
 
+        with utils.temporary_directory() as path:
+            om = self._limited_manager(path)
+            om.register_action('locked', 'locked.py', 'fail', fail,
+                               timeout=5)
+            self.assertRaises(ValueError, om.dispatch,
+                              {'action': 'fail', 'payload': {}})
+            out = om.dispatch({'action': 'single', 'payload': {}})
+            self.assertEqual(out['result_code'], 0)
+
+    def test_dispatch_closes_transaction_log(self):
+        self.useFixture(fixtures.FakeLogger())
+        with utils.temporary_directory() as path:
+            om = self._limited_manager(path)
+            om.plugins['free'] = {}
+            LOG = task_context.TaskLogger(None)
+
+            def log_something(input_data):
+                LOG.error('logged by task 7')
+                return output_manager._ok()
+
+            om.register_action('free', 'free.py', 'log', log_something)
+            out = om.dispatch({'id': 7, 'action': 'log', 'payload': {}})
+            self.assertEqual(out['result_code'], 0)
+            self.assertEqual(om.translog.open_count(), 0)
+
+            with open(os.path.join(path, 'trans_7.log')) as f:
+                self.assertTrue('logged by task 7' in f.read())
+
+    def test_dispatch_concurrent_transaction_logs(self):
+        self.useFixture(fixtures.FakeLogger())
+        with utils.temporary_directory() as path:
+            om = self._limited_manager(path)
+            om.plugins['free'] = {}
+            LOG = task_context.TaskLogger(None)
+            started = []
+            go = threading.Event()
+
+            def log_interleaved(input_data):
+                # both tasks are running before either one logs
+                started.append(input_data['id'])
+                if len(started) == 2:
+                    go.set()
+                go.wait(5)
+                for i in range(20):
+                    LOG.error('line from task %s' % input_data['id'])
+                    time.sleep(0.001)
+                return output_manager._ok()
+
+            om.register_action('free', 'free.py', 'log', log_interleaved)
+            threads = [threading.Thread(
+                target=om.dispatch,
+                args=({'id': task_id, 'action': 'log', 'payload': {}},))
+                for task_id in (1, 2)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+
+            for task_id in (1, 2):
+                with open(os.path.join(path, 'trans_%d.log' % task_id)) as f:
+                    lines = f.read().splitlines()
+                self.assertEqual(lines,
+                                 ['line from task %d' % task_id] * 20)
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+#               OpenCenter(TM) is Copyright 2013 by Rackspace US, Inc.
+##############################################################################
+#
+# OpenCenter is licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.  This
+# version of OpenCenter includes Rackspace trademarks and logos, and in
+# accordance with Section 6 of the License, the provision of commercial
+# support services in conjunction with a version of OpenCenter which includes
+# Rackspace trademarks and logos is prohibited.  OpenCenter source code and
+# details are available at: # https://github.com/rcbops/opencenter or upon
+# written request.
+#
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0 and a copy, including this
+# notice, is available in the LICENSE file accompanying this software.
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the # specific language governing permissions and limitations
+# under the License.
+#
+##############################################################################
+#
+#
+
+import os
+import testtools
+import unittest
+
+from opencenteragent import publishcache
+from opencenteragent import utils
+
+
+class TestPublishCache(testtools.TestCase):
+    def test_unchanged_after_record(self):
+        cache = publishcache.PublishCache(None, 1)
+        self.assertFalse(cache.unchanged('a', {'x': 1, 'y': 2}))
+        cache.queue('a', {'x': 1, 'y': 2})
+        cache.record('a', {'x': 1, 'y': 2})
+        self.assertTrue(cache.unchanged('a', {'y': 2, 'x': 1}))
+        self.assertFalse(cache.unchanged('a', {'x': 1}))
+        self.assertEqual(cache.stats(), {'cached': 1, 'skipped': 1})
+
+    def test_persisted(self):
+        with utils.temporary_directory() as path:
+            cache_file = os.path.join(path, 'published.json')
+            cache = publishcache.PublishCache(cache_file, 1)
+            cache.queue('a', [1, 2])
+            cache.record('a', [1, 2])
+
+            cache = publishcache.PublishCache(cache_file, '1\n')
+            self.assertTrue(cache.unchanged('a', [1, 2]))
+
+            # someone else's cache
+            cache = publishcache.PublishCache(cache_file, 2)
+            self.assertFalse(cache.unchanged('a', [1, 2]))
+
+    def test_queued_value_not_cached(self):
+        with utils.temporary_directory() as path:
+            cache_file = os.path.join(path, 'published.json')
+            cache = publishcache.PublishCache(cache_file, 1)
+            cache.queue('a', 'old')
+            cache.record('a', 'old')
+
+            # a new value is queued, but the agent stops before it
+            # goes out.  the old value must not count as published.
+            cache.queue('a', 'new')
+            cache = publishcache.PublishCache(cache_file, 1)
+            self.assertFalse(cache.unchanged('a', 'old'))
+
+    def test_record_superseded(self):
+        cache = publishcache.PublishCache(None, 1)
+        cache.queue('a', 'one')
+        cache.queue('a', 'two')
+        cache.record('a', 'one')
+        self.assertFalse(cache.unchanged('a', 'one'))
+        cache.record('a', 'two')
+        self.assertTrue(cache.unchanged('a', 'two'))
+
+    def test_reset(self):
+        cache = publishcache.PublishCache(None, 1)
+        cache.queue('a', 'one')
+        cache.record('a', 'one')
+        cache.reset(2)
+        self.assertFalse(cache.unchanged('a', 'one'))
+
+    def test_unreadable(self):
+        with utils.temporary_directory() as path:
+            cache_file = os.path.join(path, 'published.json')
+            with open(cache_file, 'w') as f:
+                f.write('{garbage')
+            cache = publishcache.PublishCache(cache_file, 1)
+            self.assertEqual(cache.stats()['cached'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
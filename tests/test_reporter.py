@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+#               OpenCenter(TM) is Copyright 2013 by Rackspace US, Inc.
+##############################################################################
+#
+# OpenCenter is licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.  This
+# version of OpenCenter includes Rackspace trademarks and logos, and in
+# accordance with Section 6 of the License, the provision of commercial
+# support services in conjunction with a version of OpenCenter which includes
+# Rackspace trademarks and logos is prohibited.  OpenCenter source code and
+# details are available at: # https://github.com/rcbops/opencenter or upon
+# written request.
+#
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0 and a copy, including this
+# notice, is available in the LICENSE file accompanying this software.
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the # specific language governing permissions and limitations
+# under the License.
+#
+##############################################################################
+#
+#
+
+import fixtures
+import os
+import testtools
+import threading
+import unittest
+
+from opencenteragent import reporter
+from opencenteragent import utils
+
+
+class FlakyError(Exception):
+    pass
+
+
+class FakeServer(object):
+    def __init__(self, failures=0):
+        self.failures = failures
+        self.received = []
+        self.gate = None
+
+    def send(self, key, data):
+        if self.gate is not None:
+            self.gate.wait(5)
+        if self.failures > 0:
+            self.failures -= 1
+            raise FlakyError('endpoint down')
+        if data == 'poison':
+            raise ValueError('bad report')
+        self.received.append((key, data))
+
+
+class TestResultReporter(testtools.TestCase):
+    def _reporter(self, server, **kwargs):
+        kwargs.setdefault('retry_on', (FlakyError,))
+        kwargs.setdefault('backoff_min', 0.01)
+        r = reporter.ResultReporter(server.send, **kwargs)
+        self.addCleanup(r.stop)
+        return r
+
+    def test_report(self):
+        server = FakeServer()
+        r = self._reporter(server)
+        r.start()
+        r.report('task:1', {'result_code': 0})
+        r.report('task:2', {'result_code': 1})
+        self.assertTrue(r.wait(5))
+        self.assertEqual(server.received,
+                         [('task:1', {'result_code': 0}),
+                          ('task:2', {'result_code': 1})])
+        self.assertEqual(r.stats()['sent'], 2)
+
+    def test_retry(self):
+        server = FakeServer(failures=3)
+        r = self._reporter(server)
+        r.start()
+        r.report('task:1', 'done')
+        self.assertTrue(r.wait(5))
+        self.assertEqual(server.received, [('task:1', 'done')])
+        self.assertEqual(r.stats()['retries'], 3)
+
+    def test_retry_waits_out_delay(self):
+        server = FakeServer(failures=1000)
+        r = self._reporter(server, backoff_min=2)
+        r.start()
+        r.report('task:1', 'done')
+        self.assertFalse(r.wait(0.5))
+        self.assertEqual(r.stats()['retries'], 1)
+
+        # new reports don't cut the retry delay short
+        for i in range(20):
+            r.report('attr:%d' % i, i)
+        self.assertFalse(r.wait(0.2))
+        self.assertEqual(r.stats()['retries'], 1)
+
+        # but stop() does
+        thread = r.thread
+        r.stop()
+        thread.join(1)
+        self.assertFalse(thread.is_alive())
+
+    def test_drop_unexpected_error(self):
+        server = FakeServer()
+        r = self._reporter(server)
+        r.start()
+        r.report('task:1', 'poison')
+        r.report('task:2', 'fine')
+        self.assertTrue(r.wait(5))
+        self.assertEqual(server.received, [('task:2', 'fine')])
+        self.assertEqual(r.stats()['dropped'], 1)
+
+    def test_coalesce(self):
+        server = FakeServer()
+        r = self._reporter(server)
+        # not started, so these all queue up
+        r.report('attr:a', 1)
+        r.report('attr:b', 1)
+        r.report('attr:a', 2)
+        r.report('attr:a', 3)
+        r.start()
+        self.assertTrue(r.wait(5))
+        self.assertEqual(server.received, [('attr:a', 3), ('attr:b', 1)])
+        self.assertEqual(r.stats()['coalesced'], 2)
+
+    def test_report_while_sending(self):
+        server = FakeServer()
+        server.gate = threading.Event()
+        r = self._reporter(server)
+        r.start()
+        r.report('attr:a', 1)
+        # the first send is stuck at the gate; this one must not be
+        # lost when it completes
+        r.report('attr:a', 2)
+        server.gate.set()
+        self.assertTrue(r.wait(5))
+        self.assertEqual(server.received[-1], ('attr:a', 2))
+
+    def test_queue_full_without_spool(self):
+        server = FakeServer()
+        r = self._reporter(server, queue_size=2)
+        r.report('task:1', 1)
+        r.report('task:2', 2)
+        r.report('task:3', 3)
+        self.assertEqual(r.pending(), 2)
+        self.assertEqual(r.stats()['dropped'], 1)
+
+    def test_spool_survives_restart(self):
+        with utils.temporary_directory() as spool:
+            server = FakeServer(failures=1000)
+            r = self._reporter(server, spool_dir=spool)
+            r.start()
+            r.report('task:1', {'result_code': 0})
+            r.report('attr:x', 'y')
+            self.assertFalse(r.wait(0.1))
+            r.stop()
+            self.assertEqual(len(os.listdir(spool)), 2)
+
+            server = FakeServer()
+            r = self._reporter(server, spool_dir=spool)
+            r.start()
+            self.assertTrue(r.wait(5))
+            self.assertEqual(sorted(server.received),
+                             [('attr:x', 'y'),
+                              ('task:1', {'result_code': 0})])
+            self.assertEqual(os.listdir(spool), [])
+
+    def test_spool_overflow(self):
+        with utils.temporary_directory() as spool:
+            server = FakeServer()
+            r = self._reporter(server, spool_dir=spool, queue_size=2)
+            for i in range(5):
+                r.report('task:%d' % i, i)
+            self.assertEqual(r.pending(), 2)
+            self.assertEqual(r.stats()['spilled'], True)
+
+            r.start()
+            self.assertTrue(r.wait(5))
+            self.assertEqual(sorted([d for k, d in server.received]),
+                             range(5))
+            self.assertEqual(r.stats()['dropped'], 0)
+
+    def test_spool_unserialisable(self):
+        with utils.temporary_directory() as spool:
+            server = FakeServer()
+            r = self._reporter(server, spool_dir=spool)
+            self.useFixture(fixtures.FakeLogger())
+            r.report('task:1', object())
+            self.assertEqual(os.listdir(spool), [])
+            self.assertEqual(r.pending(), 1)
+
+    def test_bad_spool_file(self):
+        with utils.temporary_directory() as spool:
+            with open(os.path.join(spool, 'junk.json'), 'w') as f:
+                f.write('{not json')
+
+            server = FakeServer()
+            r = self._reporter(server, spool_dir=spool)
+            r.start()
+            self.assertTrue(r.wait(5))
+            self.assertEqual(os.listdir(spool), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+#               OpenCenter(TM) is Copyright 2013 by Rackspace US, Inc.
+##############################################################################
+#
+# OpenCenter is licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.  This
+# version of OpenCenter includes Rackspace trademarks and logos, and in
+# accordance with Section 6 of the License, the provision of commercial
+# support services in conjunction with a version of OpenCenter which includes
+# Rackspace trademarks and logos is prohibited.  OpenCenter source code and
+# details are available at: # https://github.com/rcbops/opencenter or upon
+# written request.
+#
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0 and a copy, including this
+# notice, is available in the LICENSE file accompanying this software.
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the # specific language governing permissions and limitations
+# under the License.
+#
+##############################################################################
+#
+#
+
+import logging
+import threading
+import unittest
+
+from opencenteragent import task_context
+
+
+class TestTaskContext(unittest.TestCase):
+    def test_no_deadline(self):
+        context = task_context.TaskContext('42', 'test')
+        self.assertEqual(context.remaining(), None)
+
+    def test_deadline(self):
+        context = task_context.TaskContext('42', 'test', timeout=60)
+        self.assertTrue(0 < context.remaining() <= 60)
+
+    def test_cancel(self):
+        called = []
+        context = task_context.TaskContext('42', 'test')
+        context.on_cancel(lambda: called.append('first'))
+        context.on_cancel(lambda: called.append('second'))
+        context.cancel()
+        context.cancel()
+        self.assertEqual(called, ['first', 'second'])
+
+        # late registrations run straight away
+        context.on_cancel(lambda: called.append('late'))
+        self.assertEqual(called, ['first', 'second', 'late'])
+
+    def test_remove_cancel(self):
+        called = []
+
+        def callback():
+            called.append(True)
+
+        context = task_context.TaskContext('42', 'test')
+        context.on_cancel(callback)
+        context.remove_cancel(callback)
+        context.cancel()
+        self.assertEqual(called, [])
+
+    def test_current_is_per_thread(self):
+        context = task_context.TaskContext('42', 'test')
+        task_context.activate(context)
+        try:
+            seen = []
+            t = threading.Thread(
+                target=lambda: seen.append(task_context.current()))
+            t.start()
+            t.join()
+            self.assertEqual(seen, [None])
+            self.assertTrue(task_context.current() is context)
+        finally:
+            task_context.deactivate()
+        self.assertEqual(task_context.current(), None)
+
+    def test_task_logger(self):
+        default = logging.getLogger('opencenter.test.default')
+        task_logger = logging.getLogger('opencenter.test.task')
+        LOG = task_context.TaskLogger(default)
+        self.assertEqual(LOG.name, 'opencenter.test.default')
+
+        task_context.activate(task_context.TaskContext(
+            '42', 'test', logger=task_logger))
+        try:
+            self.assertEqual(LOG.name, 'opencenter.test.task')
+        finally:
+            task_context.deactivate()
+        self.assertEqual(LOG.name, 'opencenter.test.default')
+
+
+if __name__ == '__main__':
+    unittest.main()
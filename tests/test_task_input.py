@@ -0,0 +1,377 @@
+#!/usr/bin/env python
+#               OpenCenter(TM) is Copyright 2013 by Rackspace US, Inc.
+##############################################################################
+#
+# OpenCenter is licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.  This
+# version of OpenCenter includes Rackspace trademarks and logos, and in
+# accordance with Section 6 of the License, the provision of commercial
+# support services in conjunction with a version of OpenCenter which includes
+# Rackspace trademarks and logos is prohibited.  OpenCenter source code and
+# details are available at: # https://github.com/rcbops/opencenter or upon
+# written request.
+#
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0 and a copy, including this
+# notice, is available in the LICENSE file accompanying this software.
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the # specific language governing permissions and limitations
+# under the License.
+#
+##############################################################################
+#
+#
+
+import logging
+import os
+import testtools
+import time
+import unittest
+
+from requests import ConnectionError
+
+from opencenteragent import endpoints
+from opencenteragent import utils
+from opencenteragent.backoff import Backoff
+
+PLUGIN = os.path.join(os.path.dirname(__file__), '..', 'opencenteragent',
+                      'plugins', 'input', 'task_input.py')
+
+
+def wait_for(predicate, timeout=5):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if predicate():
+            return True
+        time.sleep(0.01)
+    return predicate()
+
+
+class FakeTask(object):
+    def __init__(self, task_id, action='test', payload=None):
+        self.id = task_id
+        self.action = action
+        self.payload = payload or {}
+        self.state = 'pending'
+        self.saved = []
+        self.error = None
+        self.on_save = None
+
+    def _request_get(self):
+        pass
+
+    def save(self):
+        if self.on_save is not None:
+            self.on_save()
+        if self.error is not None:
+            raise self.error
+        self.saved.append(self.state)
+
+    def to_hash(self):
+        return {'id': self.id, 'action': self.action,
+                'payload': self.payload}
+
+
+class FakeTasks(dict):
+    def filter(self, query):
+        return [task for task in self.values() if task.state == 'pending']
+
+
+class FakeNode(object):
+    def __init__(self):
+        self.task_id = None
+        self.saved = []
+        # what task_blocking hands out, in order
+        self.queue = []
+
+    def _request_get(self):
+        pass
+
+    def save(self):
+        self.saved.append(self.task_id)
+
+    @property
+    def task_blocking(self):
+        if self.queue:
+            return self.queue.pop(0)
+        return None
+
+
+class FakeAttr(object):
+    def __init__(self, saved, **kwargs):
+        self.saved = saved
+        self.attr = kwargs
+
+    def save(self):
+        self.saved.append(self.attr)
+
+
+class FakeAttrs(object):
+    def __init__(self):
+        self.saved = []
+
+    def new(self, **kwargs):
+        return FakeAttr(self.saved, **kwargs)
+
+
+class FakeEndpoint(object):
+    def __init__(self, url):
+        self.url = url
+        self.tasks = FakeTasks()
+        self.nodes = {'1': FakeNode()}
+        self.attrs = FakeAttrs()
+
+
+class TestTaskThread(testtools.TestCase):
+    def setUp(self):
+        super(TestTaskThread, self).setUp()
+        self.pool = endpoints.EndpointPool(FakeEndpoint)
+        self.ns = {'global_config': {},
+                   'LOG': logging.getLogger('opencenter.input.task_input'),
+                   'endpoints': self.pool,
+                   'notify_ready': lambda: None}
+        execfile(PLUGIN, self.ns)
+
+    def _thread(self, path, prefetch=1, publish_cache=None):
+        thread = self.ns['TaskThread'](
+            'http://server:8080/admin', 'node', '1',
+            os.path.join(path, 'hostid'), prefetch=prefetch,
+            backoff=Backoff(initial=0), publish_cache=publish_cache)
+        # don't sit out the backoff in _failed()
+        thread.stopping.set()
+        # as if run() had started
+        thread.running = True
+        return thread
+
+    def _start_local(self, thread):
+        # the modules.list/modules.actions tasks queued on connect
+        while thread.pending():
+            self.assertEqual(thread.fetch(blocking=False)['id'], -1)
+
+    def test_connection_error_invalidates_endpoint(self):
+        with utils.temporary_directory() as path:
+            thread = self._thread(path)
+            first = thread.endpoint
+            self.assertTrue(isinstance(first, FakeEndpoint))
+
+            thread._failed(ConnectionError('server went away'))
+            self.assertEqual(thread.endpoint, None)
+            self.assertFalse(thread.connected)
+            stats = self.pool.stats()['server:8080']
+            self.assertEqual(stats['invalidated'], 1)
+            self.assertEqual(stats['open'], 0)
+
+            # the next attempt gets a new endpoint
+            self.assertTrue(thread._maybe_init())
+            self.assertFalse(thread.endpoint is first)
+            self.assertEqual(self.pool.stats()['server:8080']['created'], 2)
+
+    def test_claim_outside_lock(self):
+        with utils.temporary_directory() as path:
+            thread = self._thread(path)
+            task = FakeTask(5)
+            locked = []
+            task.on_save = lambda: locked.append(
+                thread.producer_lock.locked())
+
+            self.assertTrue(thread._take(task))
+            self.assertEqual(task.saved, ['running'])
+            self.assertEqual(locked, [False])
+            self.assertTrue(5 in thread.tasks)
+            self.assertEqual(thread.node_updater.wanted, 5)
+
+            # already ours, so not claimed again
+            self.assertTrue(thread._take(task))
+            self.assertEqual(task.saved, ['running'])
+
+    def test_claim_connection_error(self):
+        with utils.temporary_directory() as path:
+            thread = self._thread(path)
+            task = FakeTask(5)
+            task.error = ConnectionError('server went away')
+
+            self.assertFalse(thread._take(task))
+            self.assertFalse(5 in thread.tasks)
+            self.assertEqual(thread.endpoint, None)
+
+    def test_node_task_id(self):
+        with utils.temporary_directory() as path:
+            thread = self._thread(path)
+            node = thread.endpoint.nodes['1']
+            updater = thread.node_updater
+            updater.start()
+            self.addCleanup(updater.stop)
+
+            updater.set(5)
+            self.assertTrue(wait_for(lambda: node.saved == [5]))
+
+            # another task's result doesn't clear ours
+            updater.clear(4)
+            updater.clear(5)
+            self.assertTrue(wait_for(lambda: node.saved == [5, None]))
+            self.assertEqual(node.task_id, None)
+
+    def test_poll_blocking(self):
+        with utils.temporary_directory() as path:
+            thread = self._thread(path)
+            node = thread.endpoint.nodes['1']
+            node.queue.append(FakeTask(3))
+            thread.endpoint.tasks[4] = FakeTask(4)
+
+            # without prefetch, one task at a time from the long poll
+            self.assertEqual([task.id for task in thread._poll(1)], [3])
+            self.assertEqual(thread._poll(1), [])
+
+    def test_prefetch(self):
+        with utils.temporary_directory() as path:
+            thread = self._thread(path, prefetch=3)
+            self._start_local(thread)
+            for task_id in [9, 3, 7, 5]:
+                thread.endpoint.tasks[task_id] = FakeTask(task_id)
+
+            self.assertEqual(thread._capacity(), 3)
+            tasks = thread._poll(thread._capacity())
+            self.assertEqual([task.id for task in tasks], [3, 5, 7])
+            for task in tasks:
+                self.assertTrue(thread._take(task))
+            self.assertEqual(thread._capacity(), 0)
+
+            # fetching one frees room for another
+            self.assertEqual(thread.fetch(blocking=False)['id'], 3)
+            self.assertEqual(thread._capacity(), 1)
+            tasks = thread._poll(thread._capacity())
+            self.assertEqual([task.id for task in tasks], [9])
+
+    def test_stop_returns_pending(self):
+        with utils.temporary_directory() as path:
+            thread = self._thread(path, prefetch=3)
+            self._start_local(thread)
+            endpoint = thread.endpoint
+            for task_id in [3, 5, 7]:
+                endpoint.tasks[task_id] = FakeTask(task_id)
+                self.assertTrue(thread._take(endpoint.tasks[task_id]))
+            self.assertEqual(thread.fetch(blocking=False)['id'], 3)
+
+            thread.stop()
+
+            # the running task is left alone, the queued ones go back
+            self.assertEqual(endpoint.tasks[3].state, 'running')
+            self.assertEqual(endpoint.tasks[5].state, 'pending')
+            self.assertEqual(endpoint.tasks[7].state, 'pending')
+            self.assertEqual(endpoint.tasks[7].saved,
+                             ['running', 'pending'])
+            self.assertEqual(thread.pending(), 0)
+
+    def test_take_after_stop(self):
+        with utils.temporary_directory() as path:
+            thread = self._thread(path, prefetch=3)
+            self._start_local(thread)
+            endpoint = thread.endpoint
+            task = endpoint.tasks[5] = FakeTask(5)
+            # stop() lands while the claim is on its way to the server
+            task.on_save = lambda: setattr(thread, 'running', False)
+
+            self.assertFalse(thread._take(task))
+            self.assertEqual(task.saved, ['running', 'pending'])
+            self.assertEqual(thread.pending(), 0)
+
+    def test_unchanged_attrs_not_published(self):
+        with utils.temporary_directory() as path:
+            thread = self._thread(
+                path, publish_cache=os.path.join(path, 'published'))
+            thread.reporter.start()
+            self.addCleanup(thread.reporter.stop)
+
+            def publish(value):
+                self._start_local(thread)
+                thread.result(-1, {'result_code': 0,
+                                   'result_data': {'name': 'modules',
+                                                   'value': value}},
+                              'modules.list')
+
+            publish(['a'])
+            saved = thread.endpoint.attrs.saved
+            self.assertTrue(wait_for(lambda: len(saved) == 1))
+            self.assertEqual(saved[0], {'node_id': '1', 'key': 'modules',
+                                        'value': ['a']})
+
+            # reconnecting republishes the module list, but the
+            # server already has it
+            thread._invalidate()
+            thread._maybe_init()
+            publish(['a'])
+            saved = thread.endpoint.attrs.saved
+            self.assertEqual(thread.reporter.stats()['sent'], 1)
+            self.assertEqual(saved, [])
+
+            # a changed value still goes out
+            thread._invalidate()
+            thread._maybe_init()
+            publish(['a', 'b'])
+            saved = thread.endpoint.attrs.saved
+            self.assertTrue(wait_for(lambda: len(saved) == 1))
+            self.assertEqual(saved[0]['value'], ['a', 'b'])
+
+    def test_priorities(self):
+        with utils.temporary_directory() as path:
+            thread = self._thread(path, prefetch=4)
+            self._start_local(thread)
+            thread.result(-1, {'result_code': 0,
+                               'result_data': {
+                                   'name': 'opencenter_agent_actions',
+                                   'value': {'batch': {'priority': -10},
+                                             'urgent': {'priority': 10},
+                                             'other': {}}}},
+                          'modules.actions')
+            self.assertEqual(thread.priorities,
+                             {'batch': -10, 'urgent': 10, 'other': 0})
+
+            tasks = [FakeTask(1, 'batch'), FakeTask(2, 'other'),
+                     FakeTask(3, 'urgent'),
+                     FakeTask(4, 'batch', {'priority': 20})]
+            for task in tasks:
+                self.assertTrue(thread._take(task))
+
+            fetched = [thread.fetch(blocking=False)['id']
+                       for task in tasks]
+            self.assertEqual(fetched, [4, 3, 2, 1])
+
+    def _fetch(self, thread, task_id):
+        while True:
+            task = thread.fetch(blocking=False)
+            if task.get('id') == task_id:
+                return task
+
+    def test_unclaim(self):
+        with utils.temporary_directory() as path:
+            thread = self._thread(path)
+            task = FakeTask(5)
+            thread.endpoint.tasks[5] = task
+            thread.tasks.add(5, task.to_hash())
+            self._fetch(thread, 5)
+
+            # fetched but never dispatched: back to pending upstream
+            thread.unclaim(5, 'test')
+            self.assertEqual(task.saved, ['pending'])
+            self.assertFalse(5 in thread.tasks)
+
+            # only once
+            thread.unclaim(5, 'test')
+            self.assertEqual(task.saved, ['pending'])
+
+    def test_other_failure_keeps_endpoint(self):
+        with utils.temporary_directory() as path:
+            thread = self._thread(path)
+            first = thread.endpoint
+
+            thread._failed('not registered')
+            self.assertTrue(thread.endpoint is first)
+            self.assertEqual(
+                self.pool.stats()['server:8080']['invalidated'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
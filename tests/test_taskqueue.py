@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+#               OpenCenter(TM) is Copyright 2013 by Rackspace US, Inc.
+##############################################################################
+#
+# OpenCenter is licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.  This
+# version of OpenCenter includes Rackspace trademarks and logos, and in
+# accordance with Section 6 of the License, the provision of commercial
+# support services in conjunction with a version of OpenCenter which includes
+# Rackspace trademarks and logos is prohibited.  OpenCenter source code and
+# details are available at: # https://github.com/rcbops/opencenter or upon
+# written request.
+#
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0 and a copy, including this
+# notice, is available in the LICENSE file accompanying this software.
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the # specific language governing permissions and limitations
+# under the License.
+#
+##############################################################################
+#
+#
+
+import fixtures
+import testtools
+import unittest
+
+from opencenteragent import taskqueue
+
+
+class FakeTime(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+
+class TestTaskQueue(testtools.TestCase):
+    def setUp(self):
+        super(TestTaskQueue, self).setUp()
+        self.clock = FakeTime()
+        self.useFixture(fixtures.MonkeyPatch(
+            'opencenteragent.taskqueue.time.time', self.clock.time))
+        self.queue = taskqueue.TaskQueue()
+
+    def test_fifo(self):
+        for i in range(1, 4):
+            self.assertTrue(self.queue.add(i, {'id': i}))
+        self.assertEqual(len(self.queue), 3)
+
+        self.assertEqual(self.queue.fetch(), (1, {'id': 1}))
+        self.assertEqual(self.queue.fetch(), (2, {'id': 2}))
+        self.assertEqual(self.queue.fetch(), (3, {'id': 3}))
+        self.assertEqual(self.queue.fetch(), None)
+
+    def test_dedupe(self):
+        self.assertTrue(self.queue.add(1, {'id': 1}))
+        self.assertFalse(self.queue.add(1, {'id': 1}))
+        self.queue.fetch()
+        # still running
+        self.assertFalse(self.queue.add(1, {'id': 1}))
+        self.assertTrue(1 in self.queue)
+
+        self.assertEqual(self.queue.finish(1), {'id': 1})
+        self.assertFalse(1 in self.queue)
+        self.assertEqual(self.queue.finish(1), None)
+
+    def test_claim(self):
+        self.assertTrue(self.queue.claim(1))
+        self.assertFalse(self.queue.claim(1))
+        self.assertTrue(1 in self.queue)
+        self.assertEqual(len(self.queue), 0)
+
+        self.assertTrue(self.queue.add(1, {'id': 1}))
+        self.assertEqual(self.queue.claiming, set())
+        self.assertFalse(self.queue.claim(1))
+
+    def test_unclaim(self):
+        self.queue.claim(1)
+        self.queue.unclaim(1)
+        self.assertFalse(1 in self.queue)
+        self.assertTrue(self.queue.claim(1))
+
+    def test_stats(self):
+        self.queue.add(1, {'id': 1})
+        self.clock.now += 5
+        self.queue.add(2, {'id': 2})
+        self.clock.now += 5
+
+        stats = self.queue.stats()
+        self.assertEqual(stats['pending'], 2)
+        self.assertEqual(stats['oldest_pending'], 10)
+
+        self.queue.fetch()
+        self.clock.now += 2
+        self.queue.fetch()
+        self.clock.now += 1
+
+        stats = self.queue.stats()
+        self.assertEqual(stats['pending'], 0)
+        self.assertEqual(stats['running'], 2)
+        self.assertEqual(stats['oldest_pending'], 0)
+        self.assertEqual(stats['oldest_running'], 3)
+        self.assertEqual(stats['max_wait'], 10)
+        self.assertEqual(stats['mean_wait'], 8.5)
+
+        self.queue.finish(1)
+        self.queue.finish(2)
+        stats = self.queue.stats()
+        self.assertEqual(stats['finished'], 2)
+        self.assertEqual(stats['oldest_running'], 0)
+
+    def test_priority(self):
+        self.queue.add(1, {'id': 1}, priority=-10)
+        self.queue.add(2, {'id': 2})
+        self.queue.add(3, {'id': 3}, priority=10)
+        self.queue.add(4, {'id': 4}, priority=10)
+        self.assertEqual(self.queue.stats()['by_priority'],
+                         {-10: 1, 0: 1, 10: 2})
+
+        self.assertEqual([self.queue.fetch()[0] for x in range(4)],
+                         [3, 4, 2, 1])
+        self.assertEqual(self.queue.stats()['by_priority'], {})
+
+    def test_aging(self):
+        queue = taskqueue.TaskQueue(aging=10)
+        queue.add('batch', {}, priority=-2)
+        self.clock.now += 15
+        queue.add('normal', {})
+        # batch has aged to -0.5, still behind
+        self.assertEqual(queue.fetch()[0], 'normal')
+
+        queue.add('normal2', {})
+        self.clock.now += 10
+        # batch is at +0.5 now, normal2 at +1
+        self.assertEqual(queue.fetch()[0], 'normal2')
+
+        queue.add('normal3', {})
+        self.clock.now += 10
+        # batch at +1.5, normal3 at +1
+        self.assertEqual(queue.fetch()[0], 'batch')
+        self.assertEqual(queue.fetch()[0], 'normal3')
+
+    def test_drain(self):
+        self.queue.add(1, {'id': 1})
+        self.queue.add(2, {'id': 2}, priority=5)
+        self.queue.add(3, {'id': 3})
+        self.queue.fetch()
+
+        self.assertEqual(self.queue.drain(), [(1, {'id': 1}),
+                                              (3, {'id': 3})])
+        self.assertEqual(len(self.queue), 0)
+        self.assertEqual(self.queue.stats()['by_priority'], {})
+        # running tasks stay
+        self.assertTrue(2 in self.queue)
+
+    def test_priority_dedupe(self):
+        self.assertTrue(self.queue.add(1, {'id': 1}, priority=5))
+        self.assertFalse(self.queue.add(1, {'id': 1}, priority=-5))
+        self.assertEqual(len(self.queue), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
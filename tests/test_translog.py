@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+#               OpenCenter(TM) is Copyright 2013 by Rackspace US, Inc.
+##############################################################################
+#
+# OpenCenter is licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.  This
+# version of OpenCenter includes Rackspace trademarks and logos, and in
+# accordance with Section 6 of the License, the provision of commercial
+# support services in conjunction with a version of OpenCenter which includes
+# Rackspace trademarks and logos is prohibited.  OpenCenter source code and
+# details are available at: # https://github.com/rcbops/opencenter or upon
+# written request.
+#
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0 and a copy, including this
+# notice, is available in the LICENSE file accompanying this software.
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the # specific language governing permissions and limitations
+# under the License.
+#
+##############################################################################
+#
+#
+
+import fixtures
+import os
+import testtools
+import unittest
+
+from opencenteragent import translog
+from opencenteragent import utils
+
+
+class TestTransactionLogs(testtools.TestCase):
+    def setUp(self):
+        super(TestTransactionLogs, self).setUp()
+        # keep what the tests log out of the test runner output
+        self.useFixture(fixtures.FakeLogger())
+
+    def test_open_and_close(self):
+        with utils.temporary_directory() as path:
+            logs = translog.TransactionLogs()
+            logger = logs.open(path, 42)
+            logger.error('hello from task 42')
+            self.assertEqual(logs.open_count(), 1)
+
+            logs.close(logger)
+            self.assertEqual(logs.open_count(), 0)
+            self.assertEqual(logger.handlers, [])
+
+            with open(logs.path(path, 42)) as f:
+                self.assertTrue('hello from task 42' in f.read())
+
+    def test_open_bounded(self):
+        with utils.temporary_directory() as path:
+            logs = translog.TransactionLogs(max_open=2)
+            first = logs.open(path, 1)
+            logs.open(path, 2)
+            logs.open(path, 3)
+            self.assertEqual(logs.open_count(), 2)
+            self.assertEqual(first.handlers, [])
+
+    def test_validate_missing(self):
+        with utils.temporary_directory() as path:
+            logs = translog.TransactionLogs()
+            self.assertRaises(OSError, logs.validate,
+                              os.path.join(path, 'missing'))
+
+    def test_validate_cached(self):
+        calls = []
+        isdir = os.path.isdir
+
+        def counting_isdir(path):
+            calls.append(path)
+            return isdir(path)
+
+        self.useFixture(fixtures.MonkeyPatch('os.path.isdir',
+                                             counting_isdir))
+        with utils.temporary_directory() as path:
+            logs = translog.TransactionLogs()
+            for task_id in range(3):
+                logs.close(logs.open(path, task_id))
+            self.assertEqual(len(calls), 1)
+
+    def test_open_failure_revalidates(self):
+        with utils.temporary_directory() as path:
+            logdir = os.path.join(path, 'logs')
+            os.mkdir(logdir)
+            logs = translog.TransactionLogs()
+            logs.close(logs.open(logdir, 1))
+
+            os.remove(logs.path(logdir, 1))
+            os.rmdir(logdir)
+            self.assertRaises(IOError, logs.open, logdir, 2)
+            self.assertRaises(OSError, logs.open, logdir, 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
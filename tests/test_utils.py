@@ -26,6 +26,7 @@
 
 import logging
 import os
+import socket
 import unittest
 
 from opencenteragent import utils
@@ -56,6 +57,11 @@ class TestOpenCenterUtils(unittest.TestCase):
             self.assertEqual(trace_as_string.find('banana()'), -1)
             self.assertNotEqual(trace_as_string.find('testing 123'), -1)
 
+    def test_digest(self):
+        self.assertEqual(utils.digest({'a': 1, 'b': [1, 2]}),
+                         utils.digest({'b': [1, 2], 'a': 1}))
+        self.assertNotEqual(utils.digest({'a': 1}), utils.digest({'a': 2}))
+
 
 class TestTemporaryFiles(unittest.TestCase):
     def test_temporary_file(self):
@@ -69,5 +75,34 @@ class TestTemporaryFiles(unittest.TestCase):
         self.assertFalse(os.path.exists(path))
 
 
+class TestSendfile(unittest.TestCase):
+    def test_sendfile(self):
+        if utils.sendfile is None:
+            self.skipTest('no sendfile on this platform')
+
+        a, b = socket.socketpair()
+        with utils.temporary_file() as filename:
+            with open(filename, 'wb') as fd:
+                fd.write('0123456789')
+
+            with open(filename, 'rb') as fd:
+                sent = utils.sendfile(a.fileno(), fd.fileno(), 4, 100)
+                self.assertEqual(sent, 6)
+                self.assertEqual(b.recv(100), '456789')
+
+                # at EOF
+                sent = utils.sendfile(a.fileno(), fd.fileno(), 10, 100)
+                self.assertEqual(sent, 0)
+
+            a.close()
+            b.close()
+
+    def test_sendfile_bad_fd(self):
+        if utils.sendfile is None:
+            self.skipTest('no sendfile on this platform')
+
+        self.assertRaises(OSError, utils.sendfile, -1, -1, 0, 10)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+#               OpenCenter(TM) is Copyright 2013 by Rackspace US, Inc.
+##############################################################################
+#
+# OpenCenter is licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.  This
+# version of OpenCenter includes Rackspace trademarks and logos, and in
+# accordance with Section 6 of the License, the provision of commercial
+# support services in conjunction with a version of OpenCenter which includes
+# Rackspace trademarks and logos is prohibited.  OpenCenter source code and
+# details are available at: # https://github.com/rcbops/opencenter or upon
+# written request.
+#
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0 and a copy, including this
+# notice, is available in the LICENSE file accompanying this software.
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the # specific language governing permissions and limitations
+# under the License.
+#
+##############################################################################
+#
+
+"""
+Benchmark for launching scripts through BashScriptRunner.
+
+Times the per-call setup run_env does before forking (finding the
+script and building its environment), the old way and with the
+runner's cached script index and base environment, and the cost of
+a whole run_env of a script that does nothing.
+
+Then compares launching /bin/true through BashExec with posix_spawn
+and with fork, with the agent's RSS padded by ballast_mb megabytes
+(a loaded agent with all its plugins is far bigger than this
+script).  Fork has to copy the page tables for all of it.
+
+usage: bench_launch.py [calls] [ballast_mb]
+"""
+
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.append(ROOT)
+sys.path.append(os.path.join(ROOT, 'opencenteragent', 'plugins', 'lib'))
+
+import bashscriptrunner  # noqa
+
+
+def old_setup(runner, script, environment, prefix):
+    env = {"PATH": "/usr/sbin:/usr/bin:/sbin:/bin"}
+    keep_env = ['http_proxy', 'https_proxy', 'no_proxy']
+    for key in set(keep_env).intersection(os.environ):
+        env[key] = os.environ[key]
+    env.update(runner.environment)
+    env.update(dict([(bashscriptrunner.name_mangle(k, prefix), str(v))
+                     for k, v in environment.iteritems()]))
+    return bashscriptrunner.find_script(script, runner.script_path), env
+
+
+def new_setup(runner, script, environment, prefix):
+    env = dict(runner.base_env)
+    env.update(dict([(bashscriptrunner.name_mangle(k, prefix), str(v))
+                     for k, v in environment.iteritems()]))
+    return runner.find_script(script), env
+
+
+def per_call(fn, calls):
+    start = time.time()
+    for _ in xrange(calls):
+        fn()
+    return (time.time() - start) / calls * 1000000
+
+
+def rss_mb():
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) / 1024.0
+    return 0
+
+
+def launch(use_spawn):
+    c = bashscriptrunner.BashExec(['/bin/true'], env={},
+                                  use_spawn=use_spawn)
+    c.wait()
+    return c.spawned
+
+
+def bench_spawn(calls, ballast_mb):
+    ballast = []
+    for _ in range(ballast_mb):
+        # touch every page, so it's really resident
+        ballast.append(bytearray(1024 * 1024))
+
+    print 'agent rss:     %8.1f MB' % rss_mb()
+    if not launch(True):
+        print 'posix_spawn not available, only fork measured'
+    else:
+        print 'posix_spawn:   %8.1f us/launch' % per_call(
+            lambda: launch(True), calls)
+    print 'fork:          %8.1f us/launch' % per_call(
+        lambda: launch(False), calls)
+
+
+def main(argv):
+    calls = int(argv[0]) if argv else 2000
+    ballast_mb = int(argv[1]) if len(argv) > 1 else 512
+
+    scripts = [tempfile.mkdtemp() for _ in range(3)]
+    try:
+        # the script lives in the last directory, like a plugin
+        # script found after a couple of misses
+        script = os.path.join(scripts[-1], 'noop.sh')
+        with open(script, 'w') as f:
+            f.write('#!/bin/sh\nexit 0\n')
+        os.chmod(script, 0755)
+
+        runner = bashscriptrunner.BashScriptRunner(
+            script_path=scripts, log=logging.getLogger('bench'),
+            environment={'OPENCENTER_BASH_DIR': scripts[0]})
+        environment = {'package': 'foo', 'version': '1.0'}
+
+        print 'setup, old:    %8.1f us/call' % per_call(
+            lambda: old_setup(runner, 'noop.sh', environment, 'RCB'),
+            calls)
+        print 'setup, cached: %8.1f us/call' % per_call(
+            lambda: new_setup(runner, 'noop.sh', environment, 'RCB'),
+            calls)
+        print 'run_env:       %8.1f us/call' % per_call(
+            lambda: runner.run_env('noop.sh', environment, 'RCB'),
+            max(1, calls / 10))
+    finally:
+        for path in scripts:
+            shutil.rmtree(path)
+
+    bench_spawn(max(1, calls / 10), ballast_mb)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
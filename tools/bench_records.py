@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+#               OpenCenter(TM) is Copyright 2013 by Rackspace US, Inc.
+##############################################################################
+#
+# OpenCenter is licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.  This
+# version of OpenCenter includes Rackspace trademarks and logos, and in
+# accordance with Section 6 of the License, the provision of commercial
+# support services in conjunction with a version of OpenCenter which includes
+# Rackspace trademarks and logos is prohibited.  OpenCenter source code and
+# details are available at: # https://github.com/rcbops/opencenter or upon
+# written request.
+#
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0 and a copy, including this
+# notice, is available in the LICENSE file accompanying this software.
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the # specific language governing permissions and limitations
+# under the License.
+#
+##############################################################################
+#
+
+"""
+Microbenchmark for decoding script output (the fd 3 records).
+
+Compares RecordDecoder with the parser BashExec.wait used to have,
+which appended 1 KB reads to a string and sliced three fields at a
+time off the front of a list.  Prints the cost per 10k records.
+
+usage: bench_records.py [records ...]
+"""
+
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.append(ROOT)
+sys.path.append(os.path.join(ROOT, 'opencenteragent', 'plugins', 'lib'))
+
+import bashscriptrunner  # noqa
+
+
+def make_output(count, value_size=64):
+    value = 'x' * value_size
+    return ''.join(['facts\0key%d\0%s\0' % (i, value)
+                    for i in xrange(count)])
+
+
+def chunks(data, size):
+    return [data[i:i + size] for i in xrange(0, len(data), size)]
+
+
+def old_parser(pieces):
+    output_str = ""
+    for n in pieces:
+        output_str += n
+
+    consequences = []
+    stuff = output_str.strip("\0").split("\0")
+    while len(stuff) > 0:
+        if len(stuff) % 3 == 0:
+            vtype, key, value = stuff[0:3]
+            stuff = stuff[3:]
+            consequences.append('%s.%s := %s' % (vtype, key, value))
+        else:
+            break
+    return consequences
+
+
+def new_parser(pieces):
+    decoder = bashscriptrunner.RecordDecoder()
+    consequences = []
+    for n in pieces:
+        for record in decoder.feed(n):
+            consequences.append(bashscriptrunner._consequence(*record))
+    for record in decoder.close():
+        consequences.append(bashscriptrunner._consequence(*record))
+    return consequences
+
+
+def timed(fn, pieces, repeat=3):
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        result = fn(pieces)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, result
+
+
+def main(argv):
+    counts = [int(x) for x in argv] or [1000, 5000, 10000]
+
+    print '%10s %8s %14s %14s' % ('records', 'read', 'old ms/10k',
+                                  'new ms/10k')
+    for count in counts:
+        data = make_output(count)
+        for size in [1024, 65536]:
+            pieces = chunks(data, size)
+            old, old_result = timed(old_parser, pieces)
+            new, new_result = timed(new_parser, pieces)
+            assert old_result == new_result
+
+            scale = 10000.0 / count * 1000
+            print '%10d %8d %14.2f %14.2f' % (count, size, old * scale,
+                                              new * scale)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])